@@ -0,0 +1,292 @@
+import io
+import os
+import json
+import gzip
+import time
+import tempfile
+import urllib.request
+import contextlib
+import datetime
+from pathlib import Path
+
+import click
+import discord
+
+from discard import reader
+from discard.discard import Discard, __version__
+from discard.metrics import peak_rss
+from discard.compression import get_codec, available_codecs, SUFFIXES
+from discard.standin import StandIn, synthetic_message, SYNTHETIC_GUILD_ID, SYNTHETIC_CHANNEL_ID, SYNTHETIC_START
+
+# Codecs compared by the codecs benchmark, those which aren't available are left out
+BENCHMARK_CODECS = ['gzip:1', 'gzip:6', 'gzip:9', 'bz2:9', 'lzma:0', 'lzma:6', 'zstd:3', 'zstd:19']
+
+def write_synthetic_channel(directory, num_messages, gzip_compress=False):
+    """Write a channel log of the given number of messages like Discard would,
+    with a message every minute.  Returns the channel path as taken by the reader."""
+    directory = Path(directory) / str(SYNTHETIC_GUILD_ID)
+    os.makedirs(directory, exist_ok=True)
+
+    start_ms = int((SYNTHETIC_START - datetime.datetime(1970, 1, 1)).total_seconds() * 1000) - reader.DISCORD_EPOCH
+    message_ids = [(start_ms + index * 60000) << 22 for index in range(num_messages)]
+
+    filename = f'{SYNTHETIC_CHANNEL_ID}.jsonl' + ('.gz' if gzip_compress else '')
+    open_func = gzip.open if gzip_compress else open
+    with open_func(directory / filename, 'wt', encoding='utf-8') as f:
+        after = 0
+        for page_start in range(0, num_messages, 100):
+            page = [synthetic_message(message_ids[index], index)
+                        for index in range(page_start, min(page_start + 100, num_messages))]
+            obj = {
+                'type': 'http',
+                'datetime_start': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'datetime_end': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'request': {
+                    'method': 'GET',
+                    'url': f'https://discord.com/api/v7/channels/{SYNTHETIC_CHANNEL_ID}/messages',
+                    'params': {'limit': 100, 'after': after}
+                },
+                'response': {
+                    'data': list(reversed(page))
+                }
+            }
+            f.write(json.dumps(obj, ensure_ascii=False) + '\n')
+            after = message_ids[min(page_start + 100, num_messages) - 1]
+
+    with open(directory / f'{SYNTHETIC_CHANNEL_ID}.meta.json', 'w') as f:
+        json.dump({
+            'channel': {'id': SYNTHETIC_CHANNEL_ID, 'name': 'synthetic', 'type': 'text'},
+            'summary': {
+                'num_messages': num_messages,
+                'oldest_message': {'id': message_ids[0]} if message_ids else None,
+                'newest_message': {'id': message_ids[-1]} if message_ids else None
+            }
+        }, f, indent=4)
+
+    return str(directory / str(SYNTHETIC_CHANNEL_ID))
+
+def time_call(func, *args, **kwargs):
+    """Time a call with its output discarded."""
+    time_start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(*args, **kwargs)
+    return time.perf_counter() - time_start
+
+def log_lines(path):
+    """The lines of a log, or of all logs in a directory."""
+    if os.path.isfile(path):
+        return [line.decode('utf-8') for line in reader.read_log_lines(path)]
+
+    lines = []
+    for directory, subdirectories, filenames in sorted(os.walk(path)):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if any(filename.endswith('.jsonl' + suffix) for suffix in [''] + SUFFIXES):
+                lines += log_lines(os.path.join(directory, filename))
+    return lines
+
+def measure_codec(codec, lines, directory):
+    """Write the lines with the codec and read them back.  Returns the
+    compressed size, and the seconds taken to write and to read."""
+    path = os.path.join(directory, 'benchmark.jsonl' + codec.suffix)
+
+    time_start = time.perf_counter()
+    with codec.open(path) as f:
+        for line in lines:
+            f.write(line)
+    write_seconds = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    for line in reader.read_log_lines(path):
+        pass
+    read_seconds = time.perf_counter() - time_start
+
+    size = os.path.getsize(path)
+    os.remove(path)
+    return size, write_seconds, read_seconds
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(directory, filename))
+                for directory, subdirectories, filenames in os.walk(path) for filename in filenames)
+
+@contextlib.contextmanager
+def api_base(url):
+    """Send discord.py's requests to another server."""
+    base = discord.http.Route.BASE
+    discord.http.Route.BASE = url + '/api/v7'
+    try:
+        yield
+    finally:
+        discord.http.Route.BASE = base
+
+def benchmark_archive(standin, directory, concurrency=1, guild_concurrency=1, codec=None, http_only=False,
+                        raw_history=False):
+    """Archive the guilds of a stand-in, then read and summarize the run.
+    Returns the results."""
+    process, url = standin.start_process()
+    try:
+        with api_base(url):
+            discard = Discard(token='standin', mode='guild', guild_id=standin.guild_ids, output_dir=Path(directory),
+                                concurrency=concurrency, guild_concurrency=guild_concurrency, codec=codec,
+                                http_only=http_only, raw_history=raw_history)
+            # The stand-in sends the guilds right after READY, there's no need to wait for more
+            discard.client._connection.guild_ready_timeout = 0.1
+            archive_seconds = time_call(discard.run)
+        archive_peak_rss = peak_rss()
+
+        with urllib.request.urlopen(url + '/standin/stats') as response:
+            server_stats = json.load(response)
+    finally:
+        process.terminate()
+        process.join()
+
+    run_path = discard.output_directory
+    with open(run_path / 'run.meta.json') as f:
+        meta = json.load(f)
+    num_messages = meta['summary']['num_messages']
+    read_seconds = time_call(reader.read_chats, reader.find_channels(run_path))
+    summary_seconds = time_call(reader.summary, Path(directory))
+
+    return {
+        'archive': {
+            'seconds': archive_seconds,
+            'num_messages': num_messages,
+            'messages_per_second': num_messages / archive_seconds,
+            'startup_time': meta['metrics']['startup_time'],
+            'startup_peak_rss': meta['metrics']['startup_peak_rss'],
+            'num_ws_connections': server_stats['num_ws_connections'],
+            'num_requests': server_stats['num_requests'],
+            'num_rate_limited': server_stats['num_rate_limited'],
+            'bytes_written': directory_size(run_path),
+            'peak_rss': archive_peak_rss
+        },
+        'read': {
+            'seconds': read_seconds,
+            'messages_per_second': num_messages / read_seconds
+        },
+        'summary': {
+            'seconds': summary_seconds
+        }
+    }
+
+@click.group(help="Measure the performance of Discard.")
+def benchmark():
+    pass
+
+@benchmark.command(help="Compare reading a channel log with and without discord.py objects.")
+@click.argument('path', required=False)
+@click.option('--messages', default=100000, help='Number of messages in the synthetic log, if no path is given.')
+@click.option('--gzip', default=False, is_flag=True, help='Compress the synthetic log with gzip.')
+def read(path, messages, gzip):
+    with tempfile.TemporaryDirectory() as directory:
+        if path is None:
+            path = write_synthetic_channel(directory, messages, gzip_compress=gzip)
+        else:
+            with open(path + '.meta.json') as f:
+                messages = json.load(f)['summary']['num_messages']
+
+        for name, objects in [("records", False), ("discord.py objects", True)]:
+            seconds = time_call(reader.read_chat, path, objects=objects)
+            print(f"{name}: {seconds:.2f}s, {messages / seconds:.0f} messages/s")
+
+@benchmark.command(help="Compare the compression codecs on a synthetic channel log and on the logs in PATH, "
+                        "a log or a directory of runs, or example/ if there is one.")
+@click.argument('path', required=False)
+@click.option('--messages', default=10000, help='Number of messages in the synthetic log.')
+@click.option('--json', 'as_json', default=False, is_flag=True, help='Output machine readable results.')
+def codecs(path, messages, as_json):
+    if path is None and os.path.isdir('example'):
+        path = 'example'
+
+    benchmark_codecs = [get_codec(spec) for spec in BENCHMARK_CODECS if spec.split(':')[0] in available_codecs()]
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        datasets = []
+        if path is not None:
+            datasets.append((path, log_lines(path)))
+        synthetic_path = write_synthetic_channel(directory, messages)
+        datasets.append((f"synthetic ({messages} messages)", log_lines(synthetic_path + '.jsonl')))
+
+        for name, lines in datasets:
+            size = sum(len(line.encode('utf-8')) for line in lines)
+            if not as_json:
+                print(f"{name}: {size / 1024**2:.2f} MiB")
+            for codec in benchmark_codecs:
+                compressed_size, write_seconds, read_seconds = measure_codec(codec, lines, directory)
+                result = {
+                    'data': name,
+                    'codec': str(codec),
+                    'size': size,
+                    'compressed_size': compressed_size,
+                    'ratio': size / compressed_size,
+                    'write_throughput': size / write_seconds,
+                    'read_throughput': size / read_seconds
+                }
+                results.append(result)
+                if not as_json:
+                    print(f"  {result['codec']}: ratio {result['ratio']:.2f}, "
+                          f"write {result['write_throughput'] / 1024**2:.1f} MiB/s, "
+                          f"read {result['read_throughput'] / 1024**2:.1f} MiB/s")
+
+    if as_json:
+        print(json.dumps(results))
+
+@benchmark.command(help="Archive synthetic guilds from a local stand-in for the Discord API, then read and "
+                        "summarize the run.")
+@click.option('--guilds', default=1, type=click.IntRange(min=1), help='Number of guilds, 1 by default.')
+@click.option('--channels', default=4, type=click.IntRange(min=1), help='Number of channels in every guild, 4 by default.')
+@click.option('--messages', default=10000, type=click.IntRange(min=0), help='Number of messages in every channel, 10000 by default.')
+@click.option('--reaction-density', default=0.1, type=click.FloatRange(min=0, max=1), help='Share of messages with a reaction, 0.1 by default.')
+@click.option('--rate-limit', default=0, type=click.IntRange(min=0), help='Requests allowed per channel and bucket in every window, unlimited by default.')
+@click.option('--rate-limit-window', default=1.0, type=click.FloatRange(min=0.01), help='Seconds in a rate limit window, 1 by default.')
+@click.option('--concurrency', default=1, type=click.IntRange(min=1), help='Number of channels to archive at once, 1 by default.')
+@click.option('--guild-concurrency', default=1, type=click.IntRange(min=1), help='Number of guilds to archive at once, 1 by default.')
+@click.option('--codec', help='Codec to compress logs with, none by default.')
+@click.option('--http-only', default=False, is_flag=True, help='Archive over HTTP only, without the gateway.')
+@click.option('--raw-history', default=False, is_flag=True, help='Page message history without building discord.py objects.')
+@click.option('--output', help='Append the results to this file, as a line of JSON.', type=click.Path(dir_okay=False))
+@click.option('--json', 'as_json', default=False, is_flag=True, help='Output machine readable results.')
+def archive(guilds, channels, messages, reaction_density, rate_limit, rate_limit_window, concurrency,
+            guild_concurrency, codec, http_only, raw_history, output, as_json):
+    settings = {
+        'guilds': guilds,
+        'channels': channels,
+        'messages': messages,
+        'reaction_density': reaction_density,
+        'rate_limit': rate_limit,
+        'rate_limit_window': rate_limit_window,
+        'concurrency': concurrency,
+        'guild_concurrency': guild_concurrency,
+        'codec': codec,
+        'http_only': http_only,
+        'raw_history': raw_history
+    }
+    standin = StandIn(num_channels=channels, num_messages=messages, reaction_density=reaction_density,
+                        rate_limit=rate_limit, rate_limit_window=rate_limit_window, num_guilds=guilds)
+    with tempfile.TemporaryDirectory() as directory:
+        results = benchmark_archive(standin, directory, concurrency=concurrency, guild_concurrency=guild_concurrency,
+                                    codec=codec, http_only=http_only, raw_history=raw_history)
+
+    results = {
+        'version': __version__,
+        'datetime': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'settings': settings,
+        **results
+    }
+    if output:
+        with open(output, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+
+    if as_json:
+        print(json.dumps(results))
+        return
+
+    archive, read = results['archive'], results['read']
+    print(f"startup: {archive['startup_time']:.2f}s")
+    print(f"archive: {archive['seconds']:.2f}s, {archive['messages_per_second']:.0f} messages/s, "
+          f"{archive['num_requests']} requests ({archive['num_rate_limited']} rate limited), "
+          f"{archive['bytes_written'] / 1024**2:.2f} MiB written"
+          + (f", peak RSS {archive['peak_rss'] / 1024**2:.0f} MiB" if archive['peak_rss'] else ""))
+    print(f"read: {read['seconds']:.2f}s, {read['messages_per_second']:.0f} messages/s")
+    print(f"summary: {results['summary']['seconds']:.2f}s")
@@ -5,7 +5,15 @@ from pathlib import Path
 import click
 
 from discard import Discard
+from discard.discard import LIVE_ROTATE_INTERVAL
 from discard import reader
+from discard import search as search_
+from discard import compact as compact_
+from discard import media as media_
+from discard.benchmark import benchmark
+from discard.compression import get_codec
+from discard.jobs import JobQueue, JOBS_FILENAME, LEASE_TIME
+from discard.media import MEDIA_DIRECTORY, DOWNLOAD_CONCURRENCY
 
 def require_token(ctx):
     if ctx.obj['token'] is None:
@@ -21,6 +29,21 @@ def require_token(ctx):
 @click.option('--before', help="Datetime before which to retrieve history (UTC)", type=click.DateTime())
 @click.option('--no-scrub', default=False, is_flag=True, help='Do not scrub token from logged data.')
 @click.option('--gzip', default=False, is_flag=True, help='Save logs compressed with gzip.')
+@click.option('--codec', help='Save logs compressed with a codec: gzip, bz2, lzma or zstd, optionally followed by a level, as in gzip:6.')
+@click.option('--incremental', default=False, is_flag=True, help='Continue every channel after the newest message archived by previous incremental runs.')
+@click.option('--resume', help='Continue an interrupted run in the given run directory.',
+                type=click.Path(exists=True, file_okay=False, writable=True))
+@click.option('--seekable', default=False, is_flag=True, help='Write channel logs in blocks with an index, so that reading a time range can skip to it.')
+@click.option('--raw-responses', default=False, is_flag=True, help='Log response bodies exactly as received.')
+@click.option('--http-only', default=False, is_flag=True, help='Archive over HTTP only, without connecting to the gateway.')
+@click.option('--raw-history', default=False, is_flag=True, help='Page message history without building discord.py objects for every message.')
+@click.option('--concurrency', default=1, type=click.IntRange(min=1), help='Number of channels to archive at once, across all guilds, 1 by default.')
+@click.option('--guild-concurrency', default=1, type=click.IntRange(min=1), help='Number of guilds to archive at once, 1 by default.')
+@click.option('--partitions', default=1, type=click.IntRange(min=1), help='Number of time ranges to split every channel into and archive at once, 1 by default.')
+@click.option('--write-buffer-size', default=64*1024, type=click.IntRange(min=0), help='Size of the log write buffer for each file, 64 KiB by default.')
+@click.option('--flush-interval', default=1.0, type=click.FloatRange(min=0.01), help='Seconds between flushing logs to disk, 1 by default.')
+@click.option('--metrics-file', help='Keep the metrics of the run in this file in the Prometheus text format, refreshed during the run.',
+                type=click.Path(dir_okay=False, writable=True))
 @click.pass_context
 def cli(ctx, **kwargs):
     ctx.ensure_object(dict)
@@ -29,6 +52,12 @@ def cli(ctx, **kwargs):
     ctx.obj['output_dir'] = Path(ctx.obj['output_dir'])
     ctx.obj['command'] = sys.argv
 
+    if ctx.obj['codec']:
+        try:
+            get_codec(ctx.obj['codec'])
+        except ValueError as ex:
+            raise click.BadParameter(str(ex), param_hint='--codec')
+
 @cli.command(help="Only log in and fetch profile information.")
 @click.pass_context
 def profile(ctx):
@@ -52,18 +81,141 @@ def guild(ctx, guild_id):
     discard = Discard(mode="guild", guild_id=guild_id, **ctx.obj)
     discard.run()
 
-@cli.command(help="Read a channel log.")
+@cli.group(help="Queue guilds or channels for workers to archive.")
+@click.option('--queue', help='Job queue database, jobs.sqlite in the output directory by default.', type=click.Path(dir_okay=False))
+@click.pass_context
+def enqueue(ctx, queue):
+    ctx.obj['queue'] = Path(queue) if queue else ctx.obj['output_dir'] / JOBS_FILENAME
+
+def enqueue_jobs(ctx, type, ids):
+    ctx.obj['queue'].parent.mkdir(parents=True, exist_ok=True)
+    jobs = JobQueue(ctx.obj['queue'])
+    num_queued = sum(jobs.enqueue(type, id) for id in ids)
+    jobs.close()
+    print(f"Queued {num_queued} of {len(ids)} {type}s, the others were already queued")
+
+@enqueue.command(name='guild', help="Queue one or multiple guilds.  Workers queue their channels when they take them.")
+@click.argument('guild_id', required=True, nargs=-1, type=int)
+@click.pass_context
+def enqueue_guild(ctx, guild_id):
+    enqueue_jobs(ctx, 'guild', guild_id)
+
+@enqueue.command(name='channel', help="Queue one or multiple channels.")
+@click.argument('channel_id', required=True, nargs=-1, type=int)
+@click.pass_context
+def enqueue_channel(ctx, channel_id):
+    enqueue_jobs(ctx, 'channel', channel_id)
+
+@cli.command(help="Archive guilds and channels from the job queue until it is empty, along with any other workers.")
+@click.option('--queue', help='Job queue database, jobs.sqlite in the output directory by default.', type=click.Path(dir_okay=False))
+@click.option('--lease-time', default=LEASE_TIME, type=click.IntRange(min=10), help=f'Seconds after which the jobs of a worker which stopped responding are taken over, {LEASE_TIME} by default.')
+@click.pass_context
+def worker(ctx, queue, lease_time):
+    require_token(ctx)
+    if ctx.obj['incremental'] or ctx.obj['resume']:
+        # The state file and run directories are per process, and can't be shared between workers
+        raise click.UsageError("--incremental and --resume can't be used with workers")
+    discard = Discard(mode="worker", queue=queue, lease_time=lease_time, **ctx.obj)
+    discard.run()
+
+@cli.command(help="Follow one or multiple guilds, logging new, edited and deleted messages and reactions as they happen, until stopped.")
+@click.argument('guild_id', required=True, nargs=-1, type=int)
+@click.option('--rotate-interval', default=LIVE_ROTATE_INTERVAL, type=click.IntRange(min=1), help=f'Seconds covered by each log file of a channel, {LIVE_ROTATE_INTERVAL} by default.')
+@click.option('--duration', type=click.FloatRange(min=0), help='Stop following after this many seconds, never by default.')
+@click.pass_context
+def live(ctx, guild_id, rotate_interval, duration):
+    require_token(ctx)
+    if ctx.obj['incremental'] or ctx.obj['resume'] or ctx.obj['http_only']:
+        # Events only come over the gateway, and there's no history range to continue
+        raise click.UsageError("--incremental, --resume and --http-only can't be used with live")
+    discard = Discard(mode="live", guild_id=guild_id, rotate_interval=rotate_interval, duration=duration, **ctx.obj)
+    discard.run()
+
+@cli.command(help="Read one or multiple channel logs, or all channels of runs.")
+@click.argument('path', required=True, nargs=-1, type=click.Path())
+@click.option('--objects', default=False, is_flag=True, help='Construct discord.py objects for all messages (slower).')
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1), help='Number of processes to read with, 1 by default.')
+@click.pass_context
+def read(ctx, path, objects, jobs):
+    after = reader.time_snowflake(ctx.obj['after'], high=True) if ctx.obj['after'] else None
+    before = reader.time_snowflake(ctx.obj['before']) if ctx.obj['before'] else None
+    channel_paths = []
+    for path_ in path:
+        try:
+            channel_paths += reader.channel_paths(path_)
+        except ValueError:
+            raise click.BadParameter(f"{path_} is neither a channel log nor a directory of runs", param_hint='PATH')
+    reader.read_chats(channel_paths, objects=objects, jobs=jobs, after=after, before=before)
+
+@cli.command(help="Build the index of channel logs written without --seekable, under a directory of runs.")
+@click.argument('path', required=True, type=click.Path(file_okay=False))
+@click.option('--force', default=False, is_flag=True, help='Index logs again even if they have an index.')
+@click.pass_context
+def reindex(ctx, path, force):
+    reader.reindex(path, force=force)
+
+@cli.command(help="Build or update the search index of a directory of runs.")
+@click.argument('path', required=True, type=click.Path(file_okay=False))
+@click.option('--database', help='Index database, index.sqlite in the directory by default.', type=click.Path(dir_okay=False))
+@click.pass_context
+def index(ctx, path, database):
+    search_.index(path, database=database)
+
+@cli.command(help="Search the messages in the index of a directory of runs.")
 @click.argument('path', required=True, type=click.Path(file_okay=False))
+@click.argument('query', required=True)
+@click.option('--database', help='Index database, index.sqlite in the directory by default.', type=click.Path(dir_okay=False))
+@click.option('--channel', help='Only search the channel with this ID or name.')
+@click.option('--author', help='Only search messages by the author with this ID or name#discriminator.')
+@click.option('--limit', default=20, type=click.IntRange(min=1), help='Maximum number of results, 20 by default.')
 @click.pass_context
-def read(ctx, path):
-    reader.read_chat(path)
+def search(ctx, path, query, database, channel, author, limit):
+    after = reader.time_snowflake(ctx.obj['after'], high=True) if ctx.obj['after'] else None
+    before = reader.time_snowflake(ctx.obj['before']) if ctx.obj['before'] else None
+    try:
+        search_.search(path, query, database=database, channel=channel, author=author,
+            after=after, before=before, limit=limit)
+    except FileNotFoundError as ex:
+        raise click.ClickException(str(ex))
 
 @cli.command(help="Output a summary and audit for a directory of runs.")
 @click.argument('path', required=True, type=click.Path(file_okay=False))
 @click.option('--json', default=False, is_flag=True, help='Output machine readable summary.')
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1), help='Number of processes to read runs with, 1 by default.')
+@click.option('--cache', default=False, is_flag=True, help='Keep what was read from every run in a cache file in the directory, and only read new or changed runs.')
+@click.option('--rebuild-cache', default=False, is_flag=True, help='Read all runs again and replace the cache.')
 @click.pass_context
-def summary(ctx, path, json):
-    reader.summary(path, as_json=json)
+def summary(ctx, path, json, jobs, cache, rebuild_cache):
+    reader.summary(path, as_json=json, jobs=jobs, cache=cache, rebuild_cache=rebuild_cache)
+
+@cli.command(help="Merge the channels of all runs in a directory into one log of messages per channel.")
+@click.argument('path', required=True, type=click.Path(file_okay=False))
+@click.option('--output', help='Directory for the compacted logs, compacted/ in the directory by default.',
+                type=click.Path(file_okay=False, writable=True))
+@click.pass_context
+def compact(ctx, path, output):
+    codec = get_codec(ctx.obj['codec']) if ctx.obj['codec'] else None
+    compact_.compact(path, output_dir=output, codec=codec)
+
+@cli.command(help="Download the attachments, embedded media, avatars and emoji linked in the logs of a run or a directory of runs.")
+@click.argument('path', required=True, type=click.Path(file_okay=False))
+@click.option('--store', help='Directory to store the files in by their content, media/ in the output directory by default.',
+                type=click.Path(file_okay=False, writable=True))
+@click.option('--concurrency', default=DOWNLOAD_CONCURRENCY, type=click.IntRange(min=1), help=f'Number of files to download at once, {DOWNLOAD_CONCURRENCY} by default.')
+@click.pass_context
+def media(ctx, path, store, concurrency):
+    media_.media(path, Path(store) if store else ctx.obj['output_dir'] / MEDIA_DIRECTORY, concurrency=concurrency)
+
+@cli.command(help="Output the channel runs needed to close the gaps in a directory of runs.")
+@click.argument('path', required=True, type=click.Path(file_okay=False))
+@click.option('--json', default=False, is_flag=True, help='Output machine readable runs.')
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1), help='Number of processes to read runs with, 1 by default.')
+@click.option('--cache', default=False, is_flag=True, help='Use the cache of the summary command.')
+@click.pass_context
+def plan(ctx, path, json, jobs, cache):
+    reader.plan(path, as_json=json, jobs=jobs, cache=cache)
+
+cli.add_command(benchmark)
 
 if __name__ == '__main__':
     cli()
\ No newline at end of file
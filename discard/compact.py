@@ -0,0 +1,129 @@
+import os
+import json
+import heapq
+import itertools
+from collections import defaultdict
+from pathlib import Path
+
+from discard import reader
+from discard.writer import BlockFile, INDEX_SUFFIX, write_index
+from discard.compression import get_codec
+
+COMPACTED_DIRECTORY = 'compacted'
+
+def find_channel_runs(path):
+    """Find the logs of every channel in all runs under the path, as
+    {(guild_id, channel_id): [(run, channel_path)]} with the runs of every
+    channel in the order they were started."""
+    runs = []
+    for run_path in reader.find_runs(path):
+        with open(run_path / 'run.meta.json') as f:
+            meta = json.load(f)
+        if meta['settings']['mode'] in reader.ARCHIVE_MODES:
+            runs.append((reader.parse_utc(meta['run']['datetime_start']), run_path))
+
+    channels = defaultdict(list)
+    for datetime_start, run_path in sorted(runs):
+        for channel_path in reader.find_channels(run_path):
+            guild_id = int(Path(channel_path).parent.name)
+            channel_id = int(Path(channel_path).name)
+            channels[guild_id, channel_id].append((os.path.relpath(run_path, path), channel_path))
+    return channels
+
+def run_messages(run_index, channel_path, meta):
+    """The messages of a channel in one run as (ID, run index, data), checking
+    that they are in order, as the merge depends on it."""
+    last_id = 0
+    for message_data in reader.read_message_data(channel_path, meta):
+        message_id = int(message_data['id'])
+        if message_id <= last_id:
+            raise ValueError(f"Messages out of order in {channel_path}")
+        last_id = message_id
+        yield message_id, run_index, message_data
+
+def message_record(runs, versions):
+    """Make the record of a message from its versions in the runs it was found
+    in, oldest run first.  The newest version is kept, along with earlier ones
+    whose content differs from the next version kept."""
+    newest_data = versions[-1][1]
+    earlier_versions = []
+    next_content = newest_data['content']
+    for run_index, message_data in reversed(versions[:-1]):
+        if message_data['content'] != next_content:
+            earlier_versions.insert(0, {'run': runs[run_index], 'data': message_data})
+            next_content = message_data['content']
+
+    record = {
+        'type': 'message',
+        'data': newest_data,
+        'runs': [runs[run_index] for run_index, message_data in versions]
+    }
+    if earlier_versions:
+        record['versions'] = earlier_versions
+    return record
+
+def compact_channel(channel_runs, output_path, codec):
+    """Merge the logs of a channel from all runs into one log of messages,
+    ordered by ID.  Only one message per run is held in memory at a time.
+    Returns the summary of the compacted log."""
+    runs = [run for run, channel_path in channel_runs]
+    streams = []
+    for run_index, (run, channel_path) in enumerate(channel_runs):
+        with open(channel_path + '.meta.json') as f:
+            meta = json.load(f)
+        streams.append(run_messages(run_index, channel_path, meta))
+
+    summary = {
+        'num_messages': 0,
+        'num_versions': 0,
+        'oldest_message': None,
+        'newest_message': None
+    }
+
+    # Write to a temporary file first, so that an interrupted compaction leaves no partial log
+    log_path = str(output_path) + '.jsonl' + codec.suffix
+    log_file = BlockFile(log_path + '.tmp', codec=codec, index_path=None)
+    try:
+        for message_id, versions in itertools.groupby(heapq.merge(*streams), key=lambda message: message[0]):
+            record = message_record(runs, [(run_index, message_data) for _, run_index, message_data in versions])
+            log_file.write(json.dumps(record, ensure_ascii=False) + '\n', (message_id, message_id))
+
+            summary['num_messages'] += 1
+            summary['num_versions'] += len(record.get('versions', []))
+            summary['oldest_message'] = summary['oldest_message'] or message_id
+            summary['newest_message'] = message_id
+    finally:
+        log_file.close()
+
+    os.replace(log_path + '.tmp', log_path)
+    write_index(log_path + INDEX_SUFFIX, log_file.blocks, codec)
+
+    return summary
+
+def compact(path, output_dir=None, codec=None):
+    """Compact the channels of all runs under the path into one log per
+    channel, in `compacted/` in the directory by default.  Logs are
+    compressed with gzip unless another codec is given."""
+    path = Path(path)
+    codec = codec or get_codec('gzip')
+    output_dir = Path(output_dir) if output_dir else path / COMPACTED_DIRECTORY
+
+    for (guild_id, channel_id), channel_runs in sorted(find_channel_runs(path).items()):
+        os.makedirs(output_dir / str(guild_id), exist_ok=True)
+        output_path = output_dir / str(guild_id) / str(channel_id)
+
+        summary = compact_channel(channel_runs, output_path, codec)
+
+        # The newest run knows the channel best
+        with open(channel_runs[-1][1] + '.meta.json') as f:
+            channel = json.load(f)['channel']
+        with open(str(output_path) + '.meta.json', 'w') as f:
+            json.dump({
+                'channel': channel,
+                'compacted': {
+                    'runs': [run for run, channel_path in channel_runs]
+                },
+                'summary': summary
+            }, f, indent=4, ensure_ascii=False)
+
+        print(f"Compacted {summary['num_messages']} messages from {len(channel_runs)} runs: {channel['name']} (id {channel_id})")
@@ -0,0 +1,164 @@
+import io
+import bz2
+import lzma
+import gzip
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Codec():
+    """A compression format for logs, at a given level or the default one.
+    Concatenated compressed streams of every codec read as one, which
+    seekable logs rely on."""
+    name = None
+    suffix = None
+    magic = None
+    levels = None
+    default_level = None
+
+    def __init__(self, level=None):
+        if level is not None and level not in self.levels:
+            raise ValueError(f"Level of {self.name} must be between {self.levels[0]} and {self.levels[-1]}")
+        self.level = self.default_level if level is None else level
+
+    def __str__(self):
+        return f"{self.name}:{self.level}"
+
+    def open(self, path):
+        """Open a file to write text to."""
+        raise NotImplementedError()
+
+    def open_read(self, path):
+        """Open a file to read bytes from."""
+        raise NotImplementedError()
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    suffix = '.gz'
+    magic = b'\x1f\x8b'
+    levels = range(0, 10)
+    default_level = 9
+
+    def open(self, path):
+        return gzip.open(path, 'wt', compresslevel=self.level, encoding='utf-8')
+
+    def open_read(self, path):
+        return gzip.open(path)
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class Bz2Codec(Codec):
+    name = 'bz2'
+    suffix = '.bz2'
+    magic = b'BZh'
+    levels = range(1, 10)
+    default_level = 9
+
+    def open(self, path):
+        return bz2.open(path, 'wt', compresslevel=self.level, encoding='utf-8')
+
+    def open_read(self, path):
+        return bz2.open(path)
+
+    def compress(self, data):
+        return bz2.compress(data, compresslevel=self.level)
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+    suffix = '.xz'
+    magic = b'\xfd7zXZ\x00'
+    levels = range(0, 10)
+    default_level = 6
+
+    def open(self, path):
+        return lzma.open(path, 'wt', preset=self.level, encoding='utf-8')
+
+    def open_read(self, path):
+        return lzma.open(path)
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    suffix = '.zst'
+    magic = b'\x28\xb5\x2f\xfd'
+    levels = range(1, 23)
+    default_level = 3
+
+    def __init__(self, level=None):
+        if zstandard is None:
+            raise ValueError("zstd requires the zstandard package")
+        super().__init__(level)
+
+    def open(self, path):
+        compressor = zstandard.ZstdCompressor(level=self.level)
+        return io.TextIOWrapper(compressor.stream_writer(open(path, 'wb')), encoding='utf-8')
+
+    def open_read(self, path):
+        decompressor = zstandard.ZstdDecompressor()
+        return io.BufferedReader(decompressor.stream_reader(open(path, 'rb'), read_across_frames=True))
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        # Blocks are single frames, which record their size
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = {codec.name: codec for codec in [GzipCodec, Bz2Codec, LzmaCodec, ZstdCodec]}
+
+SUFFIXES = [codec.suffix for codec in CODECS.values()]
+
+# Raised when reading a compressed stream which was cut off
+TRUNCATED_ERRORS = (EOFError, zlib.error, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard else ())
+
+def get_codec(spec):
+    """The codec for a name optionally followed by a level, such as gzip:6."""
+    name, _, level = spec.partition(':')
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name}, available codecs are {', '.join(CODECS)}")
+    try:
+        level = int(level) if level else None
+    except ValueError:
+        raise ValueError(f"Invalid level {level}")
+    return CODECS[name](level)
+
+def available_codecs():
+    return [name for name in CODECS if name != 'zstd' or zstandard is not None]
+
+def detect_codec(path):
+    """The codec a file is compressed with, from its first bytes, or None."""
+    with open(path, 'rb') as f:
+        return detect_data_codec(f.read(8))
+
+def detect_data_codec(data):
+    for codec in CODECS.values():
+        if data.startswith(codec.magic):
+            return codec()
+    return None
@@ -0,0 +1,49 @@
+import bisect
+
+
+class Coverage():
+    """A set of snowflakes, kept as sorted, disjoint half-open intervals
+    [start, end).  Overlapping and adjacent intervals are merged."""
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in intervals:
+            self.add(start, end)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+
+        # Intervals from i to j overlap or touch the new one
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __contains__(self, snowflake):
+        i = bisect.bisect_right(self.starts, snowflake) - 1
+        return i >= 0 and snowflake < self.ends[i]
+
+    def gaps(self, start, end=None):
+        """The intervals between `start` and `end` which are not covered.
+        Without an end, the last gap is open, with an end of None."""
+        gaps = []
+        position = start
+        for i in range(bisect.bisect_right(self.ends, start), len(self.starts)):
+            if end is not None and self.starts[i] >= end:
+                break
+            if self.starts[i] > position:
+                gaps.append((position, self.starts[i]))
+            position = max(position, self.ends[i])
+        if end is None or position < end:
+            gaps.append((position, end))
+        return gaps
@@ -8,28 +8,234 @@ import traceback
 import copy
 import random
 import string
-import gzip
 import asyncio
+import contextvars
+import time
+import re
+import urllib.parse
 from pathlib import Path
+from collections import defaultdict
 from collections.abc import Iterable
 
 import discord
+import aiohttp
 from tqdm import tqdm
 
+from discard.writer import LogWriter, BlockFile, message_range
+from discard.compression import get_codec, SUFFIXES
+from discard.ratelimit import RateLimiter, UnlockedRoute
+from discard.jobs import JobQueue, JOBS_FILENAME, LEASE_TIME
+from discard.metrics import Metrics, peak_rss
+
 __version__ = "0.3.3"
 
 PBAR_UPDATE_INTERVAL = 100
 PBAR_MINIMUM_MESSAGES = 1000 # Minimum number of messages to begin showing a progress bar for
 
+REACTION_WORKERS = 4 # Number of reactions to fetch users for at once, per channel
+REACTION_QUEUE_SIZE = 1000 # Maximum number of reactions waiting to be fetched before pagination is held up
+
+HTTP_RETRIES = 5 # Number of times to retry a request after a transient error
+HTTP_RETRY_DELAY = 1 # Seconds to wait before the first retry, doubled after each one
+
+JOB_POLL_INTERVAL = 5 # Seconds a worker waits for jobs leased by other workers to finish or expire
+
+METRICS_INTERVAL = 15 # Seconds between refreshing the Prometheus metrics file during a run
+
 # There's a few websocket events that we need to log (like GUILD_CREATE),
 # but also a few we didn't ask for we want to do without (pings, typing notifications, new messages),
-# at least until a realtime mode is introduced.  For this purpose we use a blacklist.
+# outside of live mode.  For this purpose we use a blacklist.
 WS_EVENT_BLACKLIST = [None, 'TYPING_START', 'MESSAGE_CREATE', 'MESSAGE_UPDATE', 'MESSAGE_REACTION_ADD']
 
+# The events live mode logs into the files of their channels
+LIVE_EVENTS = ['MESSAGE_CREATE', 'MESSAGE_UPDATE', 'MESSAGE_DELETE', 'MESSAGE_DELETE_BULK',
+               'MESSAGE_REACTION_ADD', 'MESSAGE_REACTION_REMOVE', 'MESSAGE_REACTION_REMOVE_ALL',
+               'MESSAGE_REACTION_REMOVE_EMOJI']
+
+LIVE_ROTATE_INTERVAL = 3600 # Seconds covered by each live file of a channel
+LIVE_BACKFILL_MARGIN = 60 # Seconds before a disconnect from which history is fetched again after it
+
+# The request file which requests made by the current task are logged into.
+# Every channel is archived in its own task when running concurrently, so this
+# can't be a single attribute on Discard.  When unset, the run file is used.
+current_request_file = contextvars.ContextVar('current_request_file', default=None)
+
+# A coroutine function called with every response received, and its parsed
+# data, by requests made by the current task.
+response_hook = contextvars.ContextVar('response_hook', default=None)
+
+# discord.py reads and parses responses in this function; wrap it to see the
+# headers of responses, including rate limited ones, and to be able to log
+# the bodies exactly as they were received.
+json_or_text = discord.http.json_or_text
+
+async def json_or_text_captured(response):
+    data = await json_or_text(response)
+
+    hook = response_hook.get()
+    if hook is not None:
+        await hook(response, data)
+
+    return data
+
+discord.http.json_or_text = json_or_text_captured
+
+# Kept in the output directory in incremental mode, records the newest
+# message archived in every channel.
+STATE_FILENAME = 'state.json'
+
 class NotFoundError(Exception):
     pass
 
 
+def summarize_message(message):
+    if message is None:
+        return None
+
+    return {
+        'id': message.id,
+        'timestamp': message.created_at.isoformat() # TODO these need to be converted to UTC!
+    }
+
+
+def to_snowflake(bound, high=False):
+    """Convert a history bound, which is either a datetime or a snowflake
+    object, to a snowflake.  discord.py treats datetimes as exclusive on the
+    high end of their millisecond for after and the low end for before."""
+    if bound is None:
+        return None
+    elif isinstance(bound, datetime.datetime):
+        return discord.utils.time_snowflake(bound, high=high)
+    else:
+        return bound.id
+
+
+def reaction_emoji(emoji):
+    """The emoji of a reaction as it goes in the reaction users URL, either
+    from a discord.py emoji or from the emoji object of a raw message."""
+    if isinstance(emoji, dict):
+        return f"{emoji['name']}:{emoji['id']}" if emoji.get('id') else emoji['name']
+    elif isinstance(emoji, str):
+        return emoji
+    else:
+        return '{0.name}:{0.id}'.format(emoji)
+
+
+def log_start(path, channel_id):
+    """The message ID a channel log starts after, as requested for its first
+    page of messages, or None if it has none."""
+    # Imported here, as the reader depends on this module
+    from discard.reader import read_log
+
+    for record in read_log(path):
+        if record['type'] == 'http' and record['request']['url'].endswith(f'/channels/{channel_id}/messages'):
+            return int(record['request'].get('params', {}).get('after', 0))
+    return None
+
+def find_checkpoint(path, channel_id, before=None, after=None):
+    """Find the last page of messages in a channel log which was completely
+    archived, including the users of all of its reactions, before the log was
+    interrupted.  Returns None if there is no such page.  Only the messages
+    after `after` are counted, for logs which overlap others."""
+    # Imported here, as the reader depends on this module
+    from discard.reader import read_log
+
+    pages = []
+    reactions = {}
+    num_reaction_requests = 0
+    reaction_time = 0.0
+
+    for record in read_log(path):
+        if record['type'] != 'http':
+            continue
+
+        url = record['request']['url']
+        params = record['request'].get('params', {})
+        data = record['response']['data']
+
+        if url.endswith(f'/channels/{channel_id}/messages'):
+            page = {'ids': [], 'pending_reactions': 0}
+            for message_data in data:
+                # Messages past the end of the range are dropped, and their reactions not fetched
+                if before is not None and int(message_data['id']) >= before:
+                    continue
+
+                page['ids'].append(int(message_data['id']))
+                for reaction in message_data.get('reactions', []):
+                    emoji = reaction['emoji']
+                    emoji = emoji['name'] if emoji['id'] is None else f"{emoji['name']}:{emoji['id']}"
+                    reactions[message_data['id'], emoji] = [page, reaction['count']]
+                    page['pending_reactions'] += 1
+            pages.append(page)
+
+        elif '/reactions/' in url:
+            num_reaction_requests += 1
+            reaction_time += (datetime.datetime.fromisoformat(record['datetime_end'])
+                                - datetime.datetime.fromisoformat(record['datetime_start'])).total_seconds()
+
+            match = re.search(r'/messages/(\d+)/reactions/([^/]+)$', url)
+            key = (match[1], urllib.parse.unquote(match[2]))
+            if key in reactions:
+                # Same as the pagination in DiscardClient.fetch_reaction_users
+                page, remaining = reactions[key]
+                remaining -= params['limit']
+                if remaining <= 0 or not data:
+                    page['pending_reactions'] -= 1
+                    del reactions[key]
+                else:
+                    reactions[key][1] = remaining
+
+    checkpoint = None
+    num_messages = 0
+    oldest_message = None
+    for page in pages:
+        if page['pending_reactions']:
+            break
+
+        ids = [message_id for message_id in page['ids'] if after is None or message_id > after]
+        if ids:
+            num_messages += len(ids)
+            if oldest_message is None:
+                oldest_message = min(ids)
+            checkpoint = max(ids)
+
+    if checkpoint is None:
+        return None
+
+    return {
+        'num_messages': num_messages,
+        'oldest_message': oldest_message,
+        'newest_message': checkpoint,
+        'num_reaction_requests': num_reaction_requests,
+        'reaction_time': reaction_time
+    }
+
+
+async def gather_or_cancel(coros):
+    """Run the coroutines concurrently and return their results in order.
+    Unlike asyncio.gather, the remaining ones are cancelled if one fails."""
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def wait_for_workers(coro, workers):
+    """Await a queue operation, but raise the exception if a worker taking
+    from the queue fails in the meantime, as the queue would never drain then."""
+    task = asyncio.ensure_future(coro)
+    done, pending = await asyncio.wait([task, *workers], return_when=asyncio.FIRST_COMPLETED)
+    for worker in workers:
+        if worker in done:
+            task.cancel()
+            worker.result()
+
+    return task.result()
+
+
 class DiscardClient(discord.Client):
     def __init__(self, *args, discard=None, **kwargs):
         super().__init__(*args, **kwargs)
@@ -37,19 +243,55 @@ class DiscardClient(discord.Client):
         self.discard = discard
         self.is_user_account = self.discard.is_user_account
         self.exception = None
+        self.metrics_exporter = None
+        self.channel_semaphore = None
+        self.live_tasks = []
+        self.connected = False
 
         # monkeypatch discord.py request function to log
 
         request_func = self.http.request
 
         async def request_func_wrapped(route, *, files=None, **kwargs):
-            datetime_start = datetime.datetime.now(datetime.timezone.utc)
+            response_bodies = []
+
+            async def on_response(response, data):
+                discard.rate_limiter.update(route, response.status, response.headers, data)
+                if discard.raw_responses and not isinstance(data, str):
+                    # The body is cached by aiohttp at this point
+                    body = await response.read()
+                    response_bodies.append(body.decode('utf-8'))
+
+            for attempt in range(HTTP_RETRIES + 1):
+                await discard.rate_limiter.acquire(route)
+                datetime_start = datetime.datetime.now(datetime.timezone.utc)
+                time_start = time.perf_counter()
 
-            response = await request_func(route, files=files, **kwargs) # XXX await?
+                token = response_hook.set(on_response)
+                try:
+                    # The rate limiter takes over locking buckets from discord.py
+                    response = await request_func(UnlockedRoute(route), files=files, **kwargs)
+                    break
+                except (discord.DiscordServerError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                    # Transient errors shouldn't end a run which may have been going for hours
+                    if attempt == HTTP_RETRIES:
+                        raise
+                    delay = HTTP_RETRY_DELAY * 2 ** attempt
+                    print(f"Retrying {route.method} {route.url} in {delay}s after error: {ex}")
+                    discard.num_http_retries += 1
+                finally:
+                    response_hook.reset(token)
+                    discard.rate_limiter.release(route)
+                await asyncio.sleep(delay)
 
             datetime_end = datetime.datetime.now(datetime.timezone.utc)
+            discard.metrics.observe_latency(route, time.perf_counter() - time_start)
 
-            discard.log_http_request(route, kwargs, response, datetime_start, datetime_end)
+            # Rate limited requests are retried, the last response is the one returned
+            raw_response = response_bodies[-1] if response_bodies else None
+            await discard.wait_for_writer_queue()
+            discard.log_http_request(route, kwargs, response, datetime_start, datetime_end,
+                                        raw_response=raw_response)
 
             return response
         
@@ -60,13 +302,70 @@ class DiscardClient(discord.Client):
         loop = self.loop
 
         try:
-            loop.run_until_complete(self.start(*args, **kwargs))
+            if self.discard.http_only:
+                loop.run_until_complete(self.start_http(*args, **kwargs))
+            else:
+                loop.run_until_complete(self.start(*args, **kwargs))
         except KeyboardInterrupt:
             self.exception = sys.exc_info()
         finally:
             loop.close()
 
+    async def start_http(self, token, bot=True):
+        """Log in and archive over HTTP only, without connecting to the
+        gateway.  Guilds and channels are fetched as they are needed instead of
+        being sent by the gateway at login."""
+        try:
+            data = await self.http.static_login(token.strip(), bot=bot)
+            self._connection.user = discord.ClientUser(state=self._connection, data=data)
+            await self.on_ready()
+        finally:
+            await self.close()
+
+    async def find_guild(self, guild_id):
+        """The guild with the ID, or None if it's not accessible."""
+        guild = self.get_guild(guild_id)
+        if guild is not None or not self.discard.http_only:
+            return guild
+
+        try:
+            data = await self.http.get_guild(guild_id)
+            member_data = await self.http.get_member(guild_id, self.user.id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+
+        guild = discord.Guild(data=data, state=self._connection)
+        # Permissions are checked against our own member
+        guild._add_member(discord.Member(data=member_data, guild=guild, state=self._connection))
+        self._connection._add_guild(guild)
+        return guild
+
+    async def find_channel(self, channel_id):
+        """The guild channel with the ID, or None if it's not accessible."""
+        channel = self.get_channel(channel_id)
+        if channel is not None or not self.discard.http_only:
+            return channel
+
+        try:
+            data = await self.http.get_channel(channel_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+
+        guild = await self.find_guild(int(data['guild_id'])) if 'guild_id' in data else None
+        if guild is None:
+            return None
+
+        factory, _ = discord.channel._channel_factory(data['type'])
+        channel = factory(state=self._connection, guild=guild, data=data)
+        guild._add_channel(channel)
+        return channel
+
     async def on_ready(self):
+        self.discard.ready()
+
+        if self.discard.metrics_file and self.metrics_exporter is None:
+            self.metrics_exporter = asyncio.ensure_future(self.export_metrics())
+
         if self.discard.mode == 'profile':
             print(f'We have logged in as {self.user.name} (id {self.user.id})')
 
@@ -80,64 +379,269 @@ class DiscardClient(discord.Client):
                 print(f"Fetched profile: {profile}")
 
         elif self.discard.mode == 'channel':
+            channels = []
             for channel_id in self.discard.channel_ids:
-                channel = self.get_channel(channel_id)
+                channel = await self.find_channel(channel_id)
 
                 if channel is None:
                     raise NotFoundError(f"Channel not found: {channel_id}")
 
-                await self.archive_channel(channel)
+                channels.append(channel)
+
+            await self.archive_channels(channels)
 
         elif self.discard.mode == 'guild':
+            guilds = []
             for guild_id in self.discard.guild_ids:
-                guild = self.get_guild(guild_id)
+                guild = await self.find_guild(guild_id)
 
                 if guild is None:
                     raise NotFoundError(f"Guild not found: {guild_id}")
 
-                await self.archive_guild(guild)
+                guilds.append(guild)
+
+            await self.archive_guilds(guilds)
+
+        elif self.discard.mode == 'worker':
+            await self.work()
+        elif self.discard.mode == 'live':
+            await self.follow()
+            # Keep following until the run is stopped
+            return
         else:
             raise ValueError(f"Unknown mode: {self.discard.mode}")
 
         # Quit
         await self.close()
     
+    async def export_metrics(self):
+        while True:
+            self.discard.write_metrics_file()
+            await asyncio.sleep(METRICS_INTERVAL)
+
+    async def close(self):
+        if self.metrics_exporter:
+            self.metrics_exporter.cancel()
+        for task in self.live_tasks:
+            # One of them may be stopping the run
+            if task is not asyncio.current_task():
+                task.cancel()
+        await super().close()
+
+    async def follow(self):
+        """Start following the guilds in live mode, or after a reconnect which
+        couldn't resume the session, fetch the history missed in the meantime.
+        The events themselves are logged as they are received."""
+        if not self.live_tasks:
+            for guild_id in self.discard.guild_ids:
+                if self.get_guild(guild_id) is None:
+                    raise NotFoundError(f"Guild not found: {guild_id}")
+
+            print(f"Following {len(self.discard.guild_ids)} guilds...")
+            self.live_tasks.append(asyncio.ensure_future(self.rotate_live_files()))
+            if self.discard.duration is not None:
+                self.live_tasks.append(asyncio.ensure_future(self.stop_after(self.discard.duration)))
+
+        # The ready event of a session which was lost before its guilds came
+        # in may still fire, only a new session can tell what was missed.
+        if self.discard.disconnected_at is not None and self.connected:
+            await self.backfill()
+
+    async def on_connect(self):
+        self.connected = True
+
+    async def on_disconnect(self):
+        self.connected = False
+        # Only the first disconnect counts until the history is fetched again
+        if self.discard.mode == 'live' and self.discard.disconnected_at is None:
+            self.discard.disconnected_at = datetime.datetime.now(datetime.timezone.utc)
+
+    async def on_resumed(self):
+        self.connected = True
+        # Discord replays the events missed by a resumed session
+        self.discard.disconnected_at = None
+
+    async def backfill(self):
+        """Fetch the history of all followed channels since shortly before the
+        disconnect, into their live files.  Messages from the margin may be
+        logged twice."""
+        since = self.discard.disconnected_at - datetime.timedelta(seconds=LIVE_BACKFILL_MARGIN)
+        self.discard.disconnected_at = None
+        print(f"Reconnected, fetching history since {since.isoformat()}")
+
+        channels = []
+        for guild_id in self.discard.guild_ids:
+            guild = self.get_guild(guild_id)
+            if guild is not None:
+                channels += [channel for channel in guild.text_channels
+                                if channel.permissions_for(guild.me).read_messages]
+
+        semaphore = asyncio.Semaphore(self.discard.concurrency)
+
+        async def backfill_channel(channel):
+            async with semaphore:
+                token = current_request_file.set(self.discard.start_backfill(channel))
+                num_messages = 0
+                try:
+                    # Datetimes are naive in UTC, same as for history
+                    async for message, reactions in self.history(channel, since.replace(tzinfo=None), None):
+                        num_messages += 1
+                except discord.Forbidden:
+                    pass
+                finally:
+                    current_request_file.reset(token)
+                    self.discard.end_backfill(channel, num_messages)
+
+        await gather_or_cancel([backfill_channel(channel) for channel in channels])
+
+    async def rotate_live_files(self):
+        interval = self.discard.rotate_interval
+        while True:
+            await asyncio.sleep(interval - time.time() % interval)
+            self.discard.rotate_live_files()
+
+    async def stop_after(self, duration):
+        await asyncio.sleep(duration)
+        print(f"Stopping after {duration}s")
+        await self.close()
+
     async def archive_channel(self, channel: discord.abc.GuildChannel):
+        if self.discard.skip_channel(channel):
+            print(f"Skipping channel, already archived: {channel}")
+            return
+
         print(f"Processing channel: {channel}")
         self.discard.start_channel(channel)
 
         # XXX is it a good idea for userbots to do this?
         #await self.fetch_channel(channel.id)
 
+        ranges = self.partition_channel(channel)
+        resumed_segment = self.discard.resumed_segments.get(channel.id)
+
+        if len(ranges) == 1 and not resumed_segment:
+            after, before = ranges[0]
+            num_messages, oldest_message, newest_message, reaction_stats = await self.archive_range(channel,
+                                                                                                    after, before)
+            await self.wait_for_writer()
+            self.discard.end_channel(channel, num_messages, oldest_message, newest_message,
+                                        reaction_stats=reaction_stats)
+            return
+
+        async def archive_segment(index, after, before):
+            self.discard.start_segment(channel, index)
+            result = await self.archive_range(channel, after, before, segment=index)
+            self.discard.end_segment(channel, index)
+            return result
+
+        results = await gather_or_cancel([archive_segment(index, after, before)
+                                            for index, (after, before) in enumerate(ranges)])
+
+        segments = []
+        for index, ((after, before), result) in enumerate(zip(ranges, results)):
+            segments.append(self.discard.segment_summary(channel, index, after, before, *result))
+
+        if resumed_segment:
+            # The parts of the channel archived before the run was interrupted, in order of their range
+            resumed = sorted(zip(segments + resumed_segment['segments'], results + resumed_segment['results']),
+                                key=lambda item: item[0]['after'] or 0)
+            segments = [segment for segment, result in resumed]
+            results = [result for segment, result in resumed]
+
+        num_messages = sum(num_messages for num_messages, _, _, _ in results)
+        oldest_message = next((oldest for _, oldest, _, _ in results if oldest), None)
+        newest_message = next((newest for _, _, newest, _ in reversed(results) if newest), None)
+        reaction_stats = {key: sum(stats[key] for _, _, _, stats in results) for key in results[0][3]}
+
+        await self.wait_for_writer()
+        self.discard.end_channel(channel, num_messages, oldest_message, newest_message,
+                                    reaction_stats=reaction_stats, segments=segments)
+
+    async def wait_for_writer(self):
+        # The bytes logged are counted by the writer thread, once it gets to them
+        await asyncio.get_event_loop().run_in_executor(None, self.discard.writer.sync)
+
+    def partition_channel(self, channel):
+        """Split the time range to be archived in a channel into consecutive
+        (after, before) snowflake ranges, one for each partition."""
+        after, before = self.discard.channel_range(channel)
+        gaps = []
+        if channel.id in self.discard.resumed_segments:
+            # The gaps left by the interrupted run, then the rest of the range split up
+            gaps = self.discard.resumed_segments[channel.id]['gaps']
+            after = discord.Object(id=self.discard.resumed_segments[channel.id]['checkpoint'])
+
+        if self.discard.partitions <= 1:
+            return gaps + [(after, before)]
+
+        first_id = to_snowflake(after, high=True) if after else channel.id
+        last_id = to_snowflake(before or datetime.datetime.utcnow())
+
+        first_ms, last_ms = first_id >> 22, last_id >> 22
+        if last_ms <= first_ms:
+            return gaps + [(after, before)]
+
+        # Each boundary is the lowest snowflake of its millisecond, so that
+        # range i covers messages with boundary[i] <= id < boundary[i+1].
+        boundaries = [(first_ms + (last_ms - first_ms) * i // self.discard.partitions) << 22
+                        for i in range(1, self.discard.partitions)]
+        boundaries = sorted(set(boundary for boundary in boundaries if boundary > first_id))
+
+        afters = [after] + [discord.Object(id=boundary - 1) for boundary in boundaries]
+        befores = [discord.Object(id=boundary) for boundary in boundaries] + [before]
+
+        return gaps + list(zip(afters, befores))
+
+    async def archive_range(self, channel, after, before, segment=None):
         num_messages = 0
         oldest_message = None
-        newest_message = None
         message = None
 
+        if isinstance(before, discord.Object):
+            before_datetime = before.created_at
+        else:
+            before_datetime = before or datetime.datetime.now()
+
         pbar = None
+        # With multiple progress bars on screen, they need to be told apart
+        pbar_desc = None
+        if segment is not None:
+            pbar_desc = f"{channel} [{segment}]"
+        elif self.discard.concurrency > 1:
+            pbar_desc = str(channel)
         
-        # before and after datetimes must be timezone-naive in UTC (why not timezone-aware UTC?)
-        async for message in channel.history(after=self.discard.after, before=self.discard.before, limit=None,
-                                                oldest_first=True):
-            if oldest_message is None:
-                oldest_message = message
-                expected_timedelta = (self.discard.before or datetime.datetime.now()) - oldest_message.created_at
+        # Users who reacted are fetched in the background, so that history
+        # pagination doesn't have to wait for them
+        reaction_stats = {
+            'num_reaction_requests': 0,
+            'reaction_time': 0.0
+        }
+        reaction_queue = asyncio.Queue(maxsize=REACTION_QUEUE_SIZE)
+        reaction_workers = [asyncio.ensure_future(self.reaction_worker(channel, reaction_queue, reaction_stats))
+                                for i in range(REACTION_WORKERS)]
+        try:
+            async for message, reactions in self.history(channel, after, before):
+                if oldest_message is None:
+                    oldest_message = message
+                    expected_timedelta = before_datetime - oldest_message.created_at
 
-            for reaction in message.reactions:
-                # Fetch the users who reacted
-                async for user in reaction.users():
-                    pass
-            
-            if num_messages % PBAR_UPDATE_INTERVAL == 0 and num_messages > PBAR_MINIMUM_MESSAGES:
-                timedelta = message.created_at - oldest_message.created_at
-                if pbar is None:
-                    pbar = tqdm(total=expected_timedelta.days, initial=timedelta.days, unit="day", miniters=1)
-                else:
-                    diff = timedelta.days - pbar.n
-                    if diff:
-                        pbar.update(diff)
-            
-            num_messages += 1
+                for emoji, count in reactions:
+                    reaction = (message.id, emoji, count)
+                    if reaction_queue.full():
+                        await wait_for_workers(reaction_queue.put(reaction), reaction_workers)
+                    else:
+                        reaction_queue.put_nowait(reaction)
+
+                pbar = self.update_pbar(pbar, pbar_desc, num_messages, message, oldest_message,
+                                        expected_timedelta)
+
+                num_messages += 1
+
+            await wait_for_workers(reaction_queue.join(), reaction_workers)
+        finally:
+            for worker in reaction_workers:
+                worker.cancel()
+            await asyncio.gather(*reaction_workers, return_exceptions=True)
            
         if pbar:
             pbar.update(expected_timedelta.days - pbar.n) 
@@ -145,15 +649,105 @@ class DiscardClient(discord.Client):
 
         newest_message = message
 
-        self.discard.end_channel(channel, num_messages, oldest_message, newest_message)
-    
+        return num_messages, oldest_message, newest_message, reaction_stats
+
+    def update_pbar(self, pbar, pbar_desc, num_messages, message, oldest_message, expected_timedelta):
+        if num_messages % PBAR_UPDATE_INTERVAL == 0 and num_messages > PBAR_MINIMUM_MESSAGES:
+            timedelta = message.created_at - oldest_message.created_at
+            if pbar is None:
+                pbar = tqdm(total=expected_timedelta.days, initial=timedelta.days, unit="day", miniters=1,
+                                desc=pbar_desc)
+            else:
+                diff = timedelta.days - pbar.n
+                if diff:
+                    pbar.update(diff)
+
+        return pbar
+
+    async def history(self, channel, after, before):
+        """Yield the messages in a range of a channel's history, oldest first,
+        along with the (emoji, count) of their reactions.
+
+        With raw history, the pages are read straight from the responses
+        instead of building a discord.Message for every message, as only the
+        ID and reactions are needed and the pages are logged anyway.  The
+        messages are then discord.Objects."""
+        if not self.discard.raw_history:
+            # before and after datetimes must be timezone-naive in UTC (why not timezone-aware UTC?)
+            async for message in channel.history(after=after, before=before, limit=None, oldest_first=True):
+                yield message, [(reaction_emoji(reaction.emoji), reaction.count) for reaction in message.reactions]
+            return
+
+        # The same requests as discord.py's history makes, except that paging
+        # stops once the end of the range is reached
+        after = to_snowflake(after, high=True) or 0
+        before = to_snowflake(before)
+        while True:
+            data = await self.http.logs_from(channel.id, 100, after=after)
+            # Pages come newest first
+            for message_data in reversed(data):
+                message_id = int(message_data['id'])
+                if before is not None and message_id >= before:
+                    return
+                yield discord.Object(id=message_id), [(reaction_emoji(reaction['emoji']), reaction['count'])
+                                                        for reaction in message_data.get('reactions', ())]
+
+            if len(data) < 100:
+                return
+            after = int(data[0]['id'])
+
+    async def reaction_worker(self, channel, queue, stats):
+        while True:
+            message_id, emoji, count = await queue.get()
+            try:
+                await self.fetch_reaction_users(channel, message_id, emoji, count, stats)
+            finally:
+                queue.task_done()
+
+    async def fetch_reaction_users(self, channel, message_id, emoji, count, stats):
+        # This follows the pagination of discord.Reaction.users(), but
+        # calls the HTTP API directly so that the requests can be counted.
+        limit = count
+        after = None
+        while limit > 0:
+            retrieve = min(limit, 100)
+
+            time_start = time.perf_counter()
+            data = await self.http.get_reaction_users(channel.id, message_id, emoji, retrieve, after=after)
+            stats['num_reaction_requests'] += 1
+            stats['reaction_time'] += time.perf_counter() - time_start
+
+            if not data:
+                break
+
+            limit -= retrieve
+            after = int(data[-1]['id'])
+
     async def archive_guild(self, guild: discord.Guild):
+        if self.discard.skip_guild(guild):
+            print(f"Skipping guild, already archived: {guild}")
+            return
+
         print(f"Processing guild: {guild}")
         self.discard.start_guild(guild)
 
+        channels = await self.fetch_guild_channels(guild)
+        print(f"{len(channels)} accessible channels...")
+
+        await self.archive_channels(channels)
+        
+        self.discard.end_guild(guild, len(channels))
+
+    async def fetch_guild_channels(self, guild):
+        """Fetch the guild along with its channels, roles and emojis, and
+        return the text channels which can be read."""
         # XXX is it a good idea for userbots to do this?
         await self.fetch_guild(guild.id)
-        await guild.fetch_channels()
+        fetched_channels = await guild.fetch_channels()
+        if self.discard.http_only:
+            # Without the gateway, the channels of the guild are only known from this request
+            for channel in fetched_channels:
+                guild._add_channel(channel)
 
         await guild.fetch_roles()
         await guild.fetch_emojis()
@@ -162,19 +756,115 @@ class DiscardClient(discord.Client):
         for channel in guild.text_channels:
             if channel.permissions_for(guild.me).read_messages:
                 channels.append(channel)
-        
-        print(f"{len(channels)} accessible channels...")
 
+        return channels
+    
+    async def archive_guilds(self, guilds):
+        if self.discard.guild_concurrency <= 1:
+            for guild in guilds:
+                await self.archive_guild(guild)
+            return
+
+        # Every guild has its own files, and the channels of all of them
+        # share the concurrency of the run.
+        semaphore = asyncio.Semaphore(self.discard.guild_concurrency)
+
+        async def archive_guild_bounded(guild):
+            async with semaphore:
+                await self.archive_guild(guild)
+
+        await gather_or_cancel([archive_guild_bounded(guild) for guild in guilds])
+
+    async def archive_channels(self, channels):
+        if self.discard.concurrency <= 1 and self.discard.guild_concurrency <= 1:
+            for channel in channels:
+                await self.archive_channel(channel)
+            return
+
+        # Discord rate limits the messages route per channel, so multiple
+        # channels can be fetched at the same time.  The limit is shared
+        # by all guilds being archived at once.
+        if self.channel_semaphore is None:
+            self.channel_semaphore = asyncio.Semaphore(self.discard.concurrency)
+
+        async def archive_channel_bounded(channel):
+            async with self.channel_semaphore:
+                await self.archive_channel(channel)
+
+        await gather_or_cancel([archive_channel_bounded(channel) for channel in channels])
+
+    async def work(self):
+        """Archive jobs leased from the job queue until no jobs are left,
+        as many at once as the concurrency allows."""
+        async def work_loop():
+            while True:
+                job = self.discard.lease_job()
+                if job is None:
+                    if not self.discard.jobs.num_pending():
+                        return
+                    # Jobs leased by other workers may still add channels, or expire
+                    await asyncio.sleep(JOB_POLL_INTERVAL)
+                    continue
+
+                # In a task of its own, so that the request file of a failed job isn't used for the next one
+                await asyncio.ensure_future(self.run_job(job))
+
+        renewer = asyncio.ensure_future(self.renew_leases())
+        try:
+            await gather_or_cancel([work_loop() for i in range(self.discard.concurrency)])
+        finally:
+            renewer.cancel()
+            await asyncio.gather(renewer, return_exceptions=True)
+
+    async def renew_leases(self):
+        while True:
+            await asyncio.sleep(self.discard.jobs.lease_time / 3)
+            for job in list(self.discard.leased_jobs.values()):
+                if not self.discard.jobs.renew(job, self.discard.ident):
+                    print(f"Lost the lease of job {job['id']}, another worker may archive it too")
+
+    async def run_job(self, job):
+        try:
+            if job['type'] == 'guild':
+                guild = await self.find_guild(job['target_id'])
+                if guild is None:
+                    raise NotFoundError(f"Guild not found: {job['target_id']}")
+
+                await self.queue_guild(guild)
+            else:
+                channel = await self.find_channel(job['target_id'])
+                if channel is None:
+                    raise NotFoundError(f"Channel not found: {job['target_id']}")
+
+                await self.archive_channel(channel)
+        except (NotFoundError, discord.Forbidden, discord.NotFound) as ex:
+            # Another worker with a different token may still get to it, if queued again
+            print(f"Job {job['id']} failed: {ex}")
+            self.discard.fail_job(job, type(ex).__name__ + f": {ex}")
+        except BaseException:
+            self.discard.release_job(job)
+            raise
+        else:
+            self.discard.complete_job(job)
+
+    async def queue_guild(self, guild):
+        """Archive the guild and queue its channels, for any worker to archive."""
+        print(f"Processing guild: {guild}")
+        self.discard.start_guild(guild)
+
+        channels = await self.fetch_guild_channels(guild)
         for channel in channels:
-            await self.archive_channel(channel)
-        
-        self.discard.end_guild(guild, len(channels))
-            
+            self.discard.jobs.enqueue('channel', channel.id, guild_id=guild.id)
+        print(f"Queued {len(channels)} accessible channels...")
+
+        self.discard.end_guild(guild, len(channels), queued=True)
 
     async def on_socket_raw_send(self, payload):
+        await self.discard.wait_for_writer_queue()
         self.discard.log_ws_send(payload)
 
     async def on_socket_response(self, msg):
+        await self.discard.wait_for_writer_queue()
         self.discard.log_ws_recv(msg)
     
     async def on_error(self, event_method, *args, **kwargs):
@@ -192,7 +882,10 @@ class DiscardClient(discord.Client):
 class Discard():
     def __init__(self, token, mode, output_dir, command=None, channel_id=None, guild_id=None,
                     is_user_account=False, no_scrub=False, before=None, after=None,
-                    gzip=False):
+                    gzip=False, concurrency=1, guild_concurrency=1, partitions=1, write_buffer_size=64*1024, flush_interval=1.0,
+                    raw_responses=False, incremental=False, resume=None, seekable=False, codec=None,
+                    queue=None, lease_time=LEASE_TIME, metrics_file=None, http_only=False, raw_history=False,
+                    rotate_interval=LIVE_ROTATE_INTERVAL, duration=None):
         self.token = token
         self.mode = mode
         self.command = command
@@ -211,6 +904,25 @@ class Discard():
         self.before = before
         self.after = after
         self.gzip = gzip
+        # --gzip is short for the gzip codec at its default level
+        self.codec = get_codec(codec) if codec else (get_codec('gzip') if gzip else None)
+        self.concurrency = concurrency
+        self.guild_concurrency = guild_concurrency
+        self.partitions = partitions
+        self.write_buffer_size = write_buffer_size
+        self.flush_interval = flush_interval
+        self.raw_responses = raw_responses
+        self.incremental = incremental
+        self.resume = Path(resume) if resume else None
+        self.seekable = seekable
+        self.queue = Path(queue) if queue else Path(output_dir) / JOBS_FILENAME
+        self.lease_time = lease_time
+        self.metrics_file = Path(metrics_file) if metrics_file else None
+        self.http_only = http_only
+        self.raw_history = raw_history
+        self.rotate_interval = rotate_interval
+        self.duration = duration
+        self.resumed_segments = {}
 
         self.client = DiscardClient(discard=self)
 
@@ -224,47 +936,158 @@ class Discard():
         self.exception = None
         self.traceback = None
         self.num_http_requests = 0
+        self.num_http_retries = 0
         self.num_ws_packets = 0
         self.num_messages = 0
-        self.num_guild_messages = 0
+        # By guild, as multiple guilds may be archived at once
+        self.num_guild_messages = defaultdict(int)
         self.profile = None
+        self.request_files = []
+        self.request_file_tokens = {}
+        self.segment_files = {}
+        self.resumed = []
+        self.resumed_segments = {}
+        self.writer = None
+        self.rate_limiter = RateLimiter()
+        self.jobs = None
+        self.leased_jobs = {}
+        self.num_jobs = 0
+        self.num_failed_jobs = 0
+        self.num_reaction_requests = 0
+        self.reaction_time = 0.0
+        self.metrics = Metrics()
+        self.channel_start_times = {}
+        self.time_start = time.perf_counter()
+        self.startup_time = None
+        self.startup_peak_rss = None
+        self.live_files = {}
+        self.backfilling_channels = set()
+        self.disconnected_at = None
+        self.num_live_events = 0
+        self.num_backfills = 0
+        self.num_backfilled_messages = 0
 
-        self.run_directory = self.datetime_start.strftime('%Y%m%dT%H%M%S_'+self.mode)
-        if not self.before and not self.after:
-            self.run_directory += '_full'
-        self.output_directory = self.output_dir_root / Path(self.run_directory)
-        if os.path.exists(self.output_directory):
-            self.run_directory += "_" + self.ident[0:5]
+        if self.resume:
+            self.start_resume()
+        else:
+            self.run_directory = self.datetime_start.strftime('%Y%m%dT%H%M%S_'+self.mode)
+            if not self.before and not self.after and not self.incremental and self.mode != 'live':
+                self.run_directory += '_full'
             self.output_directory = self.output_dir_root / Path(self.run_directory)
-        if os.path.exists(self.output_directory):
-            raise RuntimeError("Fatal: Run directory already exists")
-        os.makedirs(self.output_directory)
+            if os.path.exists(self.output_directory):
+                self.run_directory += "_" + self.ident[0:5]
+                self.output_directory = self.output_dir_root / Path(self.run_directory)
+            if os.path.exists(self.output_directory):
+                raise RuntimeError("Fatal: Run directory already exists")
+            os.makedirs(self.output_directory)
+
+        self.state = self.read_state() if self.incremental else None
+
+        if self.mode == 'worker':
+            self.jobs = JobQueue(self.queue, lease_time=self.lease_time)
 
         self.write_meta_file()
 
-        self.open_request_file('run.jsonl')
+        self.writer = LogWriter(buffer_size=self.write_buffer_size, flush_interval=self.flush_interval)
+        self.request_file = self.open_request_file('run.jsonl')
     
-    def open_request_file(self, filepath):
+    def start_resume(self):
+        self.output_directory = self.resume
+        self.output_dir_root = self.output_directory.parent
+        self.run_directory = self.output_directory.name
+
+        with open(self.output_directory / Path('run.meta.json')) as f:
+            meta = json.load(f)
+
+        if meta['settings']['mode'] != self.mode:
+            raise RuntimeError(f"Fatal: Cannot resume a run of mode {meta['settings']['mode']} in mode {self.mode}")
+        if meta['run']['completed']:
+            raise RuntimeError("Fatal: Run was already completed")
+
+        self.resumed = meta['run'].get('resumed', []) + [self.datetime_start.isoformat()]
+        self.datetime_start = datetime.datetime.fromisoformat(meta['run']['datetime_start'])
+        self.ident = meta['run']['ident']
+        # Messages are counted again from the channels, as these counts may be stale
+        self.num_http_requests = meta['summary']['num_http_requests']
+        self.num_http_retries = meta['summary'].get('num_http_retries', 0)
+        self.num_ws_packets = meta['summary']['num_ws_packets']
+
+    def open_request_file(self, filepath, indexed=False):
         filepath = Path(filepath)
         if len(filepath.parts) > 1:
             os.makedirs(self.output_directory / filepath.parts[0], exist_ok=True)
         
-        if self.gzip:
-            filepath = filepath.with_name(filepath.name + '.gz')
+        if self.codec:
+            filepath = filepath.with_name(filepath.name + self.codec.suffix)
+
+        if self.resume:
+            # Resumed runs continue in new segment files, leaving the existing ones untouched
+            base = filepath.name.split('.')[0]
+            suffix = '.jsonl' + (self.codec.suffix if self.codec else '')
+            index = 0
+            while os.path.exists(self.output_directory / filepath):
+                index += 1
+                filepath = filepath.with_name(f'{base}.{index}{suffix}')
 
         if os.path.exists(self.output_directory / filepath):
             raise RuntimeError("Request file already exists")
         
-        open_func = gzip.open if self.gzip else open
-        self.request_file = open_func(self.output_directory / filepath, 'wt')
+        if indexed and self.seekable:
+            file = BlockFile(self.output_directory / filepath, codec=self.codec)
+        elif self.codec:
+            file = self.codec.open(self.output_directory / filepath)
+        else:
+            file = open(self.output_directory / filepath, 'wt')
+        request_file = self.writer.open(file)
+        request_file.filename = filepath.name
+        request_file.path = filepath.as_posix()
+        self.request_files.append(request_file)
+        # The files of a guild directory are counted together by channel, or guild for its own files
+        key = f'{filepath.parts[0]}/{filepath.name.split(".")[0]}' if len(filepath.parts) > 1 else None
+        self.metrics.add_log_file(request_file.path, request_file, key=key)
+
+        return request_file
+    
+    def close_request_file(self, request_file):
+        request_file.close()
+        self.request_files.remove(request_file)
+
+    async def wait_for_writer_queue(self):
+        # A writer which falls behind makes logging wait, without blocking the event loop
+        if self.writer:
+            await self.writer.wait_writable()
+    
+    def get_request_file(self):
+        return current_request_file.get() or self.request_file
     
     def end(self):
-        self.request_file.close()
+        # In case of errors, some guild or channel files may still be open
+        for request_file in list(self.request_files):
+            self.close_request_file(request_file)
 
-        self.finished = True
-        self.datetime_end = datetime.datetime.now(datetime.timezone.utc)
+        if self.jobs:
+            # Let other workers take over unfinished jobs right away
+            for job in list(self.leased_jobs.values()):
+                self.release_job(job)
+            self.jobs.close()
 
-        self.write_meta_file()
+        # Wait for everything logged to be written out
+        try:
+            self.writer.close()
+        except Exception as ex:
+            self.completed = False
+            self.errors = True
+            if not self.exception:
+                self.exception = type(ex).__name__ + f": {ex}"
+                self.traceback = traceback.format_exc()
+            raise
+        finally:
+            self.finished = True
+            self.datetime_end = datetime.datetime.now(datetime.timezone.utc)
+
+            self.write_meta_file()
+            if self.metrics_file:
+                self.write_metrics_file()
 
     def run(self):
         self.start()
@@ -301,13 +1124,30 @@ class Discard():
                 'after': self.after.isoformat() if self.after else None,
                 'before': self.before.isoformat() if self.before else None,
                 'no_scrub': self.no_scrub,
-                'gzip': self.gzip
+                'gzip': self.gzip,
+                'codec': str(self.codec) if self.codec else None,
+                'concurrency': self.concurrency,
+                'guild_concurrency': self.guild_concurrency,
+                'partitions': self.partitions,
+                'write_buffer_size': self.write_buffer_size,
+                'flush_interval': self.flush_interval,
+                'raw_responses': self.raw_responses,
+                'incremental': self.incremental,
+                'seekable': self.seekable,
+                'queue': str(self.queue) if self.mode == 'worker' else None,
+                'lease_time': self.lease_time if self.mode == 'worker' else None,
+                'metrics_file': str(self.metrics_file) if self.metrics_file else None,
+                'http_only': self.http_only,
+                'raw_history': self.raw_history,
+                'rotate_interval': self.rotate_interval if self.mode == 'live' else None,
+                'duration': self.duration if self.mode == 'live' else None
             },
             'run': {
                 'datetime_start': self.datetime_start.isoformat(),
                 'datetime_end': self.datetime_end.isoformat() if self.datetime_end else None,
                 'run_directory': self.run_directory,
                 'ident': self.ident,
+                'resumed': self.resumed,
                 'completed': self.completed,
                 'finished': self.finished,
                 'errors': self.errors,
@@ -316,8 +1156,32 @@ class Discard():
             },
             'summary': {
                 'num_http_requests': self.num_http_requests,
+                'num_http_retries': self.num_http_retries,
                 'num_ws_packets': self.num_ws_packets,
-                'num_messages': self.num_messages
+                'num_messages': self.num_messages,
+                'num_jobs': self.num_jobs,
+                'num_failed_jobs': self.num_failed_jobs,
+                'num_live_events': self.num_live_events,
+                'num_backfills': self.num_backfills,
+                'num_backfilled_messages': self.num_backfilled_messages
+            },
+            'writer': {
+                'max_queue_depth': self.writer.max_queue_depth if self.writer else 0,
+                'blocked_time': self.writer.blocked_time if self.writer else 0.0
+            },
+            # Seconds spent waiting on rate limits in every bucket, before requests and on 429 responses
+            'rate_limits': {
+                'wait_time': self.rate_limiter.wait_time,
+                'buckets': self.rate_limiter.json()
+            },
+            'metrics': {
+                # Seconds from the start of the run until archiving began, and the peak memory by then
+                'startup_time': self.startup_time,
+                'startup_peak_rss': self.startup_peak_rss,
+                'messages_per_second': self.num_messages / max(self.elapsed_time(), 1e-9),
+                'num_reaction_requests': self.num_reaction_requests,
+                'reaction_time': self.reaction_time,
+                **self.metrics.json(self.output_directory)
             },
             'user': None
         }
@@ -333,15 +1197,155 @@ class Discard():
         with open(self.output_directory / Path('run.meta.json'), 'w') as f:
             json.dump(obj, f, indent=4, ensure_ascii=False)
     
-    def start_channel(self, channel):
-        self.request_file.close()
+    def ready(self):
+        """Called once logged in and about to start archiving."""
+        if self.startup_time is None:
+            self.startup_time = time.perf_counter() - self.time_start
+            self.startup_peak_rss = peak_rss()
 
-        self.num_guild_messages = 0
+    def elapsed_time(self):
+        return ((self.datetime_end or datetime.datetime.now(datetime.timezone.utc)) - self.datetime_start).total_seconds()
 
+    def write_metrics_file(self):
+        """Write the metrics in the Prometheus text format, to be collected by
+        the textfile collector of the node exporter."""
+        counters = {
+            'http_requests_total': ('counter', "HTTP requests logged.", self.num_http_requests),
+            'http_retries_total': ('counter', "HTTP requests retried after transient errors.", self.num_http_retries),
+            'ws_packets_total': ('counter', "Websocket packets logged.", self.num_ws_packets),
+            'messages_total': ('counter', "Messages archived in completed channels.", self.num_messages),
+            'reaction_requests_total': ('counter', "Requests for the users of reactions.", self.num_reaction_requests),
+            'reaction_seconds_total': ('counter', "Seconds spent fetching the users of reactions.", self.reaction_time),
+            'live_events_total': ('counter', "Message events logged in live mode.", self.num_live_events),
+            'backfilled_messages_total': ('counter', "Messages fetched again after reconnecting in live mode.",
+                                            self.num_backfilled_messages),
+            'rate_limit_wait_seconds_total': ('counter', "Seconds spent waiting on rate limits.", self.rate_limiter.wait_time),
+            'elapsed_seconds': ('gauge', "Seconds since the run started.", self.elapsed_time()),
+            'finished': ('gauge', "Whether the run finished.", int(self.finished))
+        }
+        text = self.metrics.prometheus(counters, {'mode': self.mode, 'run_directory': self.run_directory})
+
+        # The collector may read the file at any time, so it's replaced whole
+        temporary_path = self.metrics_file.with_name(self.metrics_file.name + '.tmp')
+        with open(temporary_path, 'w') as f:
+            f.write(text)
+        os.replace(temporary_path, self.metrics_file)
+
+    def lease_job(self):
+        job = self.jobs.lease(self.ident)
+        if job is not None:
+            self.leased_jobs[job['id']] = job
+        return job
+
+    def complete_job(self, job):
+        self.jobs.complete(self.leased_jobs.pop(job['id']), self.ident, self.run_directory)
+        self.num_jobs += 1
+
+    def fail_job(self, job, error):
+        self.jobs.fail(self.leased_jobs.pop(job['id']), self.ident, error)
+        self.num_failed_jobs += 1
+
+    def release_job(self, job):
+        self.jobs.release(self.leased_jobs.pop(job['id']), self.ident)
+
+    def skip_channel(self, channel):
+        """Whether the channel was already archived by the run being resumed."""
+        if not self.resume:
+            return False
+
+        meta_path = self.output_directory / Path(f'{channel.guild.id}/{channel.id}.meta.json')
+        if not os.path.exists(meta_path):
+            return False
+
+        with open(meta_path) as f:
+            num_messages = json.load(f)['summary']['num_messages']
+        self.num_messages += num_messages
+        self.num_guild_messages[channel.guild.id] += num_messages
+
+        return True
+
+    def start_channel(self, channel):
         guild_id = channel.guild.id
-        self.open_request_file(f'{guild_id}/{channel.id}.jsonl')
+        if self.resume:
+            self.resume_channel(channel)
+
+        request_file = self.open_request_file(f'{guild_id}/{channel.id}.jsonl', indexed=True)
+        self.request_file_tokens[channel.id] = current_request_file.set(request_file)
+        self.segment_files[channel.id, 0] = request_file.filename
+        self.channel_start_times[channel.id] = time.perf_counter()
+
+    def resume_channel(self, channel):
+        """Find what of an interrupted channel was archived and what remains.
+        The channel may have been logged into several files, by partitions
+        and by earlier resumes; the part of each file which was completely
+        archived becomes a segment, and the gaps between them are left to be
+        archived."""
+        directory = self.output_directory / Path(str(channel.guild.id))
+        pattern = re.compile(rf'{channel.id}(\.\d+)?\.jsonl(' + '|'.join(re.escape(suffix) for suffix in SUFFIXES) + ')?$')
+        files = []
+        for filename in sorted(os.listdir(directory)) if os.path.exists(directory) else []:
+            if pattern.match(filename):
+                start = log_start(directory / filename, channel.id)
+                if start is not None:
+                    files.append((start, filename))
+        if not files:
+            return
+
+        after, before = self.channel_range(channel)
+        segments = []
+        results = []
+        gaps = []
+        # Everything up to this message ID is archived
+        covered = to_snowflake(after, high=True) or 0
+        covered_bound = after
+        for start, filename in sorted(files):
+            checkpoint = find_checkpoint(directory / filename, channel.id, before=to_snowflake(before),
+                                            after=max(start, covered))
+            if checkpoint is None:
+                continue
+
+            if start > covered:
+                # Archived again, up to and including the first message the file skipped
+                gaps.append((covered_bound, discord.Object(id=start + 1)))
+
+            oldest_message = discord.Object(id=checkpoint['oldest_message'])
+            newest_message = discord.Object(id=checkpoint['newest_message'])
+            reaction_stats = {
+                'num_reaction_requests': checkpoint['num_reaction_requests'],
+                'reaction_time': checkpoint['reaction_time']
+            }
+            segments.append({
+                'file': filename,
+                'after': max(start, covered),
+                # Anything logged after the checkpoint is archived again
+                'before': checkpoint['newest_message'] + 1,
+                'num_messages': checkpoint['num_messages'],
+                'oldest_message': summarize_message(oldest_message),
+                'newest_message': summarize_message(newest_message),
+                **reaction_stats
+            })
+            results.append((checkpoint['num_messages'], oldest_message, newest_message, reaction_stats))
+            covered = checkpoint['newest_message']
+            covered_bound = newest_message
+
+        if not segments:
+            return
+
+        print(f"Resuming channel {channel} after message {covered}"
+              + (f", and {len(gaps)} gaps before it" if gaps else ""))
+
+        self.resumed_segments[channel.id] = {
+            'checkpoint': covered,
+            'gaps': gaps,
+            'segments': segments,
+            'results': results
+        }
     
-    def end_channel(self, channel, num_messages, oldest_message, newest_message):
+    def end_channel(self, channel, num_messages, oldest_message, newest_message, reaction_stats=None,
+                    segments=None):
+        # The range has to be known before the state moves on
+        after, before = self.channel_range(channel)
+
         # This information is intentionally minimalistic. It's supposed to be
         # a human-readable summary, not a resource. Logged requests contain all data.
         obj = {
@@ -350,37 +1354,182 @@ class Discard():
                 'name': channel.name,
                 'type': str(channel.type)
             },
+            # Bounds are exclusive snowflakes, same as in the history request parameters
+            'range': {
+                'after': to_snowflake(after, high=True),
+                'before': to_snowflake(before)
+            },
             'summary': {
                 'num_messages': num_messages,
-                'oldest_message': None,
-                'newest_message': None
+                'oldest_message': summarize_message(oldest_message),
+                'newest_message': summarize_message(newest_message)
             }
         }
 
-        if oldest_message is not None:
-            obj['summary']['oldest_message'] = {
-                'id': oldest_message.id,
-                'timestamp': oldest_message.created_at.isoformat() # TODO these need to be converted to UTC!
-            }
-        if newest_message is not None:
-            obj['summary']['newest_message'] = {
-                'id': newest_message.id,
-                'timestamp': newest_message.created_at.isoformat()
-            }
+        if reaction_stats is not None:
+            obj['summary'].update(reaction_stats)
+            self.num_reaction_requests += reaction_stats['num_reaction_requests']
+            self.reaction_time += reaction_stats['reaction_time']
+
+        if segments is not None:
+            obj['segments'] = segments
+
+        seconds = time.perf_counter() - self.channel_start_times.pop(channel.id)
+        obj['metrics'] = {
+            'seconds': seconds,
+            'messages_per_second': num_messages / max(seconds, 1e-9),
+            # Uncompressed, in the channel file and its segments
+            'num_bytes': self.metrics.key_bytes(f'{channel.guild.id}/{channel.id}')
+        }
 
         with open(self.output_directory / Path(f'{channel.guild.id}/{channel.id}.meta.json'), 'w') as f:
             json.dump(obj, f, indent=4, ensure_ascii=False)
         
         self.num_messages += num_messages
-        self.num_guild_messages += num_messages
+        self.num_guild_messages[channel.guild.id] += num_messages
+
+        if self.incremental and newest_message is not None:
+            self.update_state(channel, newest_message)
+
+        request_file = current_request_file.get()
+        current_request_file.reset(self.request_file_tokens.pop(channel.id))
+        self.close_request_file(request_file)
     
-    def start_guild(self, guild):
-        self.request_file.close()
+    def channel_range(self, channel):
+        """The (after, before) bounds of the history to archive in a channel.
+        In incremental mode, archiving continues after the newest message
+        previously archived."""
+        after = self.after
+
+        if self.incremental:
+            channel_state = self.state['channels'].get(str(channel.id))
+            if channel_state and (after is None or to_snowflake(after, high=True) < channel_state['newest_message']):
+                after = discord.Object(id=channel_state['newest_message'])
+
+        return after, self.before
+
+    def read_state(self):
+        try:
+            with open(self.output_dir_root / Path(STATE_FILENAME)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'channels': {}}
+
+    def update_state(self, channel, newest_message):
+        channel_state = self.state['channels'].get(str(channel.id))
+        if channel_state and channel_state['newest_message'] >= newest_message.id:
+            return
+
+        self.state['channels'][str(channel.id)] = {
+            'guild_id': channel.guild.id,
+            'newest_message': newest_message.id,
+            'run_directory': self.run_directory
+        }
+
+        # Write to a temporary file first, so that the state is never left half written
+        state_path = self.output_dir_root / Path(STATE_FILENAME)
+        temporary_path = state_path.with_name(STATE_FILENAME + '.tmp')
+        with open(temporary_path, 'w') as f:
+            json.dump(self.state, f, indent=4, ensure_ascii=False)
+        os.replace(temporary_path, state_path)
+
+    def segment_filename(self, channel, index):
+        # The first segment is the regular channel file; the codec suffix is added on opening
+        return f'{channel.id}.jsonl' if index == 0 else f'{channel.id}.{index}.jsonl'
+
+    def start_segment(self, channel, index):
+        if index == 0:
+            return
+
+        request_file = self.open_request_file(f'{channel.guild.id}/{self.segment_filename(channel, index)}', indexed=True)
+        self.request_file_tokens[channel.id, index] = current_request_file.set(request_file)
+        self.segment_files[channel.id, index] = request_file.filename
+
+    def end_segment(self, channel, index):
+        if index == 0:
+            return
+
+        request_file = current_request_file.get()
+        current_request_file.reset(self.request_file_tokens.pop((channel.id, index)))
+        self.close_request_file(request_file)
+
+    def segment_summary(self, channel, index, after, before, num_messages, oldest_message, newest_message,
+                        reaction_stats):
+        return {
+            'file': self.segment_files[channel.id, index],
+            # Bounds are exclusive snowflakes, same as in the history request parameters
+            'after': to_snowflake(after, high=True),
+            'before': to_snowflake(before),
+            'num_messages': num_messages,
+            'oldest_message': summarize_message(oldest_message),
+            'newest_message': summarize_message(newest_message),
+            **reaction_stats
+        }
+    
+    def live_file(self, guild_id, channel_id):
+        """The live file of a channel for the current period, opened as
+        needed.  Periods are aligned to the rotate interval in UTC."""
+        period = int(time.time() // self.rotate_interval * self.rotate_interval)
+        live_file = self.live_files.get(channel_id)
+        if live_file and live_file.period != period and channel_id not in self.backfilling_channels:
+            self.close_live_file(guild_id, channel_id)
+            live_file = None
+
+        if live_file is None:
+            period_start = datetime.datetime.fromtimestamp(period, datetime.timezone.utc)
+            live_file = self.open_request_file(f'{guild_id}/{channel_id}.{period_start:%Y%m%dT%H%M%S}.jsonl')
+            live_file.guild_id = guild_id
+            live_file.period = period
+            self.live_files[channel_id] = live_file
+
+        return live_file
+
+    def rotate_live_files(self):
+        """Close the live files of past periods, which channels without
+        events would otherwise keep open."""
+        period = int(time.time() // self.rotate_interval * self.rotate_interval)
+        for channel_id, live_file in list(self.live_files.items()):
+            if live_file.period != period and channel_id not in self.backfilling_channels:
+                self.close_live_file(live_file.guild_id, channel_id)
+
+    def close_live_file(self, guild_id, channel_id):
+        # The bytes of past periods are counted per channel, or the metrics would grow by a file every period
+        live_file = self.live_files.pop(channel_id)
+        self.close_request_file(live_file)
+        self.metrics.rotate_log_file(live_file.path)
+
+    def start_backfill(self, channel):
+        # The live file is kept open until the backfill is done, even if its period ends
+        live_file = self.live_file(channel.guild.id, channel.id)
+        self.backfilling_channels.add(channel.id)
+        return live_file
+
+    def end_backfill(self, channel, num_messages):
+        self.backfilling_channels.discard(channel.id)
+        self.num_backfills += 1
+        self.num_backfilled_messages += num_messages
+
+    def skip_guild(self, guild):
+        """Whether the guild was already archived by the run being resumed."""
+        if not self.resume:
+            return False
 
-        self.open_request_file(f'{guild.id}/guild.jsonl')
+        meta_path = self.output_directory / Path(f'{guild.id}/guild.meta.json')
+        if not os.path.exists(meta_path):
+            return False
 
+        with open(meta_path) as f:
+            self.num_messages += json.load(f)['summary'].get('num_messages', 0)
+
+        return True
+
+    def start_guild(self, guild):
+        self.num_guild_messages[guild.id] = 0
+
+        request_file = self.open_request_file(f'{guild.id}/guild.jsonl')
+        self.request_file_tokens[guild.id] = current_request_file.set(request_file)
     
-    def end_guild(self, guild, num_channels):
+    def end_guild(self, guild, num_channels, queued=False):
         obj = {
             'guild': {
                 'id': guild.id,
@@ -388,14 +1537,22 @@ class Discard():
             },
             'summary': {
                 'num_channels': num_channels,
-                'num_messages': self.num_guild_messages
+                'num_messages': self.num_guild_messages.pop(guild.id)
             }
         }
+        if queued:
+            # The channels are archived by whichever workers take them, the messages are only counted there
+            del obj['summary']['num_messages']
+            obj['summary']['queued'] = True
         
         with open(self.output_directory / Path(f'{guild.id}/guild.meta.json'), 'w') as f:
             json.dump(obj, f, indent=4, ensure_ascii=False)
+
+        request_file = current_request_file.get()
+        current_request_file.reset(self.request_file_tokens.pop(guild.id))
+        self.close_request_file(request_file)
     
-    def log_http_request(self, route, kwargs, response, datetime_start, datetime_end):
+    def log_http_request(self, route, kwargs, response, datetime_start, datetime_end, raw_response=None):
         obj = {
             'type': 'http',
             'datetime_start': datetime_start.isoformat(),
@@ -410,8 +1567,17 @@ class Discard():
         }
         if 'params' in kwargs:
             obj['request']['params'] = kwargs['params']
-        json.dump(obj, self.request_file, ensure_ascii=False)
-        self.request_file.write('\n')
+
+        # JSON whitespace may contain newlines, which would break up the record
+        if raw_response is not None and '\n' not in raw_response:
+            # Splice in the response body as it was received instead of encoding it again
+            del obj['response']
+            record = json.dumps(obj, ensure_ascii=False)[:-1] + ', "response": {"data": ' + raw_response + '}}'
+        else:
+            record = json.dumps(obj, ensure_ascii=False)
+
+        request_file = self.get_request_file()
+        request_file.write(record + '\n', message_range(route.url, response))
         self.num_http_requests += 1
     
     def log_ws_send(self, data):
@@ -425,13 +1591,20 @@ class Discard():
         if not self.no_scrub and self.token in data:
             obj['data'] = data.replace(self.token, '[SCRUBBED]')
             obj['scrubbed'] = True
-        json.dump(obj, self.request_file, ensure_ascii=False)
-        self.request_file.write('\n')
+        request_file = self.get_request_file()
+        request_file.write(json.dumps(obj, ensure_ascii=False) + '\n')
         self.num_ws_packets += 1
 
     def log_ws_recv(self, data):
+        request_file = None
         if 't' in data:
-            if data['t'] in WS_EVENT_BLACKLIST:
+            if self.mode == 'live' and data['t'] in LIVE_EVENTS:
+                # Events of the followed guilds go into the files of their channels, others are dropped
+                if int(data['d'].get('guild_id', 0)) not in self.guild_ids:
+                    return
+                request_file = self.live_file(int(data['d']['guild_id']), int(data['d']['channel_id']))
+                self.num_live_events += 1
+            elif data['t'] in WS_EVENT_BLACKLIST:
                 return
         
         now = datetime.datetime.now()
@@ -441,6 +1614,6 @@ class Discard():
             'direction': 'recv',
             'data': data
         }
-        json.dump(obj, self.request_file, ensure_ascii=False)
-        self.request_file.write('\n')
+        request_file = request_file or self.get_request_file()
+        request_file.write(json.dumps(obj, ensure_ascii=False) + '\n')
         self.num_ws_packets += 1
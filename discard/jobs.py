@@ -0,0 +1,110 @@
+import time
+import sqlite3
+from contextlib import contextmanager
+
+JOBS_FILENAME = 'jobs.sqlite'
+
+LEASE_TIME = 300 # Seconds a job is leased to a worker for, renewed while it works on it
+MAX_ATTEMPTS = 3 # Number of leases of a job which may expire before it is given up on
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    target_id INTEGER NOT NULL,
+    guild_id INTEGER,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_directory TEXT,
+    error TEXT,
+    UNIQUE (type, target_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+'''
+
+class JobQueue():
+    """A queue of guilds and channels to archive, kept in an SQLite database
+    which any number of worker processes can take jobs from.
+
+    A job is leased to one worker at a time.  The worker renews the lease
+    while it works on the job, and if it dies, the lease expires and another
+    worker takes the job over.  Jobs are queued, leased, done or failed."""
+    def __init__(self, path, lease_time=LEASE_TIME):
+        # Transactions are begun explicitly, as leasing has to read and write atomically
+        self.connection = sqlite3.connect(str(path), timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        self.lease_time = lease_time
+
+    @contextmanager
+    def transaction(self):
+        # Take the write lock right away, so that no other worker leases the same job in the meantime
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def enqueue(self, type, target_id, guild_id=None):
+        """Queue a guild or channel.  One which is already queued or leased is
+        left as is, and one which is done or failed is queued again.  Returns
+        whether the job was queued."""
+        with self.transaction():
+            cursor = self.connection.execute('''INSERT OR IGNORE INTO jobs (type, target_id, guild_id, state)
+                VALUES (?, ?, ?, 'queued')''', (type, target_id, guild_id))
+            if cursor.rowcount:
+                return True
+            cursor = self.connection.execute('''UPDATE jobs SET state = 'queued', guild_id = coalesce(?, guild_id),
+                worker = NULL, lease_expires = NULL, attempts = 0, error = NULL
+                WHERE type = ? AND target_id = ? AND state IN ('done', 'failed')''', (guild_id, type, target_id))
+            return bool(cursor.rowcount)
+
+    def lease(self, worker):
+        """Lease the next queued job, or one whose lease expired, to a worker.
+        Returns the job, or None if there is none to be leased right now."""
+        now = time.time()
+        with self.transaction():
+            self.connection.execute('''UPDATE jobs SET state = 'failed', worker = NULL,
+                error = 'Lease expired ' || attempts || ' times'
+                WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?''', (now, MAX_ATTEMPTS))
+            job = self.connection.execute('''SELECT * FROM jobs
+                WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?)
+                ORDER BY id LIMIT 1''', (now,)).fetchone()
+            if job is None:
+                return None
+            self.connection.execute('''UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?,
+                attempts = attempts + 1 WHERE id = ?''', (worker, now + self.lease_time, job['id']))
+        return dict(job, state='leased', worker=worker, attempts=job['attempts'] + 1)
+
+    def renew(self, job, worker):
+        """Extend the lease of a job.  Returns False if the worker lost it."""
+        cursor = self.connection.execute('''UPDATE jobs SET lease_expires = ?
+            WHERE id = ? AND state = 'leased' AND worker = ?''', (time.time() + self.lease_time, job['id'], worker))
+        return bool(cursor.rowcount)
+
+    def complete(self, job, worker, run_directory):
+        self.connection.execute('''UPDATE jobs SET state = 'done', lease_expires = NULL, run_directory = ?
+            WHERE id = ? AND state = 'leased' AND worker = ?''', (run_directory, job['id'], worker))
+
+    def fail(self, job, worker, error):
+        self.connection.execute('''UPDATE jobs SET state = 'failed', lease_expires = NULL, error = ?
+            WHERE id = ? AND state = 'leased' AND worker = ?''', (error, job['id'], worker))
+
+    def release(self, job, worker):
+        """Give a job back to the queue, for another worker to take."""
+        self.connection.execute('''UPDATE jobs SET state = 'queued', worker = NULL, lease_expires = NULL
+            WHERE id = ? AND state = 'leased' AND worker = ?''', (job['id'], worker))
+
+    def num_pending(self):
+        """The number of jobs which are queued or leased, and so not finished yet."""
+        return self.connection.execute("SELECT count(*) FROM jobs WHERE state IN ('queued', 'leased')").fetchone()[0]
+
+    def counts(self):
+        return dict(self.connection.execute('SELECT state, count(*) FROM jobs GROUP BY state').fetchall())
+
+    def close(self):
+        self.connection.close()
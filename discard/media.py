@@ -0,0 +1,331 @@
+import os
+import asyncio
+import hashlib
+import sqlite3
+import datetime
+import threading
+import concurrent.futures
+from pathlib import Path
+
+import aiohttp
+
+from discard import reader
+from discard.compression import SUFFIXES
+from discard.discard import wait_for_workers
+
+MEDIA_DIRECTORY = 'media'
+MANIFEST_FILENAME = reader.MEDIA_MANIFEST_FILENAME
+
+CDN_URL = 'https://cdn.discordapp.com'
+
+DOWNLOAD_CONCURRENCY = 4 # Number of files to download at once by default
+DOWNLOAD_RETRIES = 3 # Number of times to retry a download after a transient error, continuing where it stopped
+DOWNLOAD_RETRY_DELAY = 1 # Seconds to wait before the first retry, doubled after each one
+DOWNLOAD_QUEUE_SIZE = 1000 # Maximum number of URLs waiting to be downloaded before reading the logs is held up
+CHUNK_SIZE = 64*1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    sha256 TEXT,
+    size INTEGER,
+    content_type TEXT,
+    error TEXT,
+    datetime TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS urls_sha256 ON urls (sha256);
+'''
+
+class DownloadError(Exception):
+    def __init__(self, message, transient=False):
+        super().__init__(message)
+        self.transient = transient
+
+
+def avatar_url(user):
+    extension = 'gif' if user['avatar'].startswith('a_') else 'png'
+    return f"{CDN_URL}/avatars/{user['id']}/{user['avatar']}.{extension}?size=4096"
+
+def emoji_url(emoji):
+    extension = 'gif' if emoji.get('animated') else 'png'
+    return f"{CDN_URL}/emojis/{emoji['id']}.{extension}"
+
+def embed_urls(embed):
+    for key in ('image', 'thumbnail', 'video'):
+        if isinstance(embed.get(key), dict) and embed[key].get('url'):
+            yield embed[key]['url']
+    for key in ('author', 'footer'):
+        if isinstance(embed.get(key), dict) and embed[key].get('icon_url'):
+            yield embed[key]['icon_url']
+
+def media_urls(data):
+    """Yield the URLs of the media in logged API data: attachments, images
+    and videos of embeds, avatars of users and custom emoji."""
+    if isinstance(data, list):
+        for item in data:
+            yield from media_urls(item)
+        return
+    elif not isinstance(data, dict):
+        return
+
+    # Users come in many places, messages, members, reactions and mentions among them
+    if data.get('avatar') and 'discriminator' in data and 'id' in data:
+        yield avatar_url(data)
+
+    for key, value in data.items():
+        if key == 'attachments' and isinstance(value, list):
+            yield from (attachment['url'] for attachment in value if attachment.get('url'))
+        elif key == 'embeds' and isinstance(value, list):
+            for embed in value:
+                yield from embed_urls(embed)
+        elif key == 'emoji' and isinstance(value, dict) and value.get('id'):
+            yield emoji_url(value)
+        elif key == 'emojis' and isinstance(value, list):
+            yield from (emoji_url(emoji) for emoji in value if emoji.get('id'))
+
+        if isinstance(value, (dict, list)):
+            yield from media_urls(value)
+
+def run_logs(run_path):
+    """The paths of all logs of a run, including live ones."""
+    suffixes = tuple('.jsonl' + suffix for suffix in [''] + SUFFIXES)
+    for directory, subdirectories, filenames in sorted(os.walk(run_path)):
+        for filename in sorted(filenames):
+            if filename.endswith(suffixes):
+                yield Path(directory) / filename
+
+def find_urls(path):
+    """Yield the media URLs in the logs of all runs under the path, reading
+    the logs as the URLs are taken.  URLs linked many times are yielded every
+    time, the store tells them apart."""
+    for run_path in reader.find_runs(Path(path)):
+        for log_path in run_logs(run_path):
+            for record in reader.read_log(log_path):
+                data = record.get('response', {}).get('data') if record['type'] == 'http' else record.get('data')
+                for url in media_urls(data):
+                    if url.startswith(('http://', 'https://')):
+                        yield url
+
+def scan_urls(path, loop, found, stopped):
+    """Run find_urls in a thread, so that reading the logs doesn't hold up the
+    downloads, and put the URLs on the asyncio queue `found` of the loop.  The
+    last item is None, or the exception reading the logs failed with.  Gives
+    up once `stopped` is set."""
+    def put(item):
+        future = asyncio.run_coroutine_threadsafe(found.put(item), loop)
+        while True:
+            try:
+                future.result(0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stopped.is_set():
+                    future.cancel()
+                    return False
+
+    try:
+        for url in find_urls(path):
+            if not put(url):
+                return
+    except Exception as ex:
+        put(ex)
+        return
+    put(None)
+
+
+class MediaStore():
+    """A directory of files stored by the SHA-256 of their content, so that
+    a file linked from many URLs or runs is only stored once.  The manifest
+    maps every URL downloaded to the file, or records why it failed."""
+    def __init__(self, path):
+        self.path = Path(path)
+        os.makedirs(self.path / 'partial', exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path / MANIFEST_FILENAME))
+        self.connection.executescript(SCHEMA)
+        self.connection.execute('CREATE TEMP TABLE seen (url TEXT PRIMARY KEY)')
+
+    def blob_path(self, sha256):
+        return self.path / 'blobs' / sha256[:2] / sha256
+
+    def partial_path(self, url):
+        # Kept between runs, so that an interrupted download continues where it stopped
+        return self.path / 'partial' / hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def is_stored(self, url):
+        row = self.connection.execute('SELECT state FROM urls WHERE url = ?', (url,)).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def first_seen(self, url):
+        """Whether the URL is seen for the first time since the store was
+        opened.  Kept in a temporary table rather than in memory, as there
+        may be any number of URLs."""
+        cursor = self.connection.execute('INSERT OR IGNORE INTO temp.seen VALUES (?)', (url,))
+        return cursor.rowcount == 1
+
+    def lookup(self, url):
+        """The path of the file downloaded from a URL, or None."""
+        row = self.connection.execute("SELECT sha256 FROM urls WHERE url = ? AND state = 'done'", (url,)).fetchone()
+        return self.blob_path(row[0]) if row else None
+
+    def add(self, url, partial_path, sha256, size, content_type):
+        """Move a completed download into the store, unless a file with the
+        same content is already stored.  Returns whether it was new."""
+        blob_path = self.blob_path(sha256)
+        new = not blob_path.exists()
+        if new:
+            os.makedirs(blob_path.parent, exist_ok=True)
+            os.replace(partial_path, blob_path)
+        else:
+            os.remove(partial_path)
+
+        self.record(url, 'done', sha256=sha256, size=size, content_type=content_type)
+        return new
+
+    def fail(self, url, error):
+        self.record(url, 'failed', error=error)
+
+    def record(self, url, state, sha256=None, size=None, content_type=None, error=None):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, state, sha256, size, content_type, error,
+                    datetime.datetime.now(datetime.timezone.utc).isoformat()))
+
+    def close(self):
+        self.connection.close()
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher
+
+async def fetch(session, url, partial_path, stats):
+    """Download a URL into its partial file, continuing after what is already
+    in it with a Range request.  Returns the SHA-256, size and content type."""
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 416 and offset:
+            # The partial file doesn't match the file anymore
+            os.remove(partial_path)
+            raise DownloadError("Range not satisfiable", transient=True)
+        if response.status == 429 or response.status >= 500:
+            raise DownloadError(f"HTTP {response.status}", transient=True)
+        if response.status not in (200, 206):
+            raise DownloadError(f"HTTP {response.status}")
+
+        if response.status == 206:
+            if not offset or not response.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                raise DownloadError("Unexpected range", transient=True)
+            hasher = hash_file(partial_path)
+            mode = 'ab'
+            stats['num_resumed'] += 1
+        else:
+            # The server sent the whole file
+            hasher = hashlib.sha256()
+            offset = 0
+            mode = 'wb'
+
+        size = offset
+        with open(partial_path, mode) as f:
+            # aiohttp raises an error if the body ends short of its length
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                f.write(chunk)
+                hasher.update(chunk)
+                size += len(chunk)
+
+        return hasher.hexdigest(), size, response.headers.get('Content-Type')
+
+async def download(session, store, url, stats):
+    partial_path = store.partial_path(url)
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            sha256, size, content_type = await fetch(session, url, partial_path, stats)
+            break
+        except (DownloadError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            if (isinstance(ex, DownloadError) and not ex.transient) or attempt == DOWNLOAD_RETRIES:
+                if isinstance(ex, DownloadError) and not ex.transient and os.path.exists(partial_path):
+                    os.remove(partial_path)
+                store.fail(url, str(ex) or type(ex).__name__)
+                stats['num_failed'] += 1
+                return
+            await asyncio.sleep(DOWNLOAD_RETRY_DELAY * 2 ** attempt)
+
+    if store.add(url, partial_path, sha256, size, content_type):
+        stats['num_downloaded'] += 1
+        stats['num_bytes'] += size
+    else:
+        stats['num_duplicates'] += 1
+
+async def download_media(path, store_path, concurrency=DOWNLOAD_CONCURRENCY):
+    """Download the media linked in all runs under the path into the store.
+    URLs which were downloaded before are skipped.  Returns the stats."""
+    store = MediaStore(store_path)
+    stats = {
+        'num_urls': 0,
+        'num_skipped': 0,
+        'num_downloaded': 0,
+        'num_duplicates': 0,
+        'num_resumed': 0,
+        'num_failed': 0,
+        'num_bytes': 0
+    }
+    queue = asyncio.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+
+    async def worker(session):
+        while True:
+            url = await queue.get()
+            try:
+                await download(session, store, url, stats)
+            finally:
+                queue.task_done()
+
+    # One pool of connections for all downloads, no larger than the number of downloads at once
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            workers = [asyncio.ensure_future(worker(session)) for i in range(concurrency)]
+            found = asyncio.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+            stopped = threading.Event()
+            loop = asyncio.get_event_loop()
+            scan = loop.run_in_executor(None, scan_urls, path, loop, found, stopped)
+            try:
+                while True:
+                    url = await found.get()
+                    if url is None:
+                        break
+                    if isinstance(url, Exception):
+                        raise url
+                    # The store is only used from the event loop
+                    if not store.first_seen(url):
+                        continue
+                    stats['num_urls'] += 1
+                    if store.is_stored(url):
+                        stats['num_skipped'] += 1
+                        continue
+                    await wait_for_workers(queue.put(url), workers)
+                await wait_for_workers(queue.join(), workers)
+            finally:
+                stopped.set()
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(scan, *workers, return_exceptions=True)
+    finally:
+        store.close()
+
+    return stats
+
+def media(path, store_path, concurrency=DOWNLOAD_CONCURRENCY):
+    stats = asyncio.get_event_loop().run_until_complete(download_media(path, store_path, concurrency=concurrency))
+
+    print(f"{stats['num_urls']} media URLs, {stats['num_skipped']} already downloaded")
+    print(f"Downloaded {stats['num_downloaded']} files ({stats['num_bytes'] / 1024**2:.2f} MiB), "
+          f"{stats['num_duplicates']} already stored from other URLs, {stats['num_resumed']} resumed")
+    if stats['num_failed']:
+        print(f"{stats['num_failed']} failed, they are tried again next time")
@@ -0,0 +1,148 @@
+import os
+import sys
+import bisect
+
+from discard.writer import ByteCount
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def peak_rss():
+    """The peak resident memory of this process in bytes, or None where unknown."""
+    if resource is None:
+        return None
+    # Kilobytes, except on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class Histogram():
+    """Counts of observations by the upper bound of their bucket, along with
+    their number and sum, same as a Prometheus histogram."""
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """(upper bound, number of observations up to it), ending with +Inf."""
+        total = 0
+        for bound, count in zip([str(bound) for bound in self.bounds] + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+    def json(self):
+        return {
+            'buckets': dict(self.cumulative_counts()),
+            'count': self.count,
+            'sum': self.sum
+        }
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(**kwargs):
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in kwargs.items()) + '}'
+
+
+class Metrics():
+    """Measurements of a run which tell where its time goes: the latency of
+    requests on every route and the bytes logged into every file."""
+    def __init__(self):
+        self.latencies = {}
+        self.log_files = {}
+        self.totals = {}
+        self.rotated_keys = set()
+
+    def observe_latency(self, route, seconds):
+        key = f'{route.method} {route.path}'
+        if key not in self.latencies:
+            self.latencies[key] = Histogram()
+        self.latencies[key].observe(seconds)
+
+    def add_log_file(self, path, log_file, key=None):
+        """Track a log file, counting its bytes towards the key, such as its
+        channel, if given."""
+        self.log_files[str(path)] = log_file
+        log_file.key = key
+        if key is not None:
+            log_file.total = self.totals.setdefault(key, ByteCount())
+
+    def rotate_log_file(self, path):
+        """Stop tracking a log file rotated out of a long run on its own.  Its
+        bytes are still counted towards its key, and reported under it."""
+        log_file = self.log_files.pop(str(path))
+        self.rotated_keys.add(log_file.key)
+
+    def key_bytes(self, key):
+        """The uncompressed bytes logged into the files of the key."""
+        return self.totals[key].num_bytes if key in self.totals else 0
+
+    def rotated_bytes(self):
+        """The bytes of the files rotated out, by key."""
+        rotated = {key: self.key_bytes(key) for key in self.rotated_keys}
+        for log_file in self.log_files.values():
+            if log_file.key in rotated:
+                rotated[log_file.key] -= log_file.num_bytes
+        return rotated
+
+    def json(self, directory=None):
+        files = {}
+        for path, log_file in sorted(self.log_files.items()):
+            files[path] = {'num_bytes': log_file.num_bytes}
+            if directory and log_file.closed and os.path.exists(os.path.join(directory, path)):
+                files[path]['disk_bytes'] = os.path.getsize(os.path.join(directory, path))
+        for key, num_bytes in sorted(self.rotated_bytes().items()):
+            files[key] = {'num_bytes': num_bytes}
+
+        return {
+            'http_latency': {route: histogram.json() for route, histogram in sorted(self.latencies.items())},
+            'files': files,
+            'peak_rss': peak_rss()
+        }
+
+    def prometheus(self, counters, info):
+        """The metrics in the Prometheus text format, along with the given
+        counters and the labels of the run in `info`."""
+        lines = [
+            '# HELP discard_run_info The run being measured.',
+            '# TYPE discard_run_info gauge',
+            f'discard_run_info{labels(**info)} 1',
+            '# HELP discard_http_request_duration_seconds Latency of HTTP requests to Discord by route.',
+            '# TYPE discard_http_request_duration_seconds histogram'
+        ]
+        for route, histogram in sorted(self.latencies.items()):
+            for bound, count in histogram.cumulative_counts():
+                lines.append(f'discard_http_request_duration_seconds_bucket{labels(route=route, le=bound)} {count}')
+            lines.append(f'discard_http_request_duration_seconds_sum{labels(route=route)} {histogram.sum}')
+            lines.append(f'discard_http_request_duration_seconds_count{labels(route=route)} {histogram.count}')
+
+        lines += [
+            '# HELP discard_log_bytes_total Uncompressed bytes logged by file.',
+            '# TYPE discard_log_bytes_total counter'
+        ]
+        for path, log_file in sorted(self.log_files.items()):
+            lines.append(f'discard_log_bytes_total{labels(file=path)} {log_file.num_bytes}')
+        for key, num_bytes in sorted(self.rotated_bytes().items()):
+            lines.append(f'discard_log_bytes_total{labels(file=key)} {num_bytes}')
+
+        for name, (kind, help, value) in counters.items():
+            lines += [f'# HELP discard_{name} {help}', f'# TYPE discard_{name} {kind}', f'discard_{name} {value}']
+
+        rss = peak_rss()
+        if rss is not None:
+            lines += ['# HELP discard_peak_rss_bytes Peak resident memory of the process.',
+                      '# TYPE discard_peak_rss_bytes gauge', f'discard_peak_rss_bytes {rss}']
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,173 @@
+import time
+import asyncio
+from collections import defaultdict
+
+import discord
+
+
+class UnlockedRoute(discord.http.Route):
+    """A copy of a route which discord.py doesn't lock on, as requests are
+    scheduled by the RateLimiter instead."""
+    bucket = None
+
+    def __init__(self, route):
+        self.__dict__.update(route.__dict__)
+
+
+# Seconds by which the reset of a bucket may differ between responses in the same window
+RESET_TOLERANCE = 0.1
+
+
+class Bucket():
+    __slots__ = ('limit', 'remaining', 'reset', 'window')
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None # None if not limited
+        self.reset = 0.0
+        self.window = 0.0
+
+
+class RateLimiter():
+    """Schedules requests by the rate limits Discord reports in the
+    X-RateLimit-* headers of its responses.
+
+    Discord groups routes into buckets, which it names in the
+    X-RateLimit-Bucket header, and limits every bucket separately for every
+    channel or guild.  Until the bucket of a route is known, the route is its
+    own bucket.  The first request on a route is sent alone to learn its
+    limits.  After that, requests are sent right away while the bucket has
+    requests remaining, even from multiple tasks at once, and otherwise wait
+    for it to reset.  A 429 is still possible, which discord.py waits out and
+    retries.
+
+    The time spent waiting in every bucket is recorded, both before requests
+    and on 429 responses."""
+    def __init__(self):
+        self.route_buckets = {}
+        self.buckets = {}
+        self.probes = {}
+        self.global_reset = 0.0
+        self.stats = defaultdict(lambda: {
+            'routes': set(),
+            'num_requests': 0,
+            'num_rate_limited': 0,
+            'wait_time': 0.0,
+            'retry_after_time': 0.0
+        })
+
+    def bucket_name(self, route):
+        return self.route_buckets.get((route.method, route.path), f'{route.method} {route.path}')
+
+    def bucket_key(self, route):
+        return self.bucket_name(route), route.channel_id, route.guild_id
+
+    async def acquire(self, route):
+        """Wait until a request can be sent on the route, and count it."""
+        time_start = time.monotonic()
+
+        probe_key = route.method, route.path, route.channel_id, route.guild_id
+        probe = None
+        while self.bucket_key(route) not in self.buckets:
+            if self.probes.get(probe_key) is None:
+                probe = self.probes[probe_key] = asyncio.Event()
+                break
+            await self.probes[probe_key].wait()
+
+        try:
+            while True:
+                now = time.monotonic()
+                delay = self.global_reset - now
+                bucket = self.buckets.get(self.bucket_key(route))
+                if bucket and bucket.remaining is not None:
+                    if bucket.remaining <= 0 and bucket.reset <= now:
+                        # The bucket reset, assume a window like the last one until a response tells
+                        bucket.remaining = bucket.limit
+                        bucket.reset = now + bucket.window
+                    if bucket.remaining <= 0:
+                        delay = max(delay, bucket.reset - now)
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        except BaseException:
+            # Cancelled before the request was sent, so release won't be called; let the next request probe
+            if probe is not None and self.probes.get(probe_key) is probe:
+                del self.probes[probe_key]
+                probe.set()
+            raise
+
+        if bucket and bucket.remaining is not None:
+            bucket.remaining -= 1
+
+        stats = self.stats[self.bucket_name(route)]
+        stats['routes'].add(f'{route.method} {route.path}')
+        stats['num_requests'] += 1
+        stats['wait_time'] += time.monotonic() - time_start
+
+    def release(self, route):
+        """Called after every request sent on the route, whether it succeeded or not."""
+        probe = self.probes.pop((route.method, route.path, route.channel_id, route.guild_id), None)
+        if probe is not None:
+            # Routes without rate limit headers are not limited
+            self.buckets.setdefault(self.bucket_key(route), Bucket())
+            probe.set()
+
+    def update(self, route, status, headers, data):
+        """Update the bucket of a route from a response."""
+        now = time.monotonic()
+        if headers.get('X-RateLimit-Bucket'):
+            name = headers['X-RateLimit-Bucket']
+            if self.route_buckets.get((route.method, route.path)) != name:
+                # Carry over what was recorded under the route before its bucket was known
+                old_name = self.bucket_name(route)
+                self.route_buckets[route.method, route.path] = name
+                if old_name in self.stats:
+                    self.merge_stats(old_name, name)
+
+        key = self.bucket_key(route)
+        bucket = self.buckets.get(key)
+        if 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Reset-After' in headers:
+            if bucket is None:
+                bucket = self.buckets[key] = Bucket()
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset_after = float(headers['X-RateLimit-Reset-After'])
+            bucket.limit = int(headers.get('X-RateLimit-Limit', remaining + 1))
+            bucket.window = max(bucket.window, reset_after)
+            if bucket.remaining is None or now + reset_after > bucket.reset + RESET_TOLERANCE:
+                # A new window
+                bucket.remaining = remaining
+                bucket.reset = now + reset_after
+            else:
+                # Other requests may have been sent since this one, and resets we assumed are early
+                bucket.remaining = min(bucket.remaining, remaining)
+                bucket.reset = max(bucket.reset, now + reset_after)
+
+        if status == 429 and isinstance(data, dict) and 'retry_after' in data:
+            # Same as discord.py, which waits this long before retrying
+            retry_after = data['retry_after'] / 1000.0
+            stats = self.stats[key[0]]
+            stats['num_rate_limited'] += 1
+            stats['retry_after_time'] += retry_after
+            if data.get('global'):
+                self.global_reset = now + retry_after
+            elif bucket is not None:
+                bucket.remaining = 0
+                bucket.reset = max(bucket.reset, now + retry_after)
+
+    def merge_stats(self, old_name, name):
+        old_stats = self.stats.pop(old_name)
+        stats = self.stats[name]
+        stats['routes'] |= old_stats['routes']
+        for field in ('num_requests', 'num_rate_limited', 'wait_time', 'retry_after_time'):
+            stats[field] += old_stats[field]
+
+        for (bucket_name, channel_id, guild_id), bucket in list(self.buckets.items()):
+            if bucket_name == old_name:
+                self.buckets.setdefault((name, channel_id, guild_id), self.buckets.pop((bucket_name, channel_id, guild_id)))
+
+    @property
+    def wait_time(self):
+        return sum(stats['wait_time'] + stats['retry_after_time'] for stats in self.stats.values())
+
+    def json(self):
+        return {name: {**stats, 'routes': sorted(stats['routes'])} for name, stats in sorted(self.stats.items())}
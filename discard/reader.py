@@ -1,23 +1,364 @@
+import re
 import json
 import os
-import gzip
-import itertools
+import math
+import functools
+import hashlib
+import concurrent.futures
 import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 from pathlib import Path
 
 import discord
 
-def read_chat(path):
-    meta = json.load(open(path + '.meta.json'))
-    if 'channel' not in meta:
-        raise ValueError("Not a channel log")
+from discard.discard import STATE_FILENAME
+from discard.coverage import Coverage
+from discard.compression import SUFFIXES, TRUNCATED_ERRORS, detect_codec, detect_data_codec
+from discard.writer import BlockFile, INDEX_SUFFIX, SEEK_BLOCK_SIZE, message_range, write_index
+
+# Snowflakes count milliseconds since the first second of 2015
+DISCORD_EPOCH = 1420070400000
+
+# Modes of runs which archive channels, laid out as guild directories of channel logs
+ARCHIVE_MODES = ('guild', 'channel', 'worker')
+
+# The manifest which marks a media store, which may be kept among the runs
+MEDIA_MANIFEST_FILENAME = 'manifest.sqlite'
+
+# Cache of the runs read by the summary, in the directory summarized
+SUMMARY_CACHE_FILENAME = 'summary.cache.json'
+SUMMARY_CACHE_VERSION = 3
+
+# How far into a line to look for the request URL when skipping irrelevant lines
+# without parsing them.  The URL precedes the response data in every record.
+RECORD_HEADER_LENGTH = 1024
+
+# The first message ID in a logged page of messages, and the ID it was requested after.
+# Responses are logged as Discord sent them, so the spacing may vary.
+FIRST_MESSAGE_PATTERN = re.compile(rb'"response": ?\{"data": ?\[\{"id": ?"(\d+)"')
+AFTER_PARAM_PATTERN = re.compile(rb'"params": \{[^}]*"after": (\d+)')
+
+# Number of messages the parallel reader reads as one piece, at most a few of which are held per process
+READ_CHUNK_MESSAGES = 10000
+MAP_JOBS_AHEAD = 2
+
+# Number of messages in a page of a compacted log, which has a record per message
+COMPACTED_PAGE_SIZE = 100
+
+def snowflake_time(snowflake):
+    """The creation time of a snowflake as a timezone-naive datetime in UTC,
+    same as discord.utils.snowflake_time."""
+    return datetime.datetime.utcfromtimestamp(((snowflake >> 22) + DISCORD_EPOCH) / 1000)
+
+def time_snowflake(datetime_, high=False):
+    """The lowest snowflake created at a timezone-naive datetime in UTC, or the
+    highest if `high`, same as discord.utils.time_snowflake."""
+    unix = (datetime_ - datetime.datetime(1970, 1, 1)).total_seconds()
+    return ((int(unix * 1000) - DISCORD_EPOCH) << 22) + (2**22 - 1 if high else 0)
+
+class Message():
+    """A lightweight message record over the message data as logged, for
+    when constructing a discord.Message would be too slow."""
+    __slots__ = ('id', 'type', 'content', 'data')
+
+    def __init__(self, data):
+        self.id = int(data['id'])
+        self.type = data['type']
+        self.content = data['content']
+        self.data = data
+
+    @property
+    def created_at(self):
+        return snowflake_time(self.id)
+
+    @property
+    def author(self):
+        author = self.data['author']
+        return f"{author['username']}#{author['discriminator']}"
+
+def log_path(path):
+    """The path of a log as it exists on disk, compressed or not."""
+    path = str(path)
+    if not os.path.exists(path):
+        for suffix in SUFFIXES:
+            if os.path.exists(path + suffix):
+                return path + suffix
+    return path
+
+def open_log(path):
+    """Open a log for reading, with the codec it was compressed with if any."""
+    path = log_path(path)
+    codec = detect_codec(path)
+    if codec:
+        return codec.open_read(path)
+    else:
+        return open(path, 'rb')
+
+def read_log_lines(path):
+    """Read the lines of a log.  Logs of runs which were interrupted may end
+    in the middle of a record, reading stops there."""
+    with open_log(path) as file:
+        try:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    return
+                yield line
+        except TRUNCATED_ERRORS:
+            # Truncated compressed stream
+            return
+
+def read_log(path):
+    for line in read_log_lines(path):
+        yield json.loads(line)
+
+def read_index(path):
+    """The block index of a log, or None if it has none."""
+    index_path = log_path(path) + INDEX_SUFFIX
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+def read_log_range(path, after=None, before=None):
+    """Read the lines of a log which may contain messages in the exclusive
+    range of IDs.  If the log has an index, only the blocks overlapping the
+    range are read, otherwise all lines are."""
+    index = read_index(path)
+    if index is None:
+        yield from read_log_lines(path)
+        return
+
+    with open(log_path(path), 'rb') as file:
+        for block in index['blocks']:
+            if block['first_message'] is None:
+                continue
+            if (after and block['last_message'] <= after) or (before and block['first_message'] >= before):
+                continue
+
+            file.seek(block['offset'])
+            data = file.read(block['length'])
+            codec = detect_data_codec(data)
+            if codec:
+                data = codec.decompress(data)
+            yield from data.splitlines(keepends=True)
+
+def reindex_log(path, block_size=SEEK_BLOCK_SIZE):
+    """Build the block index of a log which has none.  Uncompressed logs are
+    indexed as they are.  Compressed logs are written again in blocks with
+    the same codec at its default level, and the same content; anything after
+    a truncated record is dropped."""
+    path = log_path(path)
+    index_path = path + INDEX_SUFFIX
+    codec = detect_codec(path)
+
+    def line_range(line):
+        if not line.startswith(b'{"type": "http"') or b'/messages"' not in line[:RECORD_HEADER_LENGTH]:
+            return None
+        record = json.loads(line)
+        return message_range(record['request']['url'], record['response']['data'])
+
+    if not codec:
+        blocks = []
+        offset = 0
+        for line in read_log_lines(path):
+            if not blocks or blocks[-1]['length'] >= block_size:
+                blocks.append({'offset': offset, 'length': 0, 'first_message': None, 'last_message': None})
+            block = blocks[-1]
+            block['length'] += len(line)
+            offset += len(line)
+            range_ = line_range(line)
+            if range_:
+                block['first_message'] = min(block['first_message'] or range_[0], range_[0])
+                block['last_message'] = max(block['last_message'] or range_[1], range_[1])
+        write_index(index_path, blocks, None)
+        return
+
+    # Write to a temporary file first, so that the log is never left half written
+    temporary_path = path + '.tmp'
+    block_file = BlockFile(temporary_path, codec=codec, block_size=block_size, index_path=None)
+    try:
+        for line in read_log_lines(path):
+            block_file.write(line.decode('utf-8'), line_range(line))
+    finally:
+        block_file.close()
+    os.replace(temporary_path, path)
+    write_index(index_path, block_file.blocks, codec)
 
+def reindex(path, force=False):
+    """Index the channel logs of all runs under the path."""
+    for run_path in find_runs(Path(path)):
+        for channel_path in find_channels(run_path):
+            with open(channel_path + '.meta.json') as f:
+                meta = json.load(f)
+            for segment_path, after, before in channel_segments(channel_path, meta):
+                if not os.path.exists(log_path(segment_path)):
+                    continue
+                if read_index(segment_path) is not None and not force:
+                    continue
+                reindex_log(segment_path)
+                print(f"Indexed {log_path(segment_path)}")
+
+def channel_segments(path, meta):
+    """The request logs of a channel in the order the messages were archived,
+    as (path, after, before) with the message ID range each one contributes.
+    Partitioned and resumed channels are split into multiple segments."""
+    if 'segments' not in meta:
+        return [(path + '.jsonl', None, None)]
+
+    directory = os.path.dirname(path)
+    return [(os.path.join(directory, segment['file']), segment['after'], segment['before'])
+                for segment in meta['segments']]
+
+def page_bounds(line):
+    """The exclusive lower and inclusive upper bound of the message IDs in a
+    logged page of messages, read from the start of the record without
+    parsing it.  Pages are newest first, so the first message is the highest;
+    the lowest is only known when the page was requested after an ID."""
+    header = line[:RECORD_HEADER_LENGTH]
+    match = FIRST_MESSAGE_PATTERN.search(header)
+    if not match:
+        return None, None
+    request = header[:match.start()]
+    after = AFTER_PARAM_PATTERN.search(request)
+    return int(after.group(1)) if after else None, int(match.group(1))
+
+def author_needle(author):
+    """Bytes which every logged message by the author contains, to skip the
+    pages without them unparsed, or None if there are none to rely on."""
+    if author is None:
+        return None
+    author = str(author)
+    if author.isdigit():
+        return f'"{author}"'.encode()
+    username = author.rsplit('#', 1)[0]
+    # Escaped differently depending on who wrote the JSON
+    if not username.isascii() or '"' in username or '\\' in username:
+        return None
+    return username.encode()
+
+def read_pages(path, meta, after=None, before=None, needle=None):
+    """Read the data of all messages logged for a channel a page at a time,
+    as lists oldest first, optionally only those in an exclusive range of
+    message IDs.  Pages outside the range, or without the needle, are
+    skipped without parsing them."""
     channel_id = meta['channel']['id']
-    channel_name = meta['channel']['name']
+    url_suffix = f'/channels/{channel_id}/messages"'.encode()
+
+    for segment_path, segment_after, segment_before in channel_segments(path, meta):
+        if (after and segment_before and segment_before <= after + 1) or \
+                (before and segment_after and segment_after + 1 >= before):
+            continue
+        after_ = max(after or 0, segment_after or 0)
+        before_ = min(before or float('inf'), segment_before or float('inf'))
+
+        if after or before:
+            lines = read_log_range(segment_path, after, before)
+        else:
+            lines = read_log_lines(segment_path)
+
+        if meta.get('compacted'):
+            # Compacted logs have a record for every message, oldest first
+            page = []
+            for line in lines:
+                if needle and needle not in line:
+                    continue
+                message_data = json.loads(line)['data']
+                message_id = int(message_data['id'])
+                if after_ < message_id < before_:
+                    page.append(message_data)
+                    if len(page) == COMPACTED_PAGE_SIZE:
+                        yield page
+                        page = []
+            if page:
+                yield page
+            continue
+
+        for line in lines:
+            # Skip websocket events and other requests without parsing them
+            if line.startswith(b'{"type": "ws"') or url_suffix not in line[:RECORD_HEADER_LENGTH]:
+                continue
+            if needle and needle not in line:
+                continue
+            lowest, highest = page_bounds(line)
+            if (highest is not None and highest <= after_) or (lowest is not None and lowest + 1 >= before_):
+                continue
+
+            record = json.loads(line)
+            if record['type'] != 'http' or not record['request']['url'].endswith(f'/channels/{channel_id}/messages'):
+                continue
+
+            page = [message_data for message_data in reversed(record['response']['data'])
+                        if after_ < int(message_data['id']) < before_]
+            if page:
+                yield page
 
-    print(f"Channel {channel_name} (id {channel_id})")
+def read_message_data(path, meta, after=None, before=None):
+    """Read the data of all messages logged for a channel, oldest first,
+    optionally only those in an exclusive range of message IDs."""
+    for page in read_pages(path, meta, after=after, before=before):
+        yield from page
 
+def channel_paths(path):
+    """The paths of the channel logs at the path, as taken by the reader: all
+    channels of the runs under a directory, or of a directory of compacted
+    logs, or a single channel given with or without the suffix of its log."""
+    path = Path(path)
+    if path.is_dir():
+        runs = find_runs(path)
+        return [channel_path for run_path in runs or [path] for channel_path in find_channels(run_path)]
+
+    path = str(path)
+    for suffix in ['.jsonl' + suffix for suffix in SUFFIXES] + ['.jsonl', '.meta.json']:
+        if path.endswith(suffix):
+            path = path[:-len(suffix)]
+            break
+    if not os.path.exists(path + '.meta.json'):
+        raise ValueError("Not a channel log")
+    return [path]
+
+def matches_channel(channel, query):
+    return str(channel['id']) == str(query) or channel['name'] == query
+
+def matches_author(message, query):
+    return str(query) == message.data['author']['id'] or query == message.author
+
+def iter_pages(path, channel=None, after=None, before=None, author=None):
+    """Yield the messages archived under the path a page at a time, as lists
+    of Message records oldest first.  The path is a directory of runs, a run,
+    or a channel log, compressed or not.  Messages can be limited to a channel
+    (by ID or name), an exclusive range of message IDs or datetimes in UTC,
+    and an author (by ID or name#discriminator).
+
+    Channels are read one after another, in the order of the runs, so a
+    message archived by several runs is yielded once for each of them.  Only
+    one page is held in memory at a time, and pages which can't match are
+    skipped without parsing them."""
+    if isinstance(after, datetime.datetime):
+        after = time_snowflake(after, high=True)
+    if isinstance(before, datetime.datetime):
+        before = time_snowflake(before)
+    needle = author_needle(author)
+
+    for channel_path in channel_paths(path):
+        with open(channel_path + '.meta.json') as f:
+            meta = json.load(f)
+        if 'channel' not in meta or (channel is not None and not matches_channel(meta['channel'], channel)):
+            continue
+
+        for page in read_pages(channel_path, meta, after=after, before=before, needle=needle):
+            messages = [Message(message_data) for message_data in page]
+            if author is not None:
+                messages = [message for message in messages if matches_author(message, author)]
+            if messages:
+                yield messages
+
+def iter_messages(path, channel=None, after=None, before=None, author=None):
+    """Yield the messages archived under the path one at a time, as Message
+    records, with the same filters as iter_pages."""
+    for page in iter_pages(path, channel=channel, after=after, before=before, author=author):
+        yield from page
+
+def mock_channel(channel_id, channel_name):
     # Create a crippled state
     # TODO implement our own
     state = discord.state.ConnectionState.__new__(discord.state.ConnectionState)
@@ -33,124 +374,387 @@ def read_chat(path):
     guild._roles = {}
     guild.name = ''
 
-    channel = discord.TextChannel(state=state, guild=guild, data={
+    return discord.TextChannel(state=state, guild=guild, data={
         'id': channel_id,
         'type': 0,
         'name': channel_name,
         'parent_id': 0, 'position': 0
     })
 
-    if os.path.exists(path + '.jsonl.gz'):
-        file = gzip.open(path + '.jsonl.gz')
+def chat_lines(path, objects=False, after=None, before=None, header=True):
+    meta = json.load(open(path + '.meta.json'))
+    if 'channel' not in meta:
+        raise ValueError("Not a channel log")
+
+    channel_id = meta['channel']['id']
+    channel_name = meta['channel']['name']
+
+    if header:
+        yield f"Channel {channel_name} (id {channel_id})"
+
+    channel = None
+
+    for message_data in read_message_data(path, meta, after=after, before=before):
+        if not objects and message_data['type'] == 0:
+            message = Message(message_data)
+            yield f"[{message.created_at}] <{message.author}> {message.content}"
+            continue
+
+        # System messages are rare and their text is up to discord.py
+        if channel is None:
+            channel = mock_channel(channel_id, channel_name)
+        message = discord.Message(state=channel._state, channel=channel, data=message_data)
+        if message.type == discord.MessageType.default:
+            yield f"[{message.created_at}] <{message.author}> {message.content}"
+        else:
+            yield f"[{message.created_at}] {message.system_content}"
+
+def render_chat(path, objects=False, after=None, before=None, header=True):
+    return ''.join(line + '\n' for line in chat_lines(path, objects=objects, after=after, before=before,
+                                                      header=header))
+
+def render_chat_chunk(chunk, objects=False):
+    path, after, before, header = chunk
+    return render_chat(path, objects=objects, after=after, before=before, header=header)
+
+def chat_chunks(path, after=None, before=None):
+    """Split reading a channel into ranges of message IDs of about
+    READ_CHUNK_MESSAGES messages each, going by the range and number of
+    messages in its meta, as (path, after, before, header).  Messages are
+    rarely spread evenly, but no chunk can be much of a large channel."""
+    with open(path + '.meta.json') as f:
+        summary = json.load(f).get('summary', {})
+    num_messages = summary.get('num_messages') or 0
+    # Compacted channels record the IDs alone
+    oldest, newest = [message['id'] if isinstance(message, dict) else message
+                        for message in (summary.get('oldest_message'), summary.get('newest_message'))]
+    if num_messages <= READ_CHUNK_MESSAGES or not oldest or not newest:
+        return [(path, after, before, True)]
+
+    num_chunks = math.ceil(num_messages / READ_CHUNK_MESSAGES)
+    # Chunk i reads the messages from boundary i up to boundary i + 1
+    boundaries = sorted(set(oldest + (newest - oldest) * i // num_chunks for i in range(1, num_chunks)))
+    afters = [after] + [max(boundary - 1, after or 0) for boundary in boundaries]
+    befores = [min(boundary, before or boundary) for boundary in boundaries] + [before]
+    return [(path, chunk_after, chunk_before, index == 0)
+                for index, (chunk_after, chunk_before) in enumerate(zip(afters, befores))]
+
+def read_chat(path, objects=False, after=None, before=None):
+    for line in chat_lines(path, objects=objects, after=after, before=before):
+        print(line)
+
+def read_chats(paths, objects=False, jobs=1, after=None, before=None):
+    if jobs <= 1:
+        for path in paths:
+            read_chat(path, objects=objects, after=after, before=before)
+        return
+
+    # Large channels are read in chunks, so that the output held at once is bounded
+    chunks = (chunk for path in paths for chunk in chat_chunks(path, after=after, before=before))
+    for text in map_jobs(functools.partial(render_chat_chunk, objects=objects), chunks, jobs):
+        print(text, end='')
+
+def map_jobs(func, items, jobs=1):
+    """Map the function over the items, in a pool of `jobs` processes if more
+    than one.  Results are yielded in the order of the items either way, each
+    as soon as it and those before it are done.  Only a few items per process
+    are worked on ahead of the results taken."""
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        futures = deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= jobs * MAP_JOBS_AHEAD:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+def find_runs(path):
+    """Find all run directories under the path, in a stable order."""
+    directory = sorted(os.listdir(path))
+    if 'run.meta.json' in directory:
+        return [path]
+    if MEDIA_MANIFEST_FILENAME in directory:
+        # A media store, whose many shard directories hold no runs
+        return []
+
+    runs = []
+    for subdirectory in directory:
+        if not os.path.isfile(path / subdirectory):
+            runs += find_runs(path / subdirectory)
+    return runs
+
+def find_channels(path):
+    """Find the paths of all channel logs of a run, as taken by the reader."""
+    channels = []
+    for subdirectory in sorted(os.listdir(path)):
+        if os.path.isfile(path / subdirectory):
+            continue
+        for subfile in sorted(os.listdir(path / subdirectory)):
+            if subfile.endswith('.meta.json') and not subfile.startswith('guild'):
+                channels.append(str(path / subdirectory / subfile[:-len('.meta.json')]))
+    return channels
+
+def parse_utc(text):
+    """Parse an ISO datetime from a meta file as a timezone-naive datetime in UTC."""
+    datetime_ = datetime.datetime.fromisoformat(text)
+    if datetime_.tzinfo:
+        datetime_ = datetime_.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return datetime_
+
+def channel_coverage(channel_meta, run_after, run_before):
+    """The half-open interval of snowflakes [start, end) which a channel was
+    archived over.  The range requested is what is covered, even where it had
+    no messages; the oldest and newest messages archived can only extend it."""
+    channel_range = channel_meta.get('range', {})
+    if channel_range.get('after') is not None:
+        start = channel_range['after'] + 1
+    else:
+        # No message can be older than its channel
+        start = run_after or channel_meta['channel']['id']
+    if channel_range.get('before') is not None:
+        end = channel_range['before']
     else:
-        file = open(path + '.jsonl')
+        end = run_before
+
+    summary = channel_meta.get('summary', {})
+    # Older versions mixed the oldest and newest message up
+    message_ids = [summary[key]['id'] for key in ('oldest_message', 'newest_message') if summary.get(key)]
+    if message_ids:
+        start = min(start, min(message_ids))
+        end = max(end, max(message_ids) + 1)
+
+    return start, end
+
+def read_run(path):
+    """Read the coverage of a run from its meta files.  Returns a list of
+    warnings and the guilds of the run, or None if the run is to be skipped."""
+    meta = json.load(open(path / 'run.meta.json'))
+
+    if meta['settings']['mode'] not in ARCHIVE_MODES:
+        return [], None
+
+    warnings = []
+    if not meta['run']['completed'] or not meta['run']['finished'] or meta['run']['errors']:
+        # Channel meta files are only written once a channel is complete
+        warnings.append(f"Warning: Run not completed or has errors, only counting its completed channels: {path}")
 
-    for line in file:
-        line = json.loads(line)
-        if line['type'] != 'http':
+    if meta['client']['version'] < '0.3.3':
+        # stupid bug
+        meta['settings']['after'], meta['settings']['before'] = meta['settings']['before'], meta['settings']['after']
+
+    # The run covers snowflakes from run_after (if set) up to before run_before
+    run_after = meta['settings']['after'] and time_snowflake(parse_utc(meta['settings']['after']), high=True) + 1
+    run_before = time_snowflake(parse_utc(meta['settings']['before'] or meta['run']['datetime_start']))
+
+    guilds = {}
+    for subdirectory in sorted(os.listdir(path)):
+        if os.path.isfile(path / subdirectory):
             continue
 
-        if line['request']['url'].endswith(f'/channels/{channel_id}/messages'):
-            for message_data in reversed(line['response']['data']):
-                message = discord.Message(state=state, channel=channel, data=message_data)
-                if message.type == discord.MessageType.default:
-                    print(f"[{message.created_at}] <{message.author}> {message.content}")
-                else:
-                    print(f"[{message.created_at}] {message.system_content}")
+        guild_name = None
+        if os.path.exists(path / subdirectory / 'guild.meta.json'):
+            guild_name = json.load(open(path / subdirectory / 'guild.meta.json'))['guild']['name']
+        guild = guilds[int(subdirectory)] = {
+            'name': guild_name,
+            'channels': {}
+        }
+
+        for subfile in sorted(os.listdir(path / subdirectory)):
+            if subfile.startswith('guild') or not subfile.endswith('.meta.json'):
+                continue
+            channel_meta = json.load(open(path / subdirectory / subfile))
+            guild['channels'][channel_meta['channel']['id']] = {
+                'name': channel_meta['channel']['name'],
+                'run': channel_coverage(channel_meta, run_after, run_before)
+            }
+
+    return warnings, guilds
+
+def run_signature(path):
+    """A hash of the names, sizes and modification times of all meta files of
+    a run, which covers everything read_run reads."""
+    signature = hashlib.sha1()
+    for directory, subdirectories, filenames in os.walk(path):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.meta.json'):
+                stat = os.stat(os.path.join(directory, filename))
+                relative_path = os.path.relpath(os.path.join(directory, filename), path)
+                signature.update(f"{relative_path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return signature.hexdigest()
+
+def decode_guilds(guilds):
+    """Restore the guilds of a run as returned by read_run from JSON."""
+    if guilds is None:
+        return None
+    return {int(guild_id): {
+        'name': guild['name'],
+        'channels': {int(channel_id): {'name': channel['name'], 'run': tuple(channel['run'])}
+                        for channel_id, channel in guild['channels'].items()}
+    } for guild_id, guild in guilds.items()}
 
 class Summarize():
     def __init__(self):
-        # TODO coverage
         self.guilds = defaultdict(dict)
         self.num_runs = 0
+        self.state = None
     
-    def parse_directory(self, path):
+    def parse_directory(self, path, jobs=1, cache=False, rebuild_cache=False):
+        """Parse all runs under the path.  With `cache`, what was read from
+        every run is kept in a cache file in the directory, and only runs which
+        are new or changed since are read again."""
         self.now = datetime.datetime.now()
 
-        directory = os.listdir(path)
-        if 'run.meta.json' in directory:
-            self.parse_run(path)
-        else:
-            for subdirectory in directory:
-                if not os.path.isfile(path / subdirectory):
-                    self.parse_directory(path / subdirectory)
+        if STATE_FILENAME in os.listdir(path):
+            self.parse_state(path)
+
+        runs = find_runs(path)
+        cached_runs = self.read_cache(path) if cache and not rebuild_cache else {}
+
+        keys = [os.path.relpath(run_path, path) for run_path in runs]
+        signatures = [run_signature(run_path) for run_path in runs]
+        new_runs = [run_path for run_path, key, signature in zip(runs, keys, signatures)
+                        if cached_runs.get(key, {}).get('signature') != signature]
+        results = dict(zip(new_runs, map_jobs(read_run, new_runs, jobs)))
+
+        runs_cache = {}
+        for run_path, key, signature in zip(runs, keys, signatures):
+            if run_path in results:
+                warnings, guilds = results[run_path]
+                runs_cache[key] = {'signature': signature, 'warnings': warnings, 'guilds': guilds}
+            else:
+                runs_cache[key] = cached_runs[key]
+                warnings, guilds = cached_runs[key]['warnings'], decode_guilds(cached_runs[key]['guilds'])
+            self.add_run(run_path, warnings, guilds)
+
+        if cache:
+            self.write_cache(path, runs_cache)
         
         self.calculate_gaps()
+
+    def read_cache(self, path):
+        # A cache which can't be read is as good as none, everything is read again
+        try:
+            with open(path / SUMMARY_CACHE_FILENAME) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) or cache.get('version') != SUMMARY_CACHE_VERSION:
+            return {}
+        return cache.get('runs', {})
+
+    def write_cache(self, path, runs_cache):
+        # Write to a temporary file first, so that the cache is never left half written.
+        # The cache is only an aid, so a directory it can't be written to is left as is.
+        cache_path = path / SUMMARY_CACHE_FILENAME
+        temporary_path = cache_path.with_name(SUMMARY_CACHE_FILENAME + '.tmp')
+        try:
+            with open(temporary_path, 'w') as f:
+                json.dump({'version': SUMMARY_CACHE_VERSION, 'runs': runs_cache}, f, ensure_ascii=False)
+            os.replace(temporary_path, cache_path)
+        except OSError:
+            if os.path.isfile(temporary_path):
+                os.remove(temporary_path)
     
+    def parse_state(self, path):
+        self.state = json.load(open(path / STATE_FILENAME))
+
     def parse_run(self, path):
-        meta = json.load(open(path / 'run.meta.json'))
+        self.add_run(path, *read_run(path))
 
-        if meta['settings']['mode'] != 'guild':
-            # TODO
-            return
-        
-        if not meta['run']['completed'] or not meta['run']['finished'] or meta['run']['errors']:
-            print(f"Warning: Run not completed or has errors, skipping: {path}")
+    def add_run(self, path, warnings, guilds):
+        for warning in warnings:
+            print(warning)
+
+        if guilds is None:
             return
 
         self.num_runs += 1
 
-        if meta['client']['version'] < '0.3.3':
-            # stupid bug
-            meta['settings']['after'], meta['settings']['before'] = meta['settings']['before'], meta['settings']['after']
+        for guild_id, run_guild in guilds.items():
+            # Channel mode runs don't know the name of the guild
+            if run_guild['name'] is not None or 'name' not in self.guilds[guild_id]:
+                self.guilds[guild_id]['name'] = run_guild['name']
+            if 'channels' not in self.guilds[guild_id]:
+                self.guilds[guild_id]['channels'] = defaultdict(dict)
 
-        run_after = meta['settings']['after'] or '0000-00-00T00:00:00'
-        run_before = meta['settings']['before'] or meta['run']['datetime_start']
-        
-        for subdirectory in os.listdir(path):
-            if not os.path.isfile(path / subdirectory):
-                guild_meta = json.load(open(path / subdirectory / 'guild.meta.json'))
-                guild_id = guild_meta['guild']['id']
-                self.guilds[guild_id]['name'] = guild_meta['guild']['name']
-                if 'channels' not in self.guilds[guild_id]:
-                    self.guilds[guild_id]['channels'] = defaultdict(dict)
-                
-                for subfile in os.listdir(path / subdirectory):
-                    if subfile.startswith('guild'):
-                        continue
-                    if subfile.endswith('.meta.json'):
-                        channel_meta = json.load(open(path / subdirectory / subfile))
-                        channel_id = channel_meta['channel']['id']
-                        channel = self.guilds[guild_id]['channels'][channel_id]
-                        channel['name'] = channel_meta['channel']['name']
-                        if 'runs' not in channel:
-                            channel['runs'] = []
-                        channel['runs'].append((run_after, run_before))
-                        self.guilds[guild_id]['channels'][channel_id] = channel
+            for channel_id, run_channel in run_guild['channels'].items():
+                channel = self.guilds[guild_id]['channels'][channel_id]
+                channel['name'] = run_channel['name']
+                if 'runs' not in channel:
+                    channel['runs'] = []
+                channel['runs'].append(run_channel['run'])
 
     def calculate_gaps(self):
+        """Find the gaps in the coverage of every channel since its creation.
+        Gaps are half-open intervals of snowflakes, the last one of every
+        channel is open until now, with an end of None."""
+        self.coverage = {}
         self.gaps = defaultdict(list)
         for guild_id, guild in self.guilds.items():
             for channel_id, channel in guild['channels'].items():
-                channel_beginning = '0000-00-00T00:00:00' # discord.Object(channel_id).created_at.isoformat()
-                end = datetime.datetime.utcnow().isoformat()
-
-                ranges = []
-                # union of ranges
-                for after, before in sorted(channel['runs']):
-                    if ranges and ranges[-1][1] >= after:
-                        ranges[-1][1] = max(ranges[-1][1], before)
-                    else:
-                        ranges.append([after, before])
-                
-                flat = itertools.chain((channel_beginning,), (itertools.chain.from_iterable(ranges)))
-                gaps = [(x, y) for x, y in zip(flat, flat) if x < y]
-                for gap in gaps:
+                coverage = self.coverage[channel_id] = Coverage(channel['runs'])
+                for gap in coverage.gaps(channel_id):
                     self.gaps[gap].append(channel_id)
 
-
     def json(self):
         return {
             'guilds': self.guilds,
             'num_runs': self.num_runs,
-            'gaps': {f"{p[0]} - {p[1]}":v for p,v in self.gaps}
+            'state': self.state,
+            'gaps': [{'start': start, 'end': end, 'channels': channels}
+                        for (start, end), channels in self.gaps.items()]
         }
 
-def summary(path, as_json=False):
+def plan_runs(gaps):
+    """The runs needed to close the gaps, as (after, before, channel IDs) with
+    the datetimes to pass as --after and --before.  Datetimes are rounded
+    outwards to whole seconds, and channels with the same rounded gap share a
+    run.  Runs for open gaps have no --before."""
+    runs = defaultdict(list)
+    for (start, end), channels in gaps.items():
+        # --after is exclusive of the given datetime, so it has to be before the gap
+        after = snowflake_time(start) - datetime.timedelta(milliseconds=1)
+        after = after.replace(microsecond=0)
+        before = None
+        if end is not None:
+            # --before is exclusive too, so it has to be past the last snowflake of the gap
+            before = snowflake_time(end - 1).replace(microsecond=0) + datetime.timedelta(seconds=1)
+        runs[after, before] += channels
+
+    return [(after, before, sorted(set(channels))) for (after, before), channels in
+                sorted(runs.items(), key=lambda run: (run[0][0], run[0][1] or datetime.datetime.max))]
+
+def plan(path, as_json=False, jobs=1, cache=False):
+    path = Path(path)
+
+    summarize = Summarize()
+    summarize.parse_directory(path, jobs=jobs, cache=cache)
+    runs = plan_runs(summarize.gaps)
+
+    if as_json:
+        print(json.dumps([{
+            'after': after.isoformat(),
+            'before': before.isoformat() if before else None,
+            'channels': channels
+        } for after, before, channels in runs]))
+        return
+
+    for after, before, channels in runs:
+        options = f"--after {after.isoformat()}"
+        if before:
+            options += f" --before {before.isoformat()}"
+        print(f"python -m discard {options} channel {' '.join(str(channel) for channel in channels)}")
+
+def summary(path, as_json=False, jobs=1, cache=False, rebuild_cache=False):
     path = Path(path)
 
     summarize = Summarize()
-    summarize.parse_directory(path)
+    summarize.parse_directory(path, jobs=jobs, cache=cache, rebuild_cache=rebuild_cache)
     
     if as_json:
         summary = summarize.json()
@@ -160,9 +764,14 @@ def summary(path, as_json=False):
         num_channels = sum([len(guild['channels']) for guild in summarize.guilds.values()])
         print(f"{summarize.num_runs} runs")
         print(f"{num_guilds} guilds")
+        for guild_id, guild in summarize.guilds.items():
+            print(f"  {guild['name'] or '(unknown)'} (id {guild_id}): {len(guild['channels'])} channels")
         print(f"{num_channels} channels")
+        if summarize.state is not None:
+            print(f"{len(summarize.state['channels'])} channels in incremental state")
         print("Gaps:")
-        for gap, channels in summarize.gaps.items():
+        for (start, end), channels in sorted(summarize.gaps.items(), key=lambda gap: (gap[0][0], gap[0][1] or math.inf)):
+            gap = f"{snowflake_time(start)} - {snowflake_time(end) if end is not None else 'now'}"
             if len(channels) < 5:
                 print(f"{gap}: {len(channels)} channels: {channels}")
             else:
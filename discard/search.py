@@ -0,0 +1,151 @@
+import os
+import json
+import sqlite3
+from pathlib import Path
+
+from discard import reader
+
+INDEX_FILENAME = 'index.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS channels (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    author_id INTEGER,
+    author TEXT,
+    content TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel_id, id);
+CREATE INDEX IF NOT EXISTS messages_author ON messages (author_id, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    content, content='messages', content_rowid='id'
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    signature TEXT NOT NULL
+);
+'''
+
+def connect(path):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+def channel_signature(channel_path, meta):
+    """The sizes and modification times of the files of a channel, to tell
+    whether it changed since it was indexed."""
+    paths = [channel_path + '.meta.json'] + [reader.log_path(segment_path)
+                for segment_path, after, before in reader.channel_segments(channel_path, meta)]
+    signature = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return json.dumps(signature)
+
+def index_message(connection, channel_id, message_data):
+    """Add a message to the index.  Messages are stored once by ID; one which
+    was archived again with different content, such as after an edit, is
+    replaced, so that runs indexed in order leave the newest version."""
+    message = reader.Message(message_data)
+    row = (message.id, channel_id, int(message_data['author']['id']), message.author, message.content)
+
+    cursor = connection.execute('INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)', row)
+    if cursor.rowcount:
+        connection.execute('INSERT INTO messages_fts (rowid, content) VALUES (?, ?)', (message.id, message.content))
+        return
+
+    old_content, = connection.execute('SELECT content FROM messages WHERE id = ?', (message.id,)).fetchone()
+    if old_content == message.content:
+        return
+    connection.execute("INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', ?, ?)",
+        (message.id, old_content))
+    connection.execute('UPDATE messages SET author = ?, content = ? WHERE id = ?',
+        (message.author, message.content, message.id))
+    connection.execute('INSERT INTO messages_fts (rowid, content) VALUES (?, ?)', (message.id, message.content))
+
+def index(path, database=None):
+    """Index the messages of all runs under the path for searching.  Channels
+    which were already indexed and haven't changed since are skipped."""
+    path = Path(path)
+    connection = connect(database or path / INDEX_FILENAME)
+
+    num_channels = 0
+    num_messages = 0
+    for run_path in reader.find_runs(path):
+        for channel_path in reader.find_channels(run_path):
+            with open(channel_path + '.meta.json') as f:
+                meta = json.load(f)
+
+            key = os.path.relpath(channel_path, path)
+            signature = channel_signature(channel_path, meta)
+            row = connection.execute('SELECT signature FROM files WHERE path = ?', (key,)).fetchone()
+            if row and row[0] == signature:
+                continue
+
+            # Every channel is committed on its own, so that an interrupted indexing can continue
+            with connection:
+                channel_id = meta['channel']['id']
+                guild_id = int(Path(channel_path).parent.name)
+                connection.execute('INSERT OR REPLACE INTO channels VALUES (?, ?, ?)',
+                    (channel_id, guild_id, meta['channel']['name']))
+                for message_data in reader.read_message_data(channel_path, meta):
+                    index_message(connection, channel_id, message_data)
+                    num_messages += 1
+                connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?)', (key, signature))
+            num_channels += 1
+
+    connection.close()
+    print(f"Indexed {num_messages} messages in {num_channels} channels")
+
+def search_messages(database, query, channel=None, author=None, after=None, before=None, limit=20):
+    """Search the index with an FTS5 query, optionally only messages of a
+    channel (by ID or name) or author (by ID or name#discriminator) in an
+    exclusive range of message IDs.  Yields the best matches first."""
+    sql = '''SELECT messages.id, channels.name, messages.author, messages.content
+        FROM messages_fts
+        JOIN messages ON messages.id = messages_fts.rowid
+        LEFT JOIN channels ON channels.id = messages.channel_id
+        WHERE messages_fts MATCH ?'''
+    params = [query]
+
+    if channel is not None:
+        if str(channel).isdigit():
+            sql += ' AND messages.channel_id = ?'
+        else:
+            sql += ' AND channels.name = ?'
+        params.append(channel)
+    if author is not None:
+        if str(author).isdigit():
+            sql += ' AND messages.author_id = ?'
+        else:
+            sql += ' AND messages.author = ?'
+        params.append(author)
+    if after:
+        sql += ' AND messages.id > ?'
+        params.append(after)
+    if before:
+        sql += ' AND messages.id < ?'
+        params.append(before)
+
+    sql += ' ORDER BY rank LIMIT ?'
+    params.append(limit)
+
+    connection = sqlite3.connect(database)
+    try:
+        yield from connection.execute(sql, params)
+    finally:
+        connection.close()
+
+def search(path, query, database=None, **kwargs):
+    database = database or Path(path) / INDEX_FILENAME
+    if not os.path.exists(database):
+        raise FileNotFoundError(f"No index at {database}, create it with the index command first")
+
+    for message_id, channel_name, author, content in search_messages(database, query, **kwargs):
+        print(f"[{reader.snowflake_time(message_id)}] #{channel_name} <{author}> {content}")
@@ -0,0 +1,359 @@
+import json
+import time
+import bisect
+import asyncio
+import datetime
+import multiprocessing
+
+from aiohttp import web
+
+from discard import reader
+
+SYNTHETIC_GUILD_ID = 805808489695150180
+SYNTHETIC_CHANNEL_ID = 805808489695150183
+SYNTHETIC_USER_ID = 788430627179462657
+SYNTHETIC_START = datetime.datetime(2017, 4, 16)
+
+# Discord sends a heartbeat interval in milliseconds, this is its usual one
+HEARTBEAT_INTERVAL = 41250
+
+def synthetic_message(message_id, index, channel_id=SYNTHETIC_CHANNEL_ID, reaction_density=0.1):
+    """A message like those in the example run.  A `reaction_density` of
+    the messages have a reaction, with one to three users."""
+    data = {
+        'id': str(message_id),
+        'type': 0,
+        'content': f"This is synthetic message number {index}, of a typical length for a chat message.",
+        'channel_id': str(channel_id),
+        'author': {
+            'id': str(83101988983668736 + index % 50),
+            'username': f"User{index % 50}",
+            'avatar': '5806dc8069de110e94876ea63e0a1456',
+            'discriminator': f"{index % 50:04}",
+            'public_flags': 0
+        },
+        'attachments': [],
+        'embeds': [],
+        'mentions': [],
+        'mention_roles': [],
+        'pinned': False,
+        'mention_everyone': False,
+        'tts': False,
+        'timestamp': reader.snowflake_time(message_id).isoformat() + '+00:00',
+        'edited_timestamp': None,
+        'flags': 0
+    }
+    if reaction_density and index % max(1, round(1 / reaction_density)) == 0:
+        data['reactions'] = [{'emoji': {'id': None, 'name': '👍'}, 'count': 1 + index % 3, 'me': False}]
+    return data
+
+def synthetic_user(user_id, bot=False):
+    return {
+        'id': str(user_id),
+        'username': f"User{user_id % 1000}",
+        'avatar': None,
+        'discriminator': f"{user_id % 10000:04}",
+        'public_flags': 0,
+        'bot': bot
+    }
+
+
+class StandIn():
+    """A synthetic stand-in for the Discord API, serving guilds of text
+    channels with a message every minute in each, for as long as needed.
+
+    It serves the REST endpoints archiving guilds and channels uses, along
+    with a gateway which only sends what is needed to log in.  Every channel is rate
+    limited to `rate_limit` requests per `rate_limit_window` seconds in every
+    bucket, like Discord does, or not at all if `rate_limit` is 0.
+
+    With `num_live_messages`, that many messages are posted in every channel
+    after the first login.  The first half is sent over the gateway, along
+    with an edit of the first one, then the connection is dropped and the
+    other half is posted while the client is away.  Its session can't be
+    resumed, so the client has to log in again."""
+    def __init__(self, num_channels=1, num_messages=1000, reaction_density=0.1,
+                    rate_limit=0, rate_limit_window=1.0, num_guilds=1, num_live_messages=0):
+        self.num_guilds = num_guilds
+        self.num_channels = num_channels
+        self.num_messages = num_messages
+        self.reaction_density = reaction_density
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.num_live_messages = num_live_messages
+
+        start_ms = int((SYNTHETIC_START - datetime.datetime(1970, 1, 1)).total_seconds() * 1000) - reader.DISCORD_EPOCH
+        self.guild_ids = [SYNTHETIC_GUILD_ID + guild_index * 1000000 for guild_index in range(num_guilds)]
+        # num_channels in every guild
+        self.guild_channel_ids = {guild_id: [SYNTHETIC_CHANNEL_ID + guild_index * 1000000 + index
+                                                for index in range(num_channels)]
+                                    for guild_index, guild_id in enumerate(self.guild_ids)}
+        self.channel_ids = [channel_id for guild_id in self.guild_ids for channel_id in self.guild_channel_ids[guild_id]]
+        # The lowest bits tell apart messages of different channels sent at the same time
+        self.message_ids = {channel_id: [((start_ms + index * 60000) << 22) + channel_index
+                                for index in range(num_messages)]
+                            for channel_index, channel_id in enumerate(self.channel_ids)}
+
+        self.port = None
+        self.buckets = {}
+        self.stats = {
+            'num_requests': 0,
+            'num_rate_limited': 0,
+            'num_messages': 0,
+            'num_ws_connections': 0,
+            'num_identifies': 0
+        }
+
+    def guild(self, guild_id):
+        return {
+            'id': str(guild_id),
+            'name': f"Synthetic Guild {self.guild_ids.index(guild_id)}",
+            'icon': None,
+            'splash': None,
+            'region': 'europe',
+            'owner_id': str(SYNTHETIC_USER_ID),
+            'afk_timeout': 300,
+            'verification_level': 0,
+            'default_message_notifications': 0,
+            'explicit_content_filter': 0,
+            'mfa_level': 0,
+            'features': [],
+            'roles': self.roles(guild_id),
+            'emojis': [],
+            'member_count': 1
+        }
+
+    def channels(self, guild_id):
+        return [{
+            'id': str(channel_id),
+            'type': 0,
+            'guild_id': str(guild_id),
+            'name': f"channel-{index}",
+            'position': index,
+            'parent_id': None,
+            'permission_overwrites': [],
+            'nsfw': False,
+            'topic': None
+        } for index, channel_id in enumerate(self.guild_channel_ids[guild_id])]
+
+    def roles(self, guild_id):
+        return [{
+            'id': str(guild_id),
+            'name': '@everyone',
+            'permissions': '104324673',
+            'position': 0,
+            'color': 0,
+            'hoist': False,
+            'managed': False,
+            'mentionable': False
+        }]
+
+    def member(self):
+        return {
+            'user': synthetic_user(SYNTHETIC_USER_ID, bot=True),
+            'roles': [],
+            'joined_at': SYNTHETIC_START.isoformat(),
+            'deaf': False,
+            'mute': False
+        }
+
+    def post_message(self, guild_id, channel_id):
+        """Post a message in a channel now, returning its data for the gateway."""
+        message_ids = self.message_ids[channel_id]
+        now_ms = int(time.time() * 1000) - reader.DISCORD_EPOCH
+        message_ids.append(max(now_ms << 22, message_ids[-1] + 1 if message_ids else 0))
+        data = synthetic_message(message_ids[-1], len(message_ids) - 1, channel_id=channel_id,
+                                    reaction_density=self.reaction_density)
+        return dict(data, guild_id=str(guild_id))
+
+    def rate_limit_headers(self, bucket, key):
+        """The rate limit headers of a response in a bucket, and whether the
+        request is rate limited."""
+        if not self.rate_limit:
+            return {}, False
+
+        now = time.monotonic()
+        remaining, reset = self.buckets.get((bucket, key), (0, 0.0))
+        if now >= reset:
+            remaining, reset = self.rate_limit, now + self.rate_limit_window
+        limited = remaining == 0
+        if not limited:
+            remaining -= 1
+        self.buckets[bucket, key] = (remaining, reset)
+
+        return {
+            'X-RateLimit-Bucket': bucket,
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset-After': f'{reset - now:.3f}'
+        }, limited
+
+    def respond(self, request, data, bucket=None, key=None, status=200):
+        self.stats['num_requests'] += 1
+        headers, limited = self.rate_limit_headers(bucket, key) if bucket else ({}, False)
+        if limited:
+            self.stats['num_rate_limited'] += 1
+            # API v7 gives retry_after in milliseconds
+            data = {'message': "You are being rate limited.", 'global': False,
+                    'retry_after': float(headers['X-RateLimit-Reset-After']) * 1000}
+            status = 429
+        # discord.py only parses responses of exactly this content type, without a charset
+        headers['Content-Type'] = 'application/json'
+        # and takes 429 responses which didn't pass through Discord's proxy for a Cloudflare ban
+        headers['Via'] = '1.1 google'
+        return web.Response(body=json.dumps(data, ensure_ascii=False).encode('utf-8'), status=status,
+                                headers=headers)
+
+    async def get_messages(self, request):
+        channel_id = int(request.match_info['channel_id'])
+        if channel_id not in self.message_ids:
+            return self.respond(request, {'message': "Unknown Channel", 'code': 10003}, status=404)
+        message_ids = self.message_ids[channel_id]
+        limit = int(request.query.get('limit', 50))
+        if 'after' in request.query:
+            start = bisect.bisect_right(message_ids, int(request.query['after']))
+            end = min(start + limit, len(message_ids))
+            if 'before' in request.query:
+                end = min(end, bisect.bisect_left(message_ids, int(request.query['before'])))
+        else:
+            end = len(message_ids)
+            if 'before' in request.query:
+                end = bisect.bisect_left(message_ids, int(request.query['before']))
+            start = max(0, end - limit)
+
+        # Newest first, same as Discord
+        data = [synthetic_message(message_ids[index], index, channel_id=channel_id,
+                    reaction_density=self.reaction_density) for index in reversed(range(start, end))]
+        self.stats['num_messages'] += len(data)
+        return self.respond(request, data, 'messages', channel_id)
+
+    async def get_reactions(self, request):
+        channel_id = int(request.match_info['channel_id'])
+        index = bisect.bisect_left(self.message_ids.get(channel_id, []), int(request.match_info['message_id']))
+        count = 1 + index % 3
+        after = int(request.query.get('after', 0))
+        limit = int(request.query.get('limit', 25))
+        data = [synthetic_user(user_id) for user_id in range(after + 1, count + 1)][:limit]
+        return self.respond(request, data, 'reactions', channel_id)
+
+    async def get_user(self, request):
+        return self.respond(request, synthetic_user(SYNTHETIC_USER_ID, bot=True))
+
+    async def get_gateway(self, request):
+        return self.respond(request, {'url': f'ws://127.0.0.1:{self.port}/gateway'})
+
+    async def get_guild_data(self, request):
+        guild_id = int(request.match_info['guild_id'])
+        if guild_id not in self.guild_ids:
+            return self.respond(request, {'message': "Unknown Guild", 'code': 10004}, status=404)
+
+        data = {
+            'guild': self.guild,
+            'channels': self.channels,
+            'roles': self.roles,
+            'emojis': lambda guild_id: []
+        }[request.match_info.get('data', 'guild')](guild_id)
+        return self.respond(request, data, 'guild', guild_id)
+
+    async def get_member(self, request):
+        guild_id = int(request.match_info['guild_id'])
+        if guild_id not in self.guild_ids or int(request.match_info['user_id']) != SYNTHETIC_USER_ID:
+            return self.respond(request, {'message': "Unknown Member", 'code': 10007}, status=404)
+        return self.respond(request, self.member(), 'member', guild_id)
+
+    async def get_channel(self, request):
+        channel_id = int(request.match_info['channel_id'])
+        for guild_id, channel_ids in self.guild_channel_ids.items():
+            if channel_id in channel_ids:
+                return self.respond(request, self.channels(guild_id)[channel_ids.index(channel_id)], 'channel', channel_id)
+        return self.respond(request, {'message': "Unknown Channel", 'code': 10003}, status=404)
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def gateway(self, request):
+        """Just enough of the gateway to log in: HELLO, then READY and the
+        guilds once identified, and heartbeats acknowledged until the client
+        disconnects.  Sessions are never resumed."""
+        self.stats['num_ws_connections'] += 1
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({'op': 10, 'd': {'heartbeat_interval': HEARTBEAT_INTERVAL}})
+
+        sequence = 0
+        async for msg in ws:
+            payload = json.loads(msg.data)
+            if payload['op'] == 1:
+                await ws.send_json({'op': 11})
+            elif payload['op'] == 6:
+                await ws.send_json({'op': 9, 'd': False})
+            elif payload['op'] == 2:
+                self.stats['num_identifies'] += 1
+                user = synthetic_user(SYNTHETIC_USER_ID, bot=True)
+                events = [('READY', {
+                    'v': 7, 'user': user, 'session_id': 'standin', 'private_channels': [], 'relationships': [],
+                    'guilds': [{'id': str(guild_id), 'unavailable': True} for guild_id in self.guild_ids]
+                })]
+                for guild_id in self.guild_ids:
+                    events.append(('GUILD_CREATE', dict(self.guild(guild_id), channels=self.channels(guild_id),
+                        members=[self.member()], presences=[], voice_states=[], large=False)))
+                live = self.num_live_messages and self.stats['num_identifies'] == 1
+                if live:
+                    for guild_id in self.guild_ids:
+                        for channel_id in self.guild_channel_ids[guild_id]:
+                            messages = [self.post_message(guild_id, channel_id)
+                                            for index in range(self.num_live_messages // 2)]
+                            events += [('MESSAGE_CREATE', message) for message in messages]
+                            if messages:
+                                events.append(('MESSAGE_UPDATE', dict(messages[0], content="Edited")))
+                for event, data in events:
+                    sequence += 1
+                    await ws.send_json({'op': 0, 't': event, 's': sequence, 'd': data})
+
+                if live:
+                    for guild_id in self.guild_ids:
+                        for channel_id in self.guild_channel_ids[guild_id]:
+                            for index in range(self.num_live_messages - self.num_live_messages // 2):
+                                self.post_message(guild_id, channel_id)
+                    # Any close code but a few makes the client reconnect
+                    await ws.close(code=4000)
+        return ws
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/api/v7/users/@me', self.get_user)
+        app.router.add_get('/api/v7/gateway', self.get_gateway)
+        app.router.add_get('/api/v7/gateway/bot', self.get_gateway)
+        app.router.add_get('/api/v7/guilds/{guild_id}', self.get_guild_data)
+        app.router.add_get('/api/v7/guilds/{guild_id}/{data:channels|roles|emojis}', self.get_guild_data)
+        app.router.add_get('/api/v7/guilds/{guild_id}/members/{user_id}', self.get_member)
+        app.router.add_get('/api/v7/channels/{channel_id}', self.get_channel)
+        app.router.add_get('/api/v7/channels/{channel_id}/messages', self.get_messages)
+        app.router.add_get('/api/v7/channels/{channel_id}/messages/{message_id}/reactions/{emoji}', self.get_reactions)
+        app.router.add_get('/standin/stats', self.get_stats)
+        app.router.add_get('/gateway', self.gateway)
+        return app
+
+    def serve(self, connection):
+        """Serve on a free local port, which is sent over the connection."""
+        async def start():
+            runner = web.AppRunner(self.app())
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            self.port = runner.addresses[0][1]
+            connection.send(self.port)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(start())
+        loop.run_forever()
+
+    def start_process(self):
+        """Serve in a process of its own, so that generating responses doesn't
+        take time from the client being measured.  Returns the process and
+        the URL served at."""
+        parent_connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=self.serve, args=(child_connection,), daemon=True)
+        process.start()
+        port = parent_connection.recv()
+        return process, f'http://127.0.0.1:{port}'
@@ -1,11 +1,29 @@
 import json
 import gzip
+import time
+import shutil
+import threading
+import asyncio
+import datetime
 from pathlib import Path
 
 import discord
+import aiohttp
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from click.testing import CliRunner
 
-from discard import Discard, reader
+from discard import Discard, reader, benchmark, search, compact, media
+from discard.cli import cli
+from discard.coverage import Coverage
+from discard.compression import get_codec, available_codecs, detect_data_codec
+from discard.ratelimit import RateLimiter
+from discard.jobs import JobQueue
+from discard.standin import StandIn, SYNTHETIC_GUILD_ID, SYNTHETIC_START
+from discard.discard import find_checkpoint
+from discard.writer import LogWriter, CLOSE
+from discard.metrics import Metrics
 
 # This is set to a valid token for recording cassettes but scrubbed in the repo.
 TEST_TOKEN = 'aa.bb.cc'
@@ -149,6 +167,8 @@ def test_channel(tmp_path, monkeypatch):
         assert obj['run']['finished'] == True
         assert obj['run']['errors'] == False
         assert obj['run']['exception'] == None
+        routes = [route for bucket in obj['rate_limits']['buckets'].values() for route in bucket['routes']]
+        assert 'GET /channels/{channel_id}/messages' in routes
 
     with open(run_directory / 'run.jsonl') as f:
         for line in f:
@@ -161,6 +181,8 @@ def test_channel(tmp_path, monkeypatch):
         assert obj['channel']['id'] == TEST_CHANNEL.id
         assert obj['channel']['name'] == TEST_CHANNEL.name
         assert obj['summary']['num_messages'] > 0
+        assert obj['summary']['num_reaction_requests'] == 1
+        assert obj['summary']['reaction_time'] > 0
     
     fetched_reactions = False
 
@@ -174,6 +196,217 @@ def test_channel(tmp_path, monkeypatch):
     
     assert fetched_reactions
 
+@pytest.mark.asyncio
+@pytest.mark.vcr('test_channel.yaml')
+@pytest.mark.block_network
+def test_channel_raw_responses(tmp_path, monkeypatch):
+    '''Test logging response bodies as they were received.'''
+    discard = Discard(mode="channel", channel_id=TEST_CHANNEL.id, token=TEST_TOKEN, output_dir=tmp_path,
+        raw_responses=True)
+    monkeypatch_discard(monkeypatch, discard)
+
+    discard.run()
+
+    run_directory = list(tmp_path.iterdir())[0]
+
+    with open(run_directory / Path(str(TEST_GUILD.id)) / Path(f"{TEST_CHANNEL.id}.jsonl")) as f:
+        lines = [line for line in f if line.strip()]
+
+    assert lines
+    for line in lines:
+        obj = json.loads(line)
+        assert obj['type'] == 'http'
+        assert list(obj.keys())[-1] == 'response'
+        if obj['request']['url'].endswith('/messages'):
+            assert obj['response']['data'][0]['channel_id'] == str(TEST_CHANNEL.id)
+
+
+@pytest.mark.asyncio
+@pytest.mark.vcr('test_channel.yaml')
+@pytest.mark.block_network
+def test_channel_raw_history(tmp_path, monkeypatch):
+    '''Test paging message history without discord.py objects.'''
+    discard = Discard(mode="channel", channel_id=TEST_CHANNEL.id, token=TEST_TOKEN, output_dir=tmp_path,
+        raw_history=True)
+    monkeypatch_discard(monkeypatch, discard)
+
+    discard.run()
+
+    run_directory = list(tmp_path.iterdir())[0]
+    path = str(run_directory / Path(str(TEST_GUILD.id)) / Path(f"{TEST_CHANNEL.id}"))
+    with open(path + '.meta.json') as f:
+        meta = json.load(f)
+
+    messages = list(reader.read_message_data(path, meta))
+    assert meta['summary']['num_messages'] == len(messages) > 0
+    assert meta['summary']['oldest_message']['id'] == int(messages[0]['id'])
+    assert meta['summary']['newest_message']['id'] == int(messages[-1]['id'])
+    assert meta['summary']['num_reaction_requests'] == sum(len(message.get('reactions', []))
+                                                            for message in messages)
+
+
+@pytest.mark.asyncio
+@pytest.mark.vcr('test_channel.yaml')
+@pytest.mark.block_network
+def test_channel_metrics(tmp_path, monkeypatch):
+    '''Test recording latencies, bytes and throughput, and exporting them for Prometheus.'''
+    discard = Discard(mode="channel", channel_id=TEST_CHANNEL.id, token=TEST_TOKEN, output_dir=tmp_path / 'out',
+                        metrics_file=tmp_path / 'discard.prom')
+    monkeypatch_discard(monkeypatch, discard)
+
+    discard.run()
+
+    run_directory = list((tmp_path / 'out').iterdir())[0]
+    channel_file = f'{TEST_GUILD.id}/{TEST_CHANNEL.id}.jsonl'
+    with open(run_directory / 'run.meta.json') as f:
+        metrics = json.load(f)['metrics']
+        latency = metrics['http_latency']['GET /channels/{channel_id}/messages']
+        assert latency['count'] > 0
+        assert latency['buckets']['+Inf'] == latency['count']
+        assert metrics['files'][channel_file]['num_bytes'] == metrics['files'][channel_file]['disk_bytes']
+        assert metrics['num_reaction_requests'] == 1
+
+    with open(run_directory / f'{TEST_GUILD.id}/{TEST_CHANNEL.id}.meta.json') as f:
+        metrics = json.load(f)['metrics']
+        assert metrics['messages_per_second'] > 0
+        assert metrics['num_bytes'] == (run_directory / channel_file).stat().st_size
+
+    text = (tmp_path / 'discard.prom').read_text()
+    assert 'discard_http_request_duration_seconds_bucket{route="GET /channels/{channel_id}/messages",le="+Inf"}' in text
+    assert 'discard_finished 1' in text
+
+def test_metrics_rotate_log_file(tmp_path):
+    '''Test that rotated files are counted per channel, not tracked one by one.'''
+    writer = LogWriter()
+    metrics = Metrics()
+    for hour in range(3):
+        log_file = writer.open(open(tmp_path / f'{hour}.jsonl', 'w'))
+        metrics.add_log_file(f'1/2.{hour}.jsonl', log_file, key='1/2')
+        log_file.write('{"type": "ws", "d": "é"}\n')
+        log_file.close()
+        if hour < 2:
+            metrics.rotate_log_file(f'1/2.{hour}.jsonl')
+    writer.close()
+
+    assert list(metrics.log_files) == ['1/2.2.jsonl']
+    assert metrics.key_bytes('1/2') == 3 * 26
+    assert metrics.json()['files'] == {'1/2.2.jsonl': {'num_bytes': 26}, '1/2': {'num_bytes': 2 * 26}}
+    assert metrics.prometheus({}, {}).count('discard_log_bytes_total{') == 2
+
+@pytest.mark.asyncio
+@pytest.mark.vcr('test_channel.yaml')
+@pytest.mark.block_network
+def test_channel_seekable(tmp_path, monkeypatch):
+    '''Test writing channel logs in indexed gzip blocks.'''
+    discard = Discard(mode="channel", channel_id=TEST_CHANNEL.id, token=TEST_TOKEN, output_dir=tmp_path,
+        gzip=True, seekable=True)
+    monkeypatch_discard(monkeypatch, discard)
+
+    discard.run()
+
+    run_directory = list(tmp_path.iterdir())[0]
+    channel_path = run_directory / Path(str(TEST_GUILD.id)) / Path(str(TEST_CHANNEL.id))
+    index = reader.read_index(str(channel_path) + '.jsonl')
+
+    assert index['codec'] == 'gzip'
+    assert len(index['blocks']) == 1
+    assert index['blocks'][0]['first_message'] < index['blocks'][0]['last_message']
+    assert "Hello this is a message today" in reader.render_chat(str(channel_path),
+        after=index['blocks'][0]['first_message'] - 1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.vcr('test_channel.yaml')
+@pytest.mark.block_network
+@pytest.mark.parametrize('codec,seekable', [('bz2', False), ('lzma:1', True)])
+def test_channel_codec(tmp_path, monkeypatch, codec, seekable):
+    '''Test saving logs with other codecs and reading them back.'''
+    discard = Discard(mode="channel", channel_id=TEST_CHANNEL.id, token=TEST_TOKEN, output_dir=tmp_path,
+        codec=codec, seekable=seekable)
+    monkeypatch_discard(monkeypatch, discard)
+
+    discard.run()
+
+    run_directory = list(tmp_path.iterdir())[0]
+    with open(run_directory / 'run.meta.json') as f:
+        assert json.load(f)['settings']['codec'] == str(get_codec(codec))
+
+    channel_path = run_directory / Path(str(TEST_GUILD.id)) / Path(str(TEST_CHANNEL.id))
+    suffix = get_codec(codec).suffix
+    assert (run_directory / f'run.jsonl{suffix}').exists()
+    assert Path(f'{channel_path}.jsonl{suffix}').exists()
+    assert "Hello this is a message today" in reader.render_chat(str(channel_path), after=1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.vcr('test_channel.yaml')
+@pytest.mark.block_network
+def test_incremental(tmp_path, monkeypatch):
+    '''Test recording the newest archived message for incremental runs.'''
+    discard = Discard(mode="channel", channel_id=TEST_CHANNEL.id, token=TEST_TOKEN, output_dir=tmp_path,
+        incremental=True)
+    monkeypatch_discard(monkeypatch, discard)
+
+    discard.run()
+
+    run_directory = [path for path in tmp_path.iterdir() if path.is_dir()][0]
+    assert not run_directory.name.endswith('_full')
+
+    with open(run_directory / Path(str(TEST_GUILD.id)) / Path(f"{TEST_CHANNEL.id}.meta.json")) as f:
+        newest_message_id = json.load(f)['summary']['newest_message']['id']
+
+    with open(tmp_path / 'state.json') as f:
+        obj = json.load(f)
+        assert obj['channels'][str(TEST_CHANNEL.id)]['newest_message'] == newest_message_id
+        assert obj['channels'][str(TEST_CHANNEL.id)]['run_directory'] == run_directory.name
+
+    # The next run continues after the newest message
+    discard = Discard(mode="channel", channel_id=TEST_CHANNEL.id, token=TEST_TOKEN, output_dir=tmp_path,
+        incremental=True)
+    discard.state = discard.read_state()
+    after, before = discard.channel_range(TEST_CHANNEL)
+    assert after.id == newest_message_id
+    assert before is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.vcr('test_channel.yaml')
+@pytest.mark.block_network
+def test_find_checkpoint(tmp_path, monkeypatch):
+    '''Test finding where to resume an interrupted channel log.'''
+    discard = Discard(mode="channel", channel_id=TEST_CHANNEL.id, token=TEST_TOKEN, output_dir=tmp_path)
+    monkeypatch_discard(monkeypatch, discard)
+
+    discard.run()
+
+    run_directory = list(tmp_path.iterdir())[0]
+    log_path = run_directory / Path(str(TEST_GUILD.id)) / Path(f"{TEST_CHANNEL.id}.jsonl")
+
+    with open(run_directory / Path(str(TEST_GUILD.id)) / Path(f"{TEST_CHANNEL.id}.meta.json")) as f:
+        summary = json.load(f)['summary']
+
+    checkpoint = find_checkpoint(log_path, TEST_CHANNEL.id)
+    assert checkpoint['num_messages'] == summary['num_messages']
+    assert checkpoint['newest_message'] == summary['newest_message']['id']
+    assert checkpoint['num_reaction_requests'] == 1
+
+    # Interrupted while writing the reaction request, so the page isn't complete
+    with open(log_path) as f:
+        lines = f.readlines()
+    with open(log_path, 'w') as f:
+        f.write(lines[0])
+        f.write(lines[1][:len(lines[1]) // 2])
+
+    assert find_checkpoint(log_path, TEST_CHANNEL.id) is None
+
+
+def test_resume_completed(tmp_path):
+    '''Test that completed runs aren't resumed.'''
+    with pytest.raises(RuntimeError):
+        Discard(mode="guild", guild_id=TEST_GUILD.id, token=TEST_TOKEN, output_dir=tmp_path,
+            resume='example/20210201T174740_guild').start()
+
+
 @pytest.mark.asyncio
 @pytest.mark.vcr
 @pytest.mark.block_network
@@ -215,6 +448,127 @@ def test_channels(tmp_path, monkeypatch):
                     assert obj['type'] in ['http', 'ws']
 
 
+@pytest.mark.asyncio
+@pytest.mark.vcr('test_channels.yaml')
+@pytest.mark.block_network
+def test_channels_concurrent(tmp_path, monkeypatch):
+    '''Test archiving multiple channels at once.'''
+    discard = Discard(mode="channel", channel_id=[TEST_CHANNEL.id, TEST_CHANNEL2.id], token=TEST_TOKEN, output_dir=tmp_path,
+        concurrency=2)
+    monkeypatch_discard(monkeypatch, discard)
+
+    discard.run()
+
+    run_directory = list(tmp_path.iterdir())[0]
+
+    num_messages = 0
+    for test_channel in [TEST_CHANNEL, TEST_CHANNEL2]:
+        with open(run_directory / Path(str(TEST_GUILD.id)) / Path(f"{test_channel.id}.meta.json")) as f:
+            obj = json.load(f)
+            assert obj['summary']['num_messages'] > 0
+            num_messages += obj['summary']['num_messages']
+
+        # Each channel's requests must only end up in its own file
+        with open(run_directory / Path(str(TEST_GUILD.id)) / Path(f"{test_channel.id}.jsonl")) as f:
+            for line in f:
+                if line.strip():
+                    obj = json.loads(line)
+                    if obj['type'] == 'http':
+                        assert f'/channels/{test_channel.id}/' in obj['request']['url']
+
+    with open(run_directory / 'run.meta.json') as f:
+        obj = json.load(f)
+        assert obj['settings']['concurrency'] == 2
+        assert obj['run']['completed'] == True
+        assert obj['summary']['num_messages'] == num_messages
+
+
+@pytest.mark.asyncio
+@pytest.mark.vcr('test_channel.yaml')
+@pytest.mark.block_network
+def test_worker(tmp_path, monkeypatch, capsys):
+    '''Test archiving a channel from the job queue.'''
+    jobs = JobQueue(tmp_path / 'jobs.sqlite')
+    assert jobs.enqueue('channel', TEST_CHANNEL.id)
+    assert not jobs.enqueue('channel', TEST_CHANNEL.id)
+    jobs.close()
+
+    discard = Discard(mode="worker", token=TEST_TOKEN, output_dir=tmp_path)
+    monkeypatch_discard(monkeypatch, discard)
+
+    discard.run()
+
+    run_directory = [path for path in tmp_path.iterdir() if path.is_dir()][0]
+    with open(run_directory / 'run.meta.json') as f:
+        obj = json.load(f)
+        assert obj['settings']['mode'] == 'worker'
+        assert obj['run']['completed'] == True
+        assert obj['summary']['num_jobs'] == 1
+        assert obj['summary']['num_messages'] > 0
+
+    jobs = JobQueue(tmp_path / 'jobs.sqlite')
+    assert jobs.counts() == {'done': 1}
+    jobs.close()
+
+    capsys.readouterr()
+    reader.summary(tmp_path, as_json=True)
+    summary = json.loads(capsys.readouterr().out)
+    assert summary['num_runs'] == 1
+    assert str(TEST_CHANNEL.id) in json.dumps(summary)
+
+@pytest.mark.asyncio
+def test_worker_guild(tmp_path):
+    '''Test that a worker taking a guild queues its channels and archives them.'''
+    standin = StandIn(num_channels=2, num_messages=10)
+    jobs = JobQueue(tmp_path / 'jobs.sqlite')
+    jobs.enqueue('guild', SYNTHETIC_GUILD_ID)
+    jobs.close()
+
+    process, url = standin.start_process()
+    try:
+        with benchmark.api_base(url):
+            discard = Discard(mode="worker", token='standin', output_dir=tmp_path)
+            discard.client._connection.guild_ready_timeout = 0.1
+            discard.run()
+    finally:
+        process.terminate()
+        process.join()
+
+    guild_path = discard.output_directory / str(SYNTHETIC_GUILD_ID)
+    with open(guild_path / 'guild.meta.json') as f:
+        # The messages are counted by the channels, wherever they were archived
+        assert json.load(f)['summary'] == {'num_channels': 2, 'queued': True}
+    for channel_id in standin.channel_ids:
+        with open(guild_path / f'{channel_id}.meta.json') as f:
+            assert json.load(f)['summary']['num_messages'] == 10
+
+def test_job_queue(tmp_path):
+    '''Test leasing jobs, and taking over jobs whose lease expired.'''
+    jobs = JobQueue(tmp_path / 'jobs.sqlite', lease_time=0.2)
+    jobs.enqueue('guild', 1)
+    jobs.enqueue('channel', 2, guild_id=1)
+
+    job = jobs.lease('a')
+    assert (job['type'], job['target_id']) == ('guild', 1)
+    assert jobs.lease('b')['target_id'] == 2
+    assert jobs.lease('b') is None
+    assert jobs.num_pending() == 2
+
+    # The lease of a is renewed, b dies and its lease expires
+    time.sleep(0.1)
+    assert jobs.renew(job, 'a')
+    time.sleep(0.15)
+    job = jobs.lease('c')
+    assert job['target_id'] == 2 and job['attempts'] == 2
+    assert not jobs.renew(job, 'b')
+
+    jobs.complete(job, 'c', 'run')
+    assert jobs.num_pending() == 1
+    # Done jobs can be queued again, leased ones not
+    assert jobs.enqueue('channel', 2)
+    assert not jobs.enqueue('guild', 1)
+    jobs.close()
+
 @pytest.mark.asyncio
 @pytest.mark.vcr
 @pytest.mark.block_network
@@ -237,6 +591,110 @@ def test_gzip(tmp_path, monkeypatch):
                 obj = json.loads(line)
                 assert obj['type'] in ['http', 'ws']
 
+def test_partition_channel(tmp_path):
+    '''Test splitting a channel into consecutive snowflake ranges.'''
+    after = datetime.datetime(2021, 1, 1)
+    before = datetime.datetime(2021, 2, 1)
+    discard = Discard(mode="channel", channel_id=TEST_CHANNEL.id, token=TEST_TOKEN, output_dir=tmp_path,
+        after=after, before=before, partitions=4)
+
+    ranges = discard.client.partition_channel(TEST_CHANNEL)
+
+    assert len(ranges) == 4
+    assert ranges[0][0] == after
+    assert ranges[-1][1] == before
+    for (_, range_before), (range_after, _) in zip(ranges, ranges[1:]):
+        # Every snowflake must fall into exactly one range
+        assert range_after.id == range_before.id - 1
+        assert after < range_before.created_at < before
+
+@pytest.mark.asyncio
+def test_partition_channel_codec(tmp_path):
+    '''Test archiving a channel in compressed partitions from the stand-in.'''
+    standin = StandIn(num_channels=1, num_messages=300)
+    process, url = standin.start_process()
+    try:
+        with benchmark.api_base(url):
+            discard = Discard(token='standin', mode='channel', channel_id=standin.channel_ids, output_dir=tmp_path,
+                after=SYNTHETIC_START - datetime.timedelta(days=1), before=SYNTHETIC_START + datetime.timedelta(hours=6),
+                partitions=3, codec='gzip')
+            discard.client._connection.guild_ready_timeout = 0.1
+            discard.run()
+    finally:
+        process.terminate()
+        process.join()
+
+    channel_id = standin.channel_ids[0]
+    channel_path = discard.output_directory / str(SYNTHETIC_GUILD_ID) / str(channel_id)
+    with open(str(channel_path) + '.meta.json') as f:
+        meta = json.load(f)
+
+    assert [segment['file'] for segment in meta['segments']] == \
+        [f'{channel_id}.jsonl.gz', f'{channel_id}.1.jsonl.gz', f'{channel_id}.2.jsonl.gz']
+    for segment in meta['segments']:
+        assert (channel_path.parent / segment['file']).exists()
+    assert len(list(reader.read_message_data(str(channel_path), meta))) == 300
+
+@pytest.mark.asyncio
+def test_resume_segments(tmp_path):
+    '''Test resuming a partitioned channel twice, keeping what every file archived.'''
+    standin = StandIn(num_channels=1, num_messages=300)
+    channel_id = standin.channel_ids[0]
+    process, url = standin.start_process()
+
+    def archive(**kwargs):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        discard = Discard(token='standin', mode='channel', channel_id=standin.channel_ids, output_dir=tmp_path,
+            after=SYNTHETIC_START - datetime.timedelta(minutes=1), before=SYNTHETIC_START + datetime.timedelta(minutes=300),
+            **kwargs)
+        discard.client._connection.guild_ready_timeout = 0.1
+        discard.run()
+        return discard.output_directory
+
+    def interrupt(run_path):
+        with open(run_path / 'run.meta.json') as f:
+            meta = json.load(f)
+        meta['run']['completed'] = False
+        with open(run_path / 'run.meta.json', 'w') as f:
+            json.dump(meta, f)
+        (run_path / str(SYNTHETIC_GUILD_ID) / f'{channel_id}.meta.json').unlink()
+
+    def read(run_path):
+        channel_path = str(run_path / str(SYNTHETIC_GUILD_ID) / str(channel_id))
+        with open(channel_path + '.meta.json') as f:
+            meta = json.load(f)
+        return meta, [int(message['id']) for message in reader.read_message_data(channel_path, meta)]
+
+    try:
+        with benchmark.api_base(url):
+            run_path = archive(partitions=3)
+            # The second partition only got as far as its first page, without its reactions
+            interrupt(run_path)
+            partition_path = run_path / str(SYNTHETIC_GUILD_ID) / f'{channel_id}.1.jsonl'
+            partition_path.write_text(partition_path.read_text().splitlines(keepends=True)[0])
+
+            archive(resume=run_path)
+            meta, message_ids = read(run_path)
+            files = [segment['file'] for segment in meta['segments'] if segment['num_messages']]
+
+            assert files[0] == f'{channel_id}.jsonl'
+            assert f'{channel_id}.2.jsonl' in files
+            assert f'{channel_id}.1.jsonl' not in files
+            assert meta['summary']['num_messages'] == 300
+            assert message_ids == sorted(set(message_ids)) and len(message_ids) == 300
+
+            # Resumed again, everything archived by the first resume is kept
+            interrupt(run_path)
+            archive(resume=run_path)
+            meta, message_ids = read(run_path)
+
+            assert set(files) <= set(segment['file'] for segment in meta['segments'])
+            assert meta['summary']['num_messages'] == 300
+            assert message_ids == sorted(set(message_ids)) and len(message_ids) == 300
+    finally:
+        process.terminate()
+        process.join()
+
 def test_reader(capsys):
     reader.read_chat('example/20210201T174740_guild/805808489695150180/805808489695150183')
 
@@ -245,9 +703,629 @@ def test_reader(capsys):
     assert 'general' in captured.out
     assert 'message' in captured.out
 
+def test_reader_objects(capsys):
+    '''Test that reading with and without discord.py objects gives the same output.'''
+    path = 'example/20210201T174740_guild/805808489695150180/805808489695150183'
+    reader.read_chat(path)
+    records_output = capsys.readouterr().out
+    reader.read_chat(path, objects=True)
+    objects_output = capsys.readouterr().out
+
+    assert records_output == objects_output
+
+def test_reader_synthetic(tmp_path, capsys):
+    path = benchmark.write_synthetic_channel(tmp_path, 250, gzip_compress=True)
+    reader.read_chat(path)
+
+    captured = capsys.readouterr()
+
+    assert len(captured.out.splitlines()) == 251
+    assert 'synthetic message number 249,' in captured.out
+
+def test_reader_seek(tmp_path):
+    '''Test reading a time range from an indexed log.'''
+    path = benchmark.write_synthetic_channel(tmp_path, 1000, gzip_compress=True)
+    with gzip.open(path + '.jsonl.gz') as f:
+        content = f.read()
+
+    full = reader.render_chat(path).splitlines()
+    after = reader.time_snowflake(datetime.datetime(2017, 4, 16, 3, 0), high=True)
+    before = reader.time_snowflake(datetime.datetime(2017, 4, 16, 5, 0))
+    expected = full[:1] + full[1 + 3*60 + 1:1 + 5*60]
+
+    assert reader.render_chat(path, after=after, before=before).splitlines() == expected
+
+    reader.reindex_log(path + '.jsonl.gz', block_size=1024)
+    index = reader.read_index(path + '.jsonl')
+
+    assert len(index['blocks']) == 10
+    with gzip.open(path + '.jsonl.gz') as f:
+        assert f.read() == content
+    assert reader.render_chat(path, after=after, before=before).splitlines() == expected
+    assert reader.render_chat(path).splitlines() == full
+
+def test_iter_messages(tmp_path, monkeypatch):
+    path = benchmark.write_synthetic_channel(tmp_path, 1000, gzip_compress=True)
+
+    assert [len(page) for page in reader.iter_pages(path + '.jsonl.gz')] == [100] * 10
+    assert [message.id for message in reader.iter_messages(tmp_path)] == \
+        [message.id for message in reader.iter_messages(path)]
+
+    # Only the pages overlapping the range are parsed
+    loads = json.loads
+    parsed = []
+    def count_loads(data, *args, **kwargs):
+        if isinstance(data, bytes):
+            parsed.append(data)
+        return loads(data, *args, **kwargs)
+    monkeypatch.setattr(reader.json, 'loads', count_loads)
+
+    messages = list(reader.iter_messages(path, after=datetime.datetime(2017, 4, 16, 3, 0),
+        before=datetime.datetime(2017, 4, 16, 5, 0)))
+
+    assert len(messages) == 2*60 - 1
+    assert all(datetime.datetime(2017, 4, 16, 3, 0) < message.created_at < datetime.datetime(2017, 4, 16, 5, 0)
+        for message in messages)
+    # The page after the range is only known to start after 4:59, which is still within it
+    assert len(parsed) == 3
+
+def test_iter_messages_filters():
+    messages = list(reader.iter_messages('example', channel='general', author='Sanqui#3248'))
+
+    assert len(messages) == 4
+    assert all(message.author == 'Sanqui#3248' for message in messages)
+    assert [message.id for message in reader.iter_messages('example', author=messages[0].data['author']['id'])] == \
+        [message.id for message in reader.iter_messages('example', author='Sanqui#3248')]
+    assert list(reader.iter_messages('example', author='nobody#0000')) == []
+    assert list(reader.iter_messages('example', channel='805808821749415946'))[0].content == 'This is a second channel.'
+
+def test_search(tmp_path, capsys):
+    '''Test indexing overlapping runs and searching them.'''
+    shutil.copytree('example/20210201T174740_guild', tmp_path / '20210201T174740_guild')
+    shutil.copytree('example/20210201T174740_guild', tmp_path / '20210202T174740_guild')
+
+    search.index(tmp_path)
+    search.index(tmp_path)
+    captured = capsys.readouterr()
+
+    assert captured.out.splitlines() == ["Indexed 12 messages in 4 channels", "Indexed 0 messages in 0 channels"]
+
+    database = tmp_path / search.INDEX_FILENAME
+    results = list(search.search_messages(database, 'message'))
+    assert len(results) == 4
+    assert len(set(results)) == 4
+
+    results = list(search.search_messages(database, 'reaction', channel='general', author='Sanqui#3248'))
+    assert [content for message_id, channel, author, content in results] == ["This message will have a reaction."]
+    assert not list(search.search_messages(database, 'message', channel='test'))
+    assert not list(search.search_messages(database, 'message', before=805808565507457035))
+
+def test_compact(tmp_path, capsys):
+    '''Test merging overlapping runs with an edited message.'''
+    shutil.copytree('example/20210201T174740_guild', tmp_path / '20210201T174740_guild')
+    shutil.copytree('example/20210201T174740_guild', tmp_path / '20210202T174740_guild')
+    with open(tmp_path / '20210202T174740_guild' / 'run.meta.json') as f:
+        meta = json.load(f)
+    meta['run']['datetime_start'] = '2021-02-02T17:47:40.375815+00:00'
+    with open(tmp_path / '20210202T174740_guild' / 'run.meta.json', 'w') as f:
+        json.dump(meta, f)
+    channel_log = tmp_path / '20210202T174740_guild' / str(TEST_GUILD.id) / f'{TEST_CHANNEL.id}.jsonl'
+    channel_log.write_text(channel_log.read_text().replace("This message was edited.", "Edited again."))
+
+    compact.compact(tmp_path)
+    capsys.readouterr()
+
+    compacted_path = tmp_path / compact.COMPACTED_DIRECTORY / str(TEST_GUILD.id) / str(TEST_CHANNEL.id)
+    records = list(reader.read_log(str(compacted_path) + '.jsonl'))
+
+    assert len(records) == 5
+    assert [int(record['data']['id']) for record in records] == sorted(int(record['data']['id']) for record in records)
+    assert all(record['runs'] == ['20210201T174740_guild', '20210202T174740_guild'] for record in records)
+    edited = [record for record in records if 'versions' in record]
+    assert len(edited) == 1
+    assert edited[0]['data']['content'] == "Edited again."
+    assert edited[0]['versions'][0]['data']['content'] == "This message was edited."
+    assert edited[0]['versions'][0]['run'] == '20210201T174740_guild'
+
+    original = reader.render_chat(str(tmp_path / '20210202T174740_guild' / str(TEST_GUILD.id) / str(TEST_CHANNEL.id)))
+    assert reader.render_chat(str(compacted_path)) == original
+
+def test_read_chats_jobs(capsys):
+    '''Test that reading multiple channels in a process pool keeps the order.'''
+    paths = ['example/20210201T174740_guild/805808489695150180/805808489695150183',
+             'example/20210201T174740_guild/805808489695150180/805808821749415946']
+    reader.read_chats(paths)
+    serial_output = capsys.readouterr().out
+    reader.read_chats(paths, jobs=2)
+    parallel_output = capsys.readouterr().out
+
+    assert serial_output == parallel_output
+    assert serial_output.index('general') < serial_output.index('test')
+
+def test_read_directory_jobs():
+    '''Test reading all channels of a directory of runs from the command line.'''
+    runner = CliRunner()
+    serial = runner.invoke(cli, ['read', 'example'])
+    parallel = runner.invoke(cli, ['read', 'example', '-j', '2'])
+    channel = runner.invoke(cli, ['read', 'example/20210201T174740_guild/805808489695150180/805808821749415946.jsonl'])
+
+    assert serial.exit_code == parallel.exit_code == channel.exit_code == 0
+    assert serial.output == parallel.output
+    assert serial.output.index('general') < serial.output.index('Channel test')
+    assert channel.output.startswith('Channel test')
+    assert runner.invoke(cli, ['read', 'example/missing']).exit_code == 2
+
+def test_read_chunks_jobs(tmp_path, monkeypatch, capsys):
+    '''Test that a large channel read in chunks in a process pool comes out whole and in order.'''
+    monkeypatch.setattr(reader, 'READ_CHUNK_MESSAGES', 100)
+    path = benchmark.write_synthetic_channel(tmp_path / 'run', 1000)
+    assert len(reader.chat_chunks(path)) == 10
+
+    paths = reader.channel_paths(str(tmp_path / 'run'))
+    reader.read_chats(paths)
+    serial_output = capsys.readouterr().out
+    reader.read_chats(paths, jobs=2)
+    parallel_output = capsys.readouterr().out
+
+    assert serial_output == parallel_output
+    assert serial_output.count('Channel synthetic') == 1
+    assert len(serial_output.splitlines()) == 1001
+
 def test_summary(capsys):
     reader.summary('example/20210201T174740_guild')
 
     captured = capsys.readouterr()
 
     assert str(TEST_GUILD.id) in captured.out
+
+def test_summary_cache(tmp_path, capsys, monkeypatch):
+    '''Test that cached runs are not read again.'''
+    shutil.copytree('example/20210201T174740_guild', tmp_path / '20210201T174740_guild')
+    reader.summary(tmp_path, as_json=True)
+    uncached_output = capsys.readouterr().out
+    reader.summary(tmp_path, as_json=True, cache=True)
+    capsys.readouterr()
+
+    assert (tmp_path / reader.SUMMARY_CACHE_FILENAME).exists()
+
+    def read_run(path):
+        raise AssertionError("Cached run read again")
+    monkeypatch.setattr(reader, 'read_run', read_run)
+    reader.summary(tmp_path, as_json=True, cache=True)
+
+    assert capsys.readouterr().out == uncached_output
+    with pytest.raises(AssertionError):
+        reader.summary(tmp_path, as_json=True, cache=True, rebuild_cache=True)
+
+def test_summary_cache_channel_meta(tmp_path, capsys):
+    '''Test that a run is read again when the meta file of one of its channels changes.'''
+    shutil.copytree('example/20210201T174740_guild', tmp_path / '20210201T174740_guild')
+    reader.summary(tmp_path, as_json=True, cache=True)
+    assert json.loads(capsys.readouterr().out)['guilds']['805808489695150180']['channels']['805808821749415946']['name'] == 'test'
+
+    meta_path = tmp_path / '20210201T174740_guild/805808489695150180/805808821749415946.meta.json'
+    meta = json.load(open(meta_path))
+    meta['channel']['name'] = 'renamed'
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    reader.summary(tmp_path, as_json=True, cache=True)
+
+    assert json.loads(capsys.readouterr().out)['guilds']['805808489695150180']['channels']['805808821749415946']['name'] == 'renamed'
+
+def test_summary_cache_unwritable(tmp_path, capsys):
+    '''Test that the summary is only cached on request, and read without a cache where it can't be written.'''
+    shutil.copytree('example/20210201T174740_guild', tmp_path / '20210201T174740_guild')
+    result = CliRunner().invoke(cli, ['summary', str(tmp_path), '--json'])
+    assert result.exit_code == 0
+    assert not (tmp_path / reader.SUMMARY_CACHE_FILENAME).exists()
+
+    # Writing the temporary file fails where a directory is in its way
+    (tmp_path / (reader.SUMMARY_CACHE_FILENAME + '.tmp')).mkdir()
+    reader.summary(tmp_path, as_json=True, cache=True)
+
+    assert capsys.readouterr().out == result.output
+    assert not (tmp_path / reader.SUMMARY_CACHE_FILENAME).exists()
+
+def test_benchmark_archive(tmp_path):
+    '''Test archiving a guild from the stand-in for the Discord API.'''
+    standin = StandIn(num_channels=2, num_messages=250, reaction_density=0.1, rate_limit=5, rate_limit_window=0.05)
+    results = benchmark.benchmark_archive(standin, tmp_path, concurrency=2)
+
+    assert results['archive']['num_messages'] == 500
+    # Two channels of three pages, with 25 reactions each, and the guild
+    assert results['archive']['num_requests'] >= 2 * (3 + 25) + 5
+    assert results['archive']['bytes_written'] > 0
+    assert results['read']['messages_per_second'] > 0
+
+    run_path = [path for path in tmp_path.iterdir() if path.is_dir()][0]
+    with open(run_path / str(SYNTHETIC_GUILD_ID) / 'guild.meta.json') as f:
+        assert json.load(f)['summary']['num_channels'] == 2
+
+@pytest.mark.asyncio
+def test_guild_concurrency(tmp_path):
+    '''Test archiving multiple guilds at once, each into its own files.'''
+    standin = StandIn(num_guilds=3, num_channels=2, num_messages=150, rate_limit=5, rate_limit_window=0.05)
+    results = benchmark.benchmark_archive(standin, tmp_path, concurrency=3, guild_concurrency=3)
+
+    assert results['archive']['num_messages'] == 3 * 2 * 150
+    run_path = [path for path in tmp_path.iterdir() if path.is_dir()][0]
+    for guild_id in standin.guild_ids:
+        with open(run_path / str(guild_id) / 'guild.meta.json') as f:
+            assert json.load(f)['summary'] == {'num_channels': 2, 'num_messages': 2 * 150}
+        for record in reader.read_log(run_path / str(guild_id) / 'guild.jsonl'):
+            if record['type'] == 'http':
+                assert str(guild_id) in record['request']['url']
+
+@pytest.mark.asyncio
+def test_http_only(tmp_path):
+    '''Test archiving guilds without connecting to the gateway.'''
+    standin = StandIn(num_guilds=2, num_channels=2, num_messages=50)
+    results = benchmark.benchmark_archive(standin, tmp_path, http_only=True)
+
+    assert results['archive']['num_messages'] == 2 * 2 * 50
+    assert results['archive']['num_ws_connections'] == 0
+    assert results['archive']['startup_time'] is not None
+
+@pytest.mark.asyncio
+def test_live(tmp_path, monkeypatch):
+    '''Test following guilds, and fetching the history missed while reconnecting.'''
+    standin = StandIn(num_channels=2, num_messages=10, num_live_messages=4)
+    process, url = standin.start_process()
+    try:
+        with benchmark.api_base(url):
+            discard = Discard(token='standin', mode='live', guild_id=standin.guild_ids, output_dir=tmp_path,
+                                duration=1.5, rotate_interval=10**9) # Never rotated during the test
+            discard.client._connection.guild_ready_timeout = 0.1
+
+            async def before_identify_hook(shard_id, initial=False):
+                # discord.py waits five seconds before logging in again
+                pass
+            monkeypatch.setattr(discard.client, 'before_identify_hook', before_identify_hook)
+
+            discard.run()
+    finally:
+        process.terminate()
+        process.join()
+
+    run_path = discard.output_directory
+    with open(run_path / 'run.meta.json') as f:
+        summary = json.load(f)['summary']
+    # Two messages and an edit in every channel, then all four fetched after the reconnect
+    assert summary['num_live_events'] == 2 * 3
+    assert summary['num_backfills'] == 2
+    assert summary['num_backfilled_messages'] == 2 * 4
+
+    for channel_id in standin.channel_ids:
+        paths = list((run_path / str(SYNTHETIC_GUILD_ID)).glob(f'{channel_id}.*.jsonl'))
+        assert len(paths) == 1
+        events, backfilled_ids = [], set()
+        for record in reader.read_log(paths[0]):
+            if record['type'] == 'ws':
+                events.append(record['data']['t'])
+                assert record['data']['d']['channel_id'] == str(channel_id)
+            else:
+                backfilled_ids.update(int(message['id']) for message in record['response']['data'])
+        assert events == ['MESSAGE_CREATE', 'MESSAGE_CREATE', 'MESSAGE_UPDATE']
+        assert len(backfilled_ids) == 4
+
+def test_codecs():
+    data = b'{"type": "http"}\n' * 100
+    for name in available_codecs():
+        codec = get_codec(name)
+        compressed = codec.compress(data) + codec.compress(data)
+        assert type(detect_data_codec(compressed)) == type(codec)
+        assert detect_data_codec(compressed).decompress(compressed[:len(compressed)//2]) == data
+
+    assert get_codec('gzip:1').level == 1
+    with pytest.raises(ValueError):
+        get_codec('gzip:10')
+    with pytest.raises(ValueError):
+        get_codec('rar')
+
+@pytest.mark.asyncio
+async def test_rate_limiter():
+    '''Test scheduling requests against a local server which enforces a rate limit.'''
+    limit, window = 3, 0.2
+    server_state = {'remaining': 0, 'reset': 0, 'num_rate_limited': 0}
+
+    async def handler(request):
+        now = time.monotonic()
+        if now >= server_state['reset']:
+            server_state['remaining'] = limit
+            server_state['reset'] = now + window
+        headers = {
+            'X-RateLimit-Bucket': 'messages',
+            'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Reset-After': f"{server_state['reset'] - now:.3f}",
+            'Via': '1.1 google'
+        }
+        if server_state['remaining'] == 0:
+            server_state['num_rate_limited'] += 1
+            headers['X-RateLimit-Remaining'] = '0'
+            return web.json_response({'retry_after': (server_state['reset'] - now) * 1000, 'global': False},
+                status=429, headers=headers)
+        server_state['remaining'] -= 1
+        headers['X-RateLimit-Remaining'] = str(server_state['remaining'])
+        return web.json_response([], headers=headers)
+
+    app = web.Application()
+    app.router.add_get('/channels/{channel_id}/messages', handler)
+    server = TestServer(app)
+    await server.start_server()
+
+    rate_limiter = RateLimiter()
+    route = discord.http.Route('GET', '/channels/{channel_id}/messages', channel_id=1)
+
+    async with aiohttp.ClientSession() as session:
+        async def request():
+            await rate_limiter.acquire(route)
+            try:
+                async with session.get(server.make_url('/channels/1/messages')) as response:
+                    rate_limiter.update(route, response.status, response.headers, await response.json())
+            finally:
+                rate_limiter.release(route)
+
+        time_start = time.monotonic()
+        await asyncio.gather(*[request() for i in range(10)])
+        seconds = time.monotonic() - time_start
+    await server.close()
+
+    # Ten requests take four windows of three
+    assert server_state['num_rate_limited'] == 0
+    assert 3 * window <= seconds < 6 * window
+    stats = rate_limiter.json()['messages']
+    assert stats['num_requests'] == 10
+    assert stats['routes'] == ['GET /channels/{channel_id}/messages']
+    assert stats['wait_time'] > 0
+
+@pytest.mark.asyncio
+async def test_rate_limiter_cancel():
+    '''Test that a probe cancelled while waiting out the global limit doesn't hold up the route.'''
+    rate_limiter = RateLimiter()
+    route = discord.http.Route('GET', '/channels/{channel_id}/messages', channel_id=1)
+    rate_limiter.global_reset = time.monotonic() + 60
+
+    probe = asyncio.ensure_future(rate_limiter.acquire(route))
+    waiting = asyncio.ensure_future(rate_limiter.acquire(route))
+    await asyncio.sleep(0.01)
+    probe.cancel()
+    rate_limiter.global_reset = 0.0
+
+    await asyncio.wait_for(waiting, 1)
+    rate_limiter.release(route)
+    await asyncio.wait_for(rate_limiter.acquire(route), 1)
+
+def test_media_urls():
+    message = {
+        'id': '1', 'content': "", 'channel_id': '2',
+        'author': {'id': '3', 'username': 'User', 'avatar': 'a_abc', 'discriminator': '0001'},
+        'attachments': [{'id': '4', 'filename': 'a.png', 'url': 'https://cdn.discordapp.com/attachments/2/4/a.png'}],
+        'embeds': [{'type': 'image', 'thumbnail': {'url': 'https://example.com/b.png'},
+                    'author': {'name': 'Site', 'url': 'https://example.com/'}}],
+        'reactions': [{'emoji': {'id': '5', 'name': 'custom'}, 'count': 1}, {'emoji': {'id': None, 'name': '👍'}, 'count': 1}]
+    }
+    assert sorted(media.media_urls([message])) == [
+        'https://cdn.discordapp.com/attachments/2/4/a.png',
+        'https://cdn.discordapp.com/avatars/3/a_abc.gif?size=4096',
+        'https://cdn.discordapp.com/emojis/5.png',
+        'https://example.com/b.png'
+    ]
+
+@pytest.mark.asyncio
+async def test_media_scan(tmp_path, monkeypatch):
+    '''Test that reading the logs for media doesn't block the event loop, and that its errors are raised.'''
+    def find_urls(path):
+        for i in range(20):
+            time.sleep(0.01)
+        yield from []
+        raise ValueError("Broken log")
+    monkeypatch.setattr(media, 'find_urls', find_urls)
+    num_ticks = 0
+
+    async def ticker():
+        nonlocal num_ticks
+        while True:
+            num_ticks += 1
+            await asyncio.sleep(0.001)
+
+    ticker_task = asyncio.ensure_future(ticker())
+    try:
+        with pytest.raises(ValueError):
+            await media.download_media(tmp_path, tmp_path / 'media')
+    finally:
+        ticker_task.cancel()
+
+    assert num_ticks > 10
+
+@pytest.mark.asyncio
+async def test_media(tmp_path, monkeypatch):
+    '''Test downloading media from a local server, resuming an interrupted download.'''
+    monkeypatch.setattr(media, 'DOWNLOAD_RETRY_DELAY', 0)
+    content = bytes(range(256)) * 1024
+    ranges = []
+
+    async def handler(request):
+        if request.match_info['name'] == 'missing.png':
+            return web.Response(status=404)
+        if request.match_info['name'] == 'ranged.bin':
+            # A range which wasn't asked for
+            return web.Response(body=content[1:], status=206,
+                headers={'Content-Range': f'bytes 1-{len(content) - 1}/{len(content)}'})
+        if 'Range' in request.headers:
+            start = int(request.headers['Range'][len('bytes='):-1])
+            ranges.append(start)
+            return web.Response(body=content[start:], status=206,
+                headers={'Content-Range': f'bytes {start}-{len(content) - 1}/{len(content)}'})
+        if not ranges and request.match_info['name'] == 'large.bin':
+            # Drop the connection halfway through the first time
+            response = web.StreamResponse(headers={'Content-Length': str(len(content))})
+            await response.prepare(request)
+            await response.write(content[:len(content) // 2])
+            await asyncio.sleep(0.1)
+            request.transport.close()
+            return response
+        return web.Response(body=content)
+
+    app = web.Application()
+    app.router.add_get('/files/{name}', handler)
+    server = TestServer(app)
+    await server.start_server()
+
+    run_path = tmp_path / 'runs' / 'run'
+    (run_path / '1').mkdir(parents=True)
+    (run_path / 'run.meta.json').write_text('{}')
+    urls = [str(server.make_url(f'/files/{name}')) for name in ['large.bin', 'copy.bin', 'missing.png', 'ranged.bin']]
+    # The same file linked twice is downloaded once
+    record = {'type': 'http', 'request': {'url': '/channels/2/messages'}, 'response': {'data': [
+        {'id': str(index), 'attachments': [{'url': url}], 'embeds': []} for index, url in enumerate(urls + urls[:1])]}}
+    (run_path / '1' / '2.jsonl').write_text(json.dumps(record) + '\n')
+
+    try:
+        # The store is kept among the runs, which doesn't make it a run
+        stats = await media.download_media(tmp_path / 'runs', tmp_path / 'runs' / 'media', concurrency=1)
+        stats_again = await media.download_media(tmp_path / 'runs', tmp_path / 'runs' / 'media')
+    finally:
+        await server.close()
+
+    assert ranges and ranges[0] > 0
+    assert stats['num_urls'] == 4
+    assert (stats['num_downloaded'], stats['num_duplicates'], stats['num_resumed'], stats['num_failed']) == (1, 1, 1, 2)
+    # The failed URLs are tried again, the others are skipped
+    assert (stats_again['num_urls'], stats_again['num_skipped'], stats_again['num_failed']) == (4, 2, 2)
+    assert reader.find_runs(tmp_path / 'runs') == [run_path]
+
+    store = media.MediaStore(tmp_path / 'runs' / 'media')
+    assert store.lookup(urls[0]) == store.lookup(urls[1])
+    assert store.lookup(urls[0]).read_bytes() == content
+    assert store.lookup(urls[2]) is None
+    store.close()
+
+def test_coverage():
+    coverage = Coverage([(10, 20), (30, 40), (20, 25), (50, 60)])
+
+    assert list(coverage) == [(10, 25), (30, 40), (50, 60)]
+    assert 24 in coverage and 25 not in coverage and 9 not in coverage
+    assert coverage.gaps(0, 55) == [(0, 10), (25, 30), (40, 50)]
+    assert coverage.gaps(12) == [(25, 30), (40, 50), (60, None)]
+
+    coverage.add(5, 55)
+    assert list(coverage) == [(5, 60)]
+
+def test_plan(tmp_path, capsys):
+    '''Test planning the runs to close a gap between a full and a later run.'''
+    shutil.copytree('example/20210201T174740_guild', tmp_path / '20210201T174740_guild')
+    shutil.copytree('example/20210201T174740_guild', tmp_path / '20210401T000000_guild')
+    with open(tmp_path / '20210401T000000_guild' / 'run.meta.json') as f:
+        meta = json.load(f)
+    meta['client']['version'] = '0.4.0'
+    meta['settings']['after'] = '2021-03-01T00:00:00'
+    meta['run']['datetime_start'] = '2021-04-01T00:00:00+00:00'
+    with open(tmp_path / '20210401T000000_guild' / 'run.meta.json', 'w') as f:
+        json.dump(meta, f)
+    # As if there were no messages in the channels anymore
+    for channel_path in reader.find_channels(tmp_path / '20210401T000000_guild'):
+        with open(channel_path + '.meta.json') as f:
+            channel_meta = json.load(f)
+        channel_meta['summary'] = {'num_messages': 0, 'oldest_message': None, 'newest_message': None}
+        with open(channel_path + '.meta.json', 'w') as f:
+            json.dump(channel_meta, f)
+
+    reader.plan(tmp_path)
+    captured = capsys.readouterr()
+
+    channels = f"{TEST_CHANNEL.id} 805808821749415946"
+    assert captured.out.splitlines() == [
+        f"python -m discard --after 2021-02-01T17:47:40 --before 2021-03-01T00:00:01 channel {channels}",
+        f"python -m discard --after 2021-03-31T23:59:59 channel {channels}"
+    ]
+
+def test_writer(tmp_path):
+    '''Test writing logs from the background thread.'''
+    writer = LogWriter(buffer_size=100, queue_size=10)
+
+    log_files = [writer.open(open(tmp_path / 'a.jsonl', 'w')), writer.open(gzip.open(tmp_path / 'b.jsonl.gz', 'wt'))]
+    for i in range(1000):
+        for log_file in log_files:
+            log_file.write(json.dumps({'i': i}) + '\n')
+    for log_file in log_files:
+        log_file.close()
+    writer.close()
+
+    assert writer.max_queue_depth <= 10
+    with open(tmp_path / 'a.jsonl') as f:
+        assert [json.loads(line)['i'] for line in f] == list(range(1000))
+    with gzip.open(tmp_path / 'b.jsonl.gz', 'rt') as f:
+        assert [json.loads(line)['i'] for line in f] == list(range(1000))
+
+class SlowFile():
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        time.sleep(0.005)
+        self.lines += data.splitlines()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.mark.asyncio
+async def test_writer_back_pressure():
+    '''Test that logging waits for a slow writer without blocking the event loop, and in order.'''
+    writer = LogWriter(buffer_size=0, queue_size=2)
+    file = SlowFile()
+    log_file = writer.open(file)
+    num_ticks = 0
+
+    async def ticker():
+        nonlocal num_ticks
+        while True:
+            num_ticks += 1
+            await asyncio.sleep(0.001)
+
+    async def log(i):
+        await writer.wait_writable()
+        log_file.write(f'{i}\n')
+
+    ticker_task = asyncio.ensure_future(ticker())
+    await asyncio.gather(*[log(i) for i in range(50)])
+    ticker_task.cancel()
+    log_file.close()
+    writer.close()
+
+    assert file.lines == [str(i) for i in range(50)]
+    assert writer.blocked_time > 0
+    assert num_ticks > 10
+
+def test_writer_sync_stopped():
+    '''Test that syncing with a writer thread which stops before getting to it returns.'''
+    writer = LogWriter(buffer_size=0)
+    log_file = writer.open(SlowFile())
+    log_file.write('busy\n')
+    # The thread stops at the close, before the sync queued behind it
+    writer.queue.put((None, CLOSE, None))
+
+    sync_thread = threading.Thread(target=writer.sync, daemon=True)
+    sync_thread.start()
+    sync_thread.join(timeout=5)
+
+    assert not sync_thread.is_alive()
+
+def test_writer_error(tmp_path):
+    '''Test that errors in the writer thread are raised.'''
+    writer = LogWriter(buffer_size=0)
+    log_file = writer.open(open(tmp_path / 'a.jsonl', 'w'))
+    log_file.write(b'not text')
+
+    with pytest.raises(RuntimeError):
+        writer.close()
+
+def test_summary_jobs(capsys):
+    reader.summary('example', as_json=True)
+    serial_output = capsys.readouterr().out
+    reader.summary('example', as_json=True, jobs=2)
+    parallel_output = capsys.readouterr().out
+
+    assert serial_output == parallel_output
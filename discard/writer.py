@@ -0,0 +1,315 @@
+import json
+import time
+import queue
+import asyncio
+import threading
+import collections
+
+WRITER_QUEUE_SIZE = 1000 # Maximum number of records waiting to be written before logging blocks
+SEEK_BLOCK_SIZE = 1024*1024 # Uncompressed size at which seekable logs start a new block
+INDEX_SUFFIX = '.index.json'
+
+# Sentinel put on the queue in place of data to close a file
+CLOSE = object()
+
+
+class LogFile():
+    """A handle for a file written to by a LogWriter.  Only whole records
+    should be written, as they may be buffered before reaching the file."""
+    def __init__(self, writer, file):
+        self.writer = writer
+        self.file = file
+        self.closed = False
+        # Uncompressed, counted by the writer thread as it gets to the records
+        self.num_bytes = 0
+        self.total = None
+
+    def write(self, data, message_range=None):
+        self.writer.put(self, data, message_range)
+
+    def count(self, data):
+        # Most records are ASCII, whose length is known without encoding them
+        num_bytes = len(data) if data.isascii() else len(data.encode('utf-8'))
+        self.num_bytes += num_bytes
+        if self.total is not None:
+            self.total.num_bytes += num_bytes
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.put(self, CLOSE)
+
+
+class ByteCount():
+    """The bytes logged into a group of files, such as those of a channel."""
+    def __init__(self):
+        self.num_bytes = 0
+
+
+def message_range(url, data):
+    """The lowest and highest message ID in a response, if it is a page of messages."""
+    if not url.endswith('/messages') or not isinstance(data, list) or not data:
+        return None
+    message_ids = [int(message['id']) for message in data]
+    return min(message_ids), max(message_ids)
+
+
+def write_index(path, blocks, codec):
+    with open(path, 'w') as f:
+        json.dump({'codec': codec.name if codec else None, 'blocks': blocks}, f, indent=4)
+
+
+class BlockFile():
+    """A log file written in blocks which can be read on their own.  When
+    compressed, every block is compressed separately; concatenated gzip
+    members (or streams of the other codecs) read as one, so the log reads
+    the same as any other.
+
+    When closed, an index with the byte offset, length and range of message
+    IDs of every block is written to `index_path`.  Records must be written
+    whole and with the range of message IDs they contain."""
+    def __init__(self, path, codec=None, block_size=SEEK_BLOCK_SIZE, index_path=True):
+        self.file = open(path, 'wb')
+        self.codec = codec
+        self.block_size = block_size
+        self.index_path = str(path) + INDEX_SUFFIX if index_path is True else index_path
+        self.blocks = []
+        self.block = []
+        self.block_length = 0
+        self.block_range = None
+
+    def write(self, data, message_range=None):
+        self.block.append(data)
+        self.block_length += len(data)
+        if message_range:
+            if self.block_range:
+                message_range = (min(self.block_range[0], message_range[0]),
+                                 max(self.block_range[1], message_range[1]))
+            self.block_range = message_range
+        if self.block_length >= self.block_size:
+            self.write_block()
+
+    def write_block(self):
+        if not self.block:
+            return
+
+        data = ''.join(self.block).encode('utf-8')
+        if self.codec:
+            data = self.codec.compress(data)
+        self.blocks.append({
+            'offset': self.file.tell(),
+            'length': len(data),
+            'first_message': self.block_range[0] if self.block_range else None,
+            'last_message': self.block_range[1] if self.block_range else None
+        })
+        self.file.write(data)
+
+        self.block = []
+        self.block_length = 0
+        self.block_range = None
+
+    def flush(self):
+        # Blocks are only cut at their size, so that they compress well
+        self.file.flush()
+
+    def close(self):
+        try:
+            self.write_block()
+        finally:
+            self.file.close()
+
+        if self.index_path:
+            write_index(self.index_path, self.blocks, self.codec)
+
+
+class LogWriter():
+    """Writes to log files from a background thread, so that compression
+    and disk access don't block the asyncio event loop.
+
+    Records are buffered per file and written once `buffer_size` characters
+    have accumulated.  Every `flush_interval` seconds, all buffers are written
+    and flushed to disk.  Files are flushed when closed."""
+    def __init__(self, buffer_size=64*1024, flush_interval=1.0, queue_size=WRITER_QUEUE_SIZE):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.exception = None
+        # Futures of coroutines waiting for room in the queue, with their loops
+        self.waiters = []
+        self.waiters_lock = threading.Lock()
+        # Futures done as the coroutine waiting in turn before is through
+        self.turns = collections.deque()
+
+        # Metrics
+        self.max_queue_depth = 0
+        # Seconds spent waiting for room in the full queue, awaited or blocking.
+        # Encoding the records, which happens before they are queued, isn't counted.
+        self.blocked_time = 0.0
+
+        self.thread = threading.Thread(target=self.run, name='discard-writer', daemon=True)
+        self.thread.start()
+
+    def open(self, file):
+        return LogFile(self, file)
+
+    async def wait_writable(self):
+        """Wait until the queue has room, without blocking the event loop.
+        Awaited before logging from a coroutine, so that a writer which falls
+        behind slows the archiving down instead of blocking in `put`."""
+        self.raise_exception()
+        if not self.queue.full() and not self.turns:
+            return
+
+        # Coroutines take turns, so that records are queued in the order they came in
+        loop = asyncio.get_event_loop()
+        previous_turn = self.turns[-1] if self.turns else None
+        turn = loop.create_future()
+        self.turns.append(turn)
+        time_start = time.perf_counter()
+        try:
+            if previous_turn:
+                await asyncio.shield(previous_turn)
+            while self.queue.full():
+                # Don't wait forever on a writer thread which died
+                self.raise_exception()
+                if not self.thread.is_alive():
+                    break
+                future = loop.create_future()
+                with self.waiters_lock:
+                    self.waiters.append((loop, future))
+                # The thread may have made room before it saw the waiter
+                if self.queue.full():
+                    try:
+                        await asyncio.wait_for(future, 0.1)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self.turns.remove(turn)
+            turn.set_result(None)
+            self.blocked_time += time.perf_counter() - time_start
+
+    def wake_waiters(self):
+        with self.waiters_lock:
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+            except RuntimeError:
+                # The loop is closed
+                pass
+
+    def put(self, log_file, data, message_range=None):
+        """Queue a record.  Blocks while the queue is full, which coroutines
+        avoid by awaiting `wait_writable` first."""
+        self.raise_exception()
+
+        try:
+            self.queue.put_nowait((log_file, data, message_range))
+        except queue.Full:
+            time_start = time.perf_counter()
+            while True:
+                # Don't wait forever on a writer thread which died
+                self.raise_exception()
+                try:
+                    self.queue.put((log_file, data, message_range), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            self.blocked_time += time.perf_counter() - time_start
+
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def raise_exception(self):
+        if self.exception:
+            raise RuntimeError("Log writer failed") from self.exception
+
+    def sync(self):
+        """Wait until everything queued so far has been taken by the thread,
+        so that the bytes of the files are counted.  Blocks."""
+        if not self.thread.is_alive():
+            return
+        event = threading.Event()
+        self.put(None, event)
+        # Don't wait forever on a writer thread which died
+        while not event.wait(0.1):
+            self.raise_exception()
+            if not self.thread.is_alive():
+                return
+
+    def close(self):
+        """Write out everything queued, close the remaining files and stop the thread."""
+        if self.thread.is_alive():
+            self.queue.put((None, CLOSE, None))
+            self.thread.join()
+
+        self.raise_exception()
+
+    def run(self):
+        buffers = {}
+        buffer_sizes = {}
+        last_flush = time.monotonic()
+
+        def flush(log_file, to_disk=False):
+            if buffers.get(log_file):
+                log_file.file.write(''.join(buffers[log_file]))
+                if to_disk:
+                    log_file.file.flush()
+            buffers[log_file] = []
+            buffer_sizes[log_file] = 0
+
+        while True:
+            try:
+                log_file, data, message_range = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                log_file, data, message_range = None, None, None
+            if self.waiters:
+                self.wake_waiters()
+
+            if log_file is None and data is CLOSE:
+                break
+            if log_file is None and isinstance(data, threading.Event):
+                data.set()
+                continue
+
+            # After a failure, only keep draining the queue so that nothing blocks on it
+            if self.exception:
+                if data is CLOSE:
+                    buffers.pop(log_file, None)
+                    try:
+                        log_file.file.close()
+                    except BaseException:
+                        pass
+                continue
+
+            try:
+                if data is not None and data is not CLOSE:
+                    log_file.count(data)
+
+                if data is CLOSE:
+                    flush(log_file)
+                    log_file.file.close()
+                    del buffers[log_file], buffer_sizes[log_file]
+                elif data is not None and isinstance(log_file.file, BlockFile):
+                    # Block files buffer by themselves, and need the range of every record
+                    log_file.file.write(data, message_range)
+                elif data is not None:
+                    buffers.setdefault(log_file, []).append(data)
+                    buffer_sizes[log_file] = buffer_sizes.get(log_file, 0) + len(data)
+                    if buffer_sizes[log_file] >= self.buffer_size:
+                        flush(log_file)
+
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    for buffered_file in buffers:
+                        flush(buffered_file, to_disk=True)
+                    last_flush = time.monotonic()
+            except BaseException as ex:
+                self.exception = ex
+
+        for log_file in list(buffers):
+            try:
+                if not self.exception:
+                    flush(log_file)
+            except BaseException as ex:
+                self.exception = ex
+            finally:
+                log_file.file.close()
@@ -18,9 +18,12 @@ setuptools.setup(
         'click==7.1.2',
         'tqdm==4.58.0'
     ],
+    extras_require={
+        'zstd': ['zstandard']
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
 )